@@ -1,7 +1,78 @@
 #!/usr/bin/env python3
 
+import os
+import codecs
+
 import typer
-import chardet
+from chardet import UniversalDetector
+
+# Bytes read and converted at a time
+CHUNK_SIZE = 1024 * 1024
+# Bytes used to detect the encoding
+SAMPLE_SIZE = 1024 * 1024
+
+
+def warm_up():
+    """Load the detector's language models, e.g. before forking"""
+    detector = UniversalDetector()
+    detector.feed('æøå'.encode('latin-1'))
+    detector.close()
+
+
+def detect_encoding(input_file: str, limit: int = SAMPLE_SIZE,
+                    skip_ascii: bool = False):
+    """
+    Detect encoding from the start of a file
+
+    Args:
+        input_file: path for the file
+        limit: max number of bytes to read, None to read until the
+               detector is confident or the file ends
+        skip_ascii: skip blocks with only ascii characters, which the
+                    detector may be confident about before it has seen
+                    any special characters
+    """
+    detector = UniversalDetector()
+    read = 0
+    with open(input_file, 'rb') as file_r:
+        while limit is None or read < limit:
+            block = file_r.read(64 * 1024)
+            if not block:
+                break
+            read += len(block)
+            if skip_ascii and block.isascii():
+                continue
+            detector.feed(block)
+            if detector.done:
+                break
+    detector.close()
+
+    return detector.result['encoding']
+
+
+def transcode(input_file: str, output_file: str, char_enc: str):
+    """
+    Convert file from char_enc to utf8 with Linux file endings, a chunk
+    at a time
+    """
+    decoder = codecs.getincrementaldecoder(char_enc)()
+    encoder = codecs.getincrementalencoder('utf8')()
+    pending = ''
+    with open(output_file, 'wb') as file:
+        with open(input_file, 'rb') as file_r:
+            while True:
+                block = file_r.read(CHUNK_SIZE)
+                final = not block
+                data = pending + decoder.decode(block, final)
+                # A '\r' at the end may be the first half of '\r\n'
+                if not final and data.endswith('\r'):
+                    data, pending = data[:-1], '\r'
+                else:
+                    pending = ''
+                data = data.replace('\r\n', '\n').replace('\r', '\n')
+                file.write(encoder.encode(data, final))
+                if final:
+                    break
 
 
 def text2utf8(input_file: str, output_file: str):
@@ -35,33 +106,29 @@ def text2utf8(input_file: str, output_file: str):
         #('=C3=A5', 'å'),
     #)
 
-    with open(output_file, 'wb') as file:
-        with open(input_file, 'rb') as file_r:
-            content = file_r.read()
-            if content is None:
-                return ''
-
-            windows_line_ending = b'\r\n'
-            mac_line_ending = b'\r'
-            unix_line_ending = b'\n'
-            content = content.replace(windows_line_ending, unix_line_ending)
-            content = content.replace(mac_line_ending, unix_line_ending)
+    if os.path.getsize(input_file) == 0:
+        open(output_file, 'wb').close()
+        return output_file
 
-            char_enc = chardet.detect(content)['encoding']
+    char_enc = detect_encoding(input_file)
+    if char_enc is None:
+        raise typer.Exit(code=1)
 
-            try:
-                data = content.decode(char_enc)
-            except UnicodeDecodeError:
-                raise typer.Exit(code=1)
-                return ''
+    try:
+        transcode(input_file, output_file, char_enc)
+    except UnicodeDecodeError:
+        # The start of the file wasn't representative, e.g. only ascii
+        # before the first special character
+        full_enc = detect_encoding(input_file, limit=None, skip_ascii=True)
+        if full_enc in (None, char_enc):
+            raise typer.Exit(code=1)
+        try:
+            transcode(input_file, output_file, full_enc)
+        except UnicodeDecodeError:
+            raise typer.Exit(code=1)
 
-            #for k, v in repls:
-                #data = re.sub(k, v, data, flags=re.MULTILINE)
+    return output_file
 
-        try:
-            file.write(data.encode('utf8'))
-        except UnicodeEncodeError:
-            return ''
 
 if __name__ == '__main__':
     typer.run(text2utf8)
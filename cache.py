@@ -0,0 +1,138 @@
+from __future__ import annotations
+import os
+import time
+import sqlite3
+import threading
+import hashlib
+from pathlib import Path
+
+from config import cfg, pwconv_path
+from util.transfer import transfer_file
+
+
+class ConversionCache:
+    """
+    Cache of conversion results shared between runs
+
+    Outputs are stored under a key made from the hash of the source file
+    and the converter used, so the same bytes converted with the same
+    command are only converted once. When the cache grows beyond
+    `max_size` bytes, the least recently used outputs are removed.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int):
+        self.dir = Path(cache_dir)
+        self.max_size = max_size
+        self._pid = os.getpid()
+        self._objects = Path(self.dir, 'objects')
+        self._objects.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(Path(self.dir, 'index.db'), timeout=30,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS entry (
+                key TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_last_used ON entry(last_used)"
+        )
+
+    @staticmethod
+    def key(checksum: str, converter: str, dest_ext: str) -> str:
+        """
+        Get cache key for converting a file with the given content
+
+        Args:
+            checksum: checksum of the source file
+            converter: the command or function the file is converted with
+            dest_ext: extension of the output file
+        """
+        parts = [checksum, converter or '', dest_ext or '']
+        return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return Path(self._objects, key[:2], key)
+
+    def get(self, key: str, dest_path: str) -> bool:
+        """Copy cached output to dest_path, return False if not cached"""
+        path = self._path(key)
+        if not self._db.execute("SELECT 1 FROM entry WHERE key = ?",
+                                (key,)).fetchone():
+            return False
+        try:
+            Path(dest_path).parent.mkdir(parents=True, exist_ok=True)
+            # Not hardlinked, since the output may be changed later on
+            transfer_file(str(path), dest_path, ['reflink', 'kernel'])
+        except FileNotFoundError:
+            self._db.execute("DELETE FROM entry WHERE key = ?", (key,))
+            return False
+
+        self._db.execute("UPDATE entry SET last_used = ? WHERE key = ?",
+                         (time.time(), key))
+        return True
+
+    def put(self, key: str, output_path: str):
+        """Store output of a conversion"""
+        if not os.path.isfile(output_path):
+            return
+        size = os.path.getsize(output_path)
+        if size > self.max_size:
+            return
+
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        # Write to a temporary name first, so that other processes never
+        # see a partly written output
+        tmp_path = path.with_name(f'{key}.{os.getpid()}.tmp')
+        transfer_file(output_path, str(tmp_path), ['reflink', 'kernel'])
+        os.replace(tmp_path, path)
+        self._db.execute(
+            "INSERT OR REPLACE INTO entry (key, size, last_used) VALUES (?, ?, ?)",
+            (key, size, time.time())
+        )
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used outputs until cache fits max_size"""
+        total = self._db.execute("SELECT SUM(size) FROM entry").fetchone()[0] or 0
+        if total <= self.max_size:
+            return
+
+        cursor = self._db.execute("SELECT key, size FROM entry ORDER BY last_used")
+        removed = []
+        for key, size in cursor:
+            removed.append(key)
+            total -= size
+            if total <= self.max_size:
+                break
+        cursor.close()
+
+        for key in removed:
+            self._db.execute("DELETE FROM entry WHERE key = ?", (key,))
+            try:
+                self._path(key).unlink()
+            except FileNotFoundError:
+                pass
+
+
+# Caches of this process, per thread since an SQLite connection can only
+# be used by the thread that opened it
+_local = threading.local()
+
+
+def get_cache() -> ConversionCache | None:
+    """Get the conversion cache of this thread, None if not enabled"""
+    settings = cfg.get('cache') or {}
+    if not settings.get('enabled'):
+        return None
+    cache = getattr(_local, 'cache', None)
+    # A cache opened before forking a worker can't share its connection
+    if cache is None or cache._pid != os.getpid():
+        cache = _local.cache = ConversionCache(
+            Path(pwconv_path, settings.get('dir', 'data/cache')),
+            int(settings.get('max_size_gb', 10) * 1024 ** 3)
+        )
+    return cache
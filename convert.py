@@ -17,6 +17,9 @@ from __future__ import annotations
 print("Import 1: annotations")
 import os
 print("Import 2: os")
+import sys
+import signal
+import logging
 import shutil
 print("Import 3: shutil")
 import datetime
@@ -27,8 +30,12 @@ import textwrap
 print("Import 6: textwrap")
 from pathlib import Path
 print("Import 7: pathlib")
-from multiprocessing import Pool, Manager
+from multiprocessing import Pool
 print("Import 8: multiprocessing")
+from functools import partial
+from itertools import islice
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import typer
 print("Import 9: typer")
 
@@ -37,11 +44,22 @@ print("Import 10: rich")
 import petl as etl
 print("Import 11: petl")
 from dotenv import load_dotenv
-from storage import Storage
+from storage import Storage, RowBuffer
 print("Import 12: storage")
 from file import File
 print("Import 13: file")
-from util import make_filelist, remove_file, start_uno_server
+from dedup import find_duplicates, link_duplicates
+from triage import triage
+from lease import Lease, is_expired, lease_fields
+from recovery import recover, recover_row
+from util import remove_file, start_uno_server, stop_uno_server
+from util.walk import scan_files
+from util.daemon import daemon_needed, start_converter_daemon
+from util.progress import Progress, get_progress, set_progress
+from util.events import attach, emit, get_event_log, get_queue
+from util.orchestrator import start_orchestrator
+from util.identify import (FileList, get_sf_server, parse_modified,
+                           siegfried_available)
 print("Import 14: util")
 from config import cfg, converters
 print("Import 15: config")
@@ -116,7 +134,21 @@ def convert(
     ),
     multi: bool = typer.Option(
         default=False,
-        help="Use multiprocessing to convert each subfolder in its own process"
+        help="Use multiprocessing to convert files in parallel"
+    ),
+    threads: int = typer.Option(
+        default=None,
+        help="Instead of --multi, convert with this many threads in one "
+             "process, with converter commands run from an event loop. "
+             "Suited for converters that mostly wait on I/O"
+    ),
+    workers: int = typer.Option(
+        default=None,
+        help="Number of worker processes with --multi. Defaults to cpu count"
+    ),
+    chunk_size: int = typer.Option(
+        default=10,
+        help="Number of files handed to a worker at a time"
     ),
     retry: bool = typer.Option(
         default=False,
@@ -125,6 +157,24 @@ def convert(
     keep_originals: bool = typer.Option(
         default=cfg['keep-original-files'],
         help="Keep original files"
+    ),
+    dedup: bool = typer.Option(
+        default=False,
+        help="Convert files with identical content only once, and link "
+             "the result to the duplicates"
+    ),
+    rescan: bool = typer.Option(
+        default=False,
+        help="Add files that are new or changed in source since the last run"
+    ),
+    mark_missing: bool = typer.Option(
+        default=False,
+        help="With --rescan, set status 'deleted' on files no longer in source"
+    ),
+    worker: bool = typer.Option(
+        default=False,
+        help="Claim files from the database in batches, so that converters "
+             "on several hosts can share one MySQL base"
     )
 ) -> None:
     try:
@@ -162,46 +212,66 @@ def convert(
                 db = os.path.join(dest, 'convert.db')
 
         try:
-            with Storage(db) as store:
+            with Storage(db, persistent=True) as store:
                 console.print("Database connection established", style="bold green")
                 
-                # Create filelist in a writable location
-                data_dir = os.path.join(os.getcwd(), 'data')
-                Path(data_dir).mkdir(parents=True, exist_ok=True)
-                console.print(f"Data directory: {data_dir}", style="bold cyan")
-                
-                # Use a consistent filename based on source path hash to avoid conflicts
-                import hashlib
-                source_hash = hashlib.md5(source.encode()).hexdigest()[:8]
-                filelist_path = os.path.join(data_dir, f'filelist-{source_hash}.txt')
-                console.print(f"File list path: {filelist_path}", style="bold cyan")
-                
-                # Fix the logic here - is_new_batch should be True if file does NOT exist
-                is_new_batch = not os.path.isfile(filelist_path)
                 first_run = store.get_row_count() == 0
-                console.print(f"First run: {first_run}, New batch: {is_new_batch}", style="bold cyan")
+                console.print(f"First run: {first_run}", style="bold cyan")
                 
-                # Initialize status variable
-                if not status:
+                # Initialize status variable. --reconvert, --retry and
+                # --identify-only select files by status themselves.
+                if not status and not (reconvert or retry or identify_only):
                     status = 'new'  # Default status
                 
-                # Create filelist if it's a first run OR if we don't have a filelist yet
-                if first_run or is_new_batch:
-                    console.print(f"Creating file list from: {source}", style="bold cyan")
+                if worker and first_run:
+                    console.print("Files must be registered before converting "
+                                  "with --worker. Run once with --identify-only "
+                                  "from one host first.", style="bold red")
+                    return False
+                if worker and (reconvert or retry or identify_only or
+                               set_source_ext or status != 'new'):
+                    console.print("--worker only converts files with status "
+                                  "'new'", style="bold red")
+                    return False
+
+                # Identify files and insert them as they are reported
+                if first_run:
+                    console.print(f"Identifying files in: {source}", style="bold cyan")
                     try:
-                        make_filelist(source, filelist_path)
-                        
-                        console.print(f"Writing file list to database...", style="bold cyan")
-                        write_id_file_to_storage(filelist_path, source, store, '')
+                        filelist = FileList(source, progress=print_identify_progress)
+                        write_filelist_to_storage(filelist, store, progress=False)
                         status = 'new'  # Override status after creating new files
                     except Exception as e:
                         console.print(f"Error creating file list: {e}", style="bold red")
                         return False
+                elif rescan:
+                    console.print(f"Looking for changes in: {source}", style="bold cyan")
+                    rescan_source(source, store, mark_missing)
+
+                # Files this run is converting are leased, so that other
+                # runs don't recover them, and with --worker don't claim them
+                lease = Lease(db, cfg.get('lease_seconds', 300),
+                              cfg.get('claim_batch_size', 100))
+                if not first_run:
+                    scope_conds, scope_params = store.get_conds(
+                        mime=mime, puid=puid, ext=ext, from_path=from_path,
+                        to_path=to_path
+                    )
+                    count_recovered = recover(store, source, dest,
+                                              scope_conds, scope_params)
+                    if count_recovered:
+                        console.print(f"Recovered {count_recovered} files left "
+                                      "by an interrupted run", style="bold yellow")
 
-                conds, params = store.get_conds(mime=mime, puid=puid, status=status,
+                # Files added while converting, e.g. unpacked from archives,
+                # are left for the next run
+                conds, params = store.get_conds(mime=mime, puid=puid,
+                                                status=None if worker else status,
+                                                claimable=worker,
                                                 reconvert=(reconvert or identify_only),
                                                 from_path=from_path, to_path=to_path,
-                                                timestamp=timestamp, ext=ext, retry=retry)
+                                                timestamp=timestamp, ext=ext, retry=retry,
+                                                max_id=store.get_max_id())
 
                 count_remains = store.get_row_count(conds, params)
                 
@@ -209,13 +279,23 @@ def convert(
                     console.print("No files to convert found.", style="bold yellow")
                     return False  # Same issue here
                     
-                m = Manager()
-                count = {
-                    'remains': m.Value('i', count_remains),
-                    'finished': m.Value('i', 0)
-                }
+                if threads and multi:
+                    console.print("--multi is not used with --threads",
+                                  style="bold yellow")
+                    multi = False
+                progress = Progress(count_remains,
+                                    (workers or os.cpu_count() or 1) if multi else 1,
+                                    threaded=bool(threads))
+                set_progress(progress)
 
                 start_uno_server()
+                if threads:
+                    start_orchestrator(cfg.get('converter-concurrency') or threads)
+                if daemon_needed():
+                    start_converter_daemon()
+                # Started before the workers are forked, so they share it
+                if siegfried_available():
+                    get_sf_server()
                 msg = f"Converts {count_remains} files. "
                 if dest == source and keep_originals is False:
                     msg += ("You have chosen to convert files within source folder "
@@ -251,36 +331,112 @@ def convert(
 
                 console.print("Converting files..", style="bold cyan")
 
-                pool = Pool()
+                # Collect the ids before a reconvert resets the status,
+                # since the status filter wouldn't match afterwards.
+                # Otherwise the ids are read page by page while converting.
+                if reconvert:
+                    ids = store.get_ids(conds, params)
+                    store.update_status(conds, params, 'new')
+                    if dedup:
+                        console.print("--dedup is not used with --reconvert",
+                                      style="bold yellow")
+                        dedup = False
+                elif worker:
+                    # Files are claimed as the workers need them, also
+                    # files left by converters that died
+                    claim_conds, claim_params = store.get_conds(
+                        mime=mime, puid=puid, from_path=from_path,
+                        to_path=to_path, max_id=store.get_max_id()
+                    )
+                    ids = lease.iter_ids(claim_conds, claim_params)
+                    console.print(f"Claiming files as {lease.worker}",
+                                  style="bold cyan")
+                    if dedup:
+                        console.print("--dedup is not used with --worker",
+                                      style="bold yellow")
+                        dedup = False
+                else:
+                    ids = store.iter_ids(conds, params)
+
+                # Files that only need a status, like accepted formats,
+                # are set in bulk instead of one by one in the workers.
+                # The ids are read lazily, so these are left out. With
+                # --worker, the converters on other hosts would triage
+                # the same files at once, so they are left to the workers.
+                if (cfg.get('sql-triage', True) and status == 'new'
+                        and not (reconvert or identify_only or set_source_ext
+                                 or worker)):
+                    console.print("Triaging files...", style="bold cyan")
+                    count_triaged = triage(store, source, dest, conds, params,
+                                           threads=cfg.get('scan_threads') or 8)
+                    progress.total -= count_triaged
+                    console.print(f"{count_triaged} files triaged without "
+                                  "conversion", style="bold cyan")
+
+                if dedup:
+                    # Duplicates are left out here, and get the result of
+                    # the file they duplicate when it is converted
+                    console.print("Looking for duplicate files...", style="bold cyan")
+                    count_dups = find_duplicates(store, source, conds, params)
+                    console.print(f"Found {count_dups} duplicates", style="bold cyan")
+                    dup_conds, dup_params = store.get_conds(duplicate=False)
+                    ids = store.iter_ids(f"({conds}) AND {dup_conds}",
+                                         params + dup_params)
+
                 t0 = time.time()
 
                 try:
+                    task = partial(convert_chunk, source_dir=source,
+                                   dest_dir=dest, debug=debug,
+                                   orig_ext=orig_ext, db=db,
+                                   reconvert=reconvert,
+                                   identify_only=identify_only,
+                                   set_source_ext=set_source_ext,
+                                   keep_originals=keep_originals,
+                                   owner=lease.worker,
+                                   lease_seconds=lease.seconds)
                     if multi:
-                        dirs = store.get_subfolders(conds, params)
-                        console.print(f"Found {len(dirs)} subdirectories to process", style="bold cyan")
-                        for dir in dirs:
-                            dir = Path(dir).name
-                            args = (source, dest, debug, orig_ext, db, dir, True,
-                                    mime, puid, ext, status, reconvert, retry,
-                                    identify_only, filecheck, timestamp, set_source_ext,
-                                    from_path, to_path, count, keep_originals)
-                            pool.apply_async(convert_folder, args=args, error_callback=handle_error)
-                    else:
-                        console.print("Processing single folder", style="bold cyan")
-                        result = convert_folder(source, dest, debug, orig_ext, db, '', True,
-                                    mime, puid, ext, status, reconvert, retry,
-                                    identify_only, filecheck, timestamp, set_source_ext,
-                                    from_path, to_path, count, keep_originals)
-                        console.print(f"Folder processing result: {result}", style="bold cyan")
-
-                    console.print("Waiting for all processes to complete...", style="bold cyan")
-                    pool.close()
-                    pool.join()
+                        console.print(f"Distributing {count_remains} files in "
+                                      f"chunks of {chunk_size} to worker pool",
+                                      style="bold cyan")
+                    events = get_event_log()
+                    events.start()
+                    emit('run started', source=source, dest=dest,
+                         files=progress.total)
+                    progress.start()
+                    lease.start()
+                    try:
+                        run_chunks(ids, task, db, multi, workers, chunk_size,
+                                   threads)
+                        if dedup:
+                            ids = link_duplicates(store, get_row_buffer(db),
+                                                  source, dest, conds, params)
+                            progress.add('done', count_dups - len(ids))
+                            progress.stop()
+                            console.print(f"Linked {count_dups - len(ids)} "
+                                          "duplicates to converted files",
+                                          style="bold cyan")
+                            progress.start()
+                            run_chunks(ids, task, db, multi, workers,
+                                       chunk_size, threads)
+                    finally:
+                        lease.stop()
+                        progress.stop()
+                        emit('run finished', files=progress.get('done'))
+                        events.stop()
+                    console.print(f"Events written to {events.path}")
                     console.print("All processes completed", style="bold green")
-                    
+
                     console.print("Starting result summary...", style="bold cyan")
                     duration = str(datetime.timedelta(seconds=round(time.time() - t0)))
                     console.print('\nConversion finished in ' + duration)
+                    if progress.get('cached'):
+                        console.print(f"{progress.get('cached')} conversions taken "
+                                      "from cache", style="bold cyan")
+                    if progress.get('unpacked'):
+                        console.print(f"{progress.get('unpacked')} files unpacked "
+                                      "from archives are left for the next run",
+                                      style="bold cyan")
                     
                     console.print("Querying accepted files...", style="bold cyan")
                     conds, params = store.get_conds(finished=True, status='accepted',
@@ -310,202 +466,302 @@ def convert(
                     console.print(f"See database {db} for details")
                 except Exception as e:
                     console.print(f"Error during conversion process: {e}", style="bold red")
-                    pool.terminate()  # Make sure to terminate the pool on error
-                    pool.join()
                     return False
         except Exception as e:
             console.print(f"Database connection error: {e}", style="bold red")
             return False
     except KeyboardInterrupt:
         console.print("\nConversion interrupted by user", style="bold yellow")
-        if 'pool' in locals():
-            pool.terminate()
-            pool.join()
         raise typer.Exit(1)
     except Exception as e:
         console.print(f"Unexpected error in conversion: {e}", style="bold red")
         import traceback
         traceback.print_exc()
-        if 'pool' in locals():
-            pool.terminate()
-            pool.join()
         raise typer.Exit(1)
+    finally:
+        stop_uno_server()
+
+
+def iter_chunks(iterable, size):
+    """Split iterable into lists of `size` items"""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def submit_chunks(pool, task, chunks, window):
+    """
+    Submit chunks to the pool, keeping at most `window` of them queued
+
+    The chunks are read lazily, so the ids of pending files never need
+    to be held in memory all at once.
+    """
+    slots = threading.BoundedSemaphore(window)
+
+    def done(_):
+        slots.release()
+
+    def failed(error):
+        slots.release()
+        handle_error(error)
 
+    for chunk in chunks:
+        slots.acquire()
+        pool.apply_async(task, (chunk,), callback=done, error_callback=failed)
 
-def convert_folder(
+
+def run_chunks(ids, task, db, multi, workers, chunk_size, threads=None):
+    """
+    Run task on chunks of row ids
+
+    With multi, each task is a small chunk of row ids submitted to a
+    worker pool. The pool workers pull chunks from a shared queue, so an
+    idle worker always picks up the next chunk regardless of how the
+    files are spread over the source tree.
+
+    With threads, the chunks are run by a thread pool in this process
+    instead. The threads mostly wait for converter commands, which the
+    orchestrator runs from its event loop.
+    """
+    chunks = iter_chunks(ids, chunk_size)
+    if threads:
+        slots = threading.BoundedSemaphore(4 * threads)
+
+        def done(future):
+            slots.release()
+            if future.exception():
+                handle_error(future.exception())
+
+        with ThreadPoolExecutor(threads) as executor:
+            for chunk in chunks:
+                slots.acquire()
+                executor.submit(task, chunk).add_done_callback(done)
+        get_row_buffer(db).flush()
+        return
+
+    if not multi:
+        for chunk in chunks:
+            task(chunk)
+        get_row_buffer(db).flush()
+        return
+
+    # The workers of a previous pool have exited, so their rows of
+    # progress counters can be claimed again
+    progress = get_progress()
+    progress.release_rows()
+    pool = Pool(workers, initializer=init_worker,
+                initargs=(progress, get_queue()))
+    try:
+        submit_chunks(pool, task, chunks,
+                      window=4 * (workers or os.cpu_count()))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def init_worker(progress: Progress = None, events=None):
+    """Make pool workers exit cleanly on SIGTERM from `pool.terminate()`
+
+    A SystemExit lets the worker run its exit finalizers, which write
+    the rows still waiting in its row buffer. The worker also takes its
+    own row of the progress counters, and sends events to the event log
+    of the main process.
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    set_progress(progress, worker=True)
+    attach(events)
+
+
+_row_buffer = None
+_row_buffer_pid = None
+_row_buffer_lock = threading.Lock()
+
+
+def get_row_buffer(db: str) -> RowBuffer:
+    """Get the row buffer of this process"""
+    global _row_buffer, _row_buffer_pid
+    with _row_buffer_lock:
+        # A buffer copied into a forked worker has lost its timer thread,
+        # and its rows are written by the parent
+        if _row_buffer is None or _row_buffer_pid != os.getpid():
+            _row_buffer_pid = os.getpid()
+            _row_buffer = RowBuffer(db, size=cfg.get('write_batch_size', 500),
+                                    interval=cfg.get('write_batch_interval', 5))
+    return _row_buffer
+
+
+def convert_chunk(
+    ids: list[int],
     source_dir: str,
     dest_dir: str,
     debug: bool,
     orig_ext: bool,
     db: str,
-    subpath: str,
-    multi: bool,
-    mime: str,
-    puid: str,
-    ext: str,
-    status: str,
     reconvert: bool,
-    retry: bool,
     identify_only: bool,
-    filecheck: bool,
-    timestamp: datetime.datetime,
     set_source_ext: bool,
-    from_path: str,
-    to_path: str,
-    count: dict,
-    keep_originals: bool
-) -> tuple[str, str]:
-    """Convert all files in folder"""
-    
+    keep_originals: bool,
+    owner: str = None,
+    lease_seconds: int = 300
+) -> int:
+    """
+    Convert the files with the given row ids
+
+    Steps journaled while converting give the file to `owner`, the run
+    this is part of, for `lease_seconds` seconds.
+    """
+
+    buffer = get_row_buffer(db)
     try:
-        # Get all the files to process first with a single database connection
-        with Storage(db) as store:
-            if reconvert:
-                conds, params = store.get_conds(
-                    mime=mime, puid=puid, status=status, subpath=subpath,
-                    reconvert=(reconvert or identify_only), ext=ext,
-                    from_path=from_path, to_path=to_path, timestamp=timestamp,
-                    retry=retry
-                )
-                store.update_status(conds, params, 'new')
-            else:
-                conds, params = store.get_conds(
-                    mime=mime, puid=puid, status=status, subpath=subpath, ext=ext,
-                    from_path=from_path, to_path=to_path, timestamp=timestamp,
-                    reconvert=identify_only, retry=retry
-                )
-                
-            # Get all rows at once to avoid keeping the connection open for too long
+        with Storage(db, persistent=True) as store:
+            def write_journal(journal_row):
+                store.update_row({**journal_row,
+                                  **lease_fields(owner, lease_seconds)})
+
+            conds, params = store.get_conds(ids=ids)
             table = store.get_rows(conds, params)
-            all_rows = list(etl.dicts(table))
-        
-        # Process files in smaller batches, creating a new connection for each batch
-        batch_size = 20  # Smaller batch size to reduce connection time
-        total_rows = len(all_rows)
-        
-        for offset in range(0, total_rows, batch_size):
-            batch_rows = all_rows[offset:offset + batch_size]
-            
-            # Process this batch of files
-            for row in batch_rows:
-                # Open a new connection for each file operation that needs database access
-                with Storage(db) as store:
-                    process_single_file(row, source_dir, dest_dir, orig_ext, debug, 
-                                      set_source_ext, identify_only, keep_originals,
-                                      store, count, reconvert, pwconv_path)
-                
+            for row in etl.dicts(table):
+                if row['status'] == 'processing':
+                    # Claimed by this converter with --worker
+                    row['status'] = 'new'
+                if row.get('stage'):
+                    if (row.get('worker') != owner and
+                            not is_expired(row.get('worker'),
+                                           row.get('lease_expires'))):
+                        # Being converted by another run
+                        emit('file busy', id=row['id'], path=row['path'],
+                             worker=row.get('worker'))
+                        get_progress().add('done')
+                        continue
+                    # Left by a converter that died, e.g. claimed again
+                    # with --worker after its lease ran out
+                    recover_row(row, source_dir, dest_dir)
+                    row['stage'] = None
+                process_single_file(row, source_dir, dest_dir, orig_ext, debug,
+                                    set_source_ext, identify_only, keep_originals,
+                                    store, buffer, reconvert, pwconv_path,
+                                    write_journal)
+
+        return len(ids)
     except Exception as e:
-        console.print(f"Database error in convert_folder: {e}", style="bold red")
+        console.print(f"Database error in convert_chunk: {e}", style="bold red")
         raise
 
 
 def process_single_file(row, source_dir, dest_dir, orig_ext, debug, 
                        set_source_ext, identify_only, keep_originals,
-                       store, count, reconvert, pwconv_path):
+                       store, buffer, reconvert, pwconv_path,
+                       write_journal=None):
     """Process a single file conversion"""
+    progress = get_progress()
+    status = 'failed'
+    stage = 'read'
+    t0 = time.perf_counter()
     try:
-        count['finished'].value += 1
-        
-        if row['source_id'] is None:
-            pass  # Handle source file logic
-        
-        n = count['remains'].value
-        new_percent = round((1 - n/(n + count['finished'].value)) * 100)
-        
         # Use safe encoding for file path display
         file_path = row.get('path', 'unknown')
         try:
             display_path = file_path.encode('utf-8', errors='replace').decode('utf-8')
         except (UnicodeEncodeError, UnicodeDecodeError):
             display_path = repr(file_path)  # Fallback to repr for problematic paths
-            
-        print(end='\x1b[2K')  # clear line
-        print(f"\r{new_percent}% | "
-              f"{display_path[0:100]}", end=" ", flush=True)
 
         unidentify = reconvert or identify_only
-         
+
         # Handle encoding issues when creating File object
         try:
-
             src_file = File(row, pwconv_path, unidentify)
-            console.print(f"File object created successfully", style="dim")
+            src_file._write_row = write_journal or store.update_row
         except Exception as e:
-            error_msg = f"Error creating File object for {display_path}: {e}"
-            console.print(error_msg, style="bold red")
-            
+            emit('file failed', logging.ERROR, id=row.get('id'),
+                 path=display_path, stage=stage, error=str(e))
+
             # Update file status to failed with detailed error
-            if store and hasattr(store, 'update_file_status'):
-                try:
-                    store.update_file_status(row.get('id'), 'failed', str(e))
-                except Exception as db_err:
-                    console.print(f"Database update error: {db_err}", style="bold red")
+            try:
+                buffer.add({'id': row.get('id'), 'status': 'failed',
+                            'error_message': str(e)})
+            except Exception as db_err:
+                emit('database update failed', logging.ERROR, id=row.get('id'),
+                     path=display_path, stage=stage, error=str(db_err))
             return
-            
+
+        stage = 'convert'
         try:
-            console.print(f"Starting conversion for: {display_path}", style="dim")
             norm = src_file.convert(source_dir, dest_dir, orig_ext,
                                   debug, set_source_ext, identify_only,
                                   keep_originals)
-            console.print(f"Conversion completed for: {display_path}", style="dim")
+            if not identify_only:
+                src_file.duration = time.perf_counter() - t0
         except Exception as e:
-            error_msg = f"Error during conversion for {display_path}: {e}"
-            console.print(error_msg, style="bold red")
-            
+            emit('file failed', logging.ERROR, id=row.get('id'),
+                 path=display_path, stage=stage, error=str(e))
+
             # Update file status to failed
-            if store and hasattr(store, 'update_file_status'):
-                try:
-                    store.update_file_status(row.get('id'), 'failed', str(e))
-                except Exception as db_err:
-                    console.print(f"Database update error: {db_err}", style="bold red")
+            try:
+                buffer.add({'id': row.get('id'), 'status': 'failed',
+                            'error_message': str(e)})
+            except Exception as db_err:
+                emit('database update failed', logging.ERROR, id=row.get('id'),
+                     path=display_path, stage=stage, error=str(db_err))
             return
 
+        if src_file.cached:
+            progress.add('cached')
+
         # Handle conversion results
-        if norm is False:
-            if src_file.status != 'accepted':
-                console.print(f"  {src_file.status}", style="bold red")
-        elif type(norm) is str:
-            handle_unpacked_files(norm, dest_dir, store, src_file, count)
-        else:
-            handle_converted_file(norm, store)
+        stage = 'store'
+        if type(norm) is str:
+            handle_unpacked_files(norm, dest_dir, store, src_file)
+        elif norm:
+            handle_converted_file(norm, buffer)
 
         # Update source file status
         try:
             src_file.status_ts = datetime.datetime.now()
-            
-            # Ensure store is still valid before updating
-            if store and hasattr(store, 'update_row'):
-                store.update_row(src_file.__dict__)
+            # The result is recorded, so there is nothing to recover
+            src_file.stage = None
+            buffer.add(src_file.__dict__)
         except Exception as db_err:
-            console.print(f"Database update error for {display_path}: {db_err}", style="bold red")
-        
-        count['remains'].value -= 1
-        
+            emit('database update failed', logging.ERROR, id=src_file.id,
+                 path=display_path, stage=stage, error=str(db_err))
+
+        status = src_file.status
+        emit(status, logging.WARNING if status in ('failed', 'timeout')
+             else logging.INFO, id=src_file.id, path=display_path,
+             stage='done', status=status, duration=src_file.duration,
+             converter=src_file.converter, cached=src_file.cached)
+
     except UnicodeError as e:
-        error_msg = f"Unicode/encoding error processing file {row.get('path', 'unknown')}: {e}"
-        console.print(error_msg, style="bold red")
+        emit('file failed', logging.ERROR, id=row.get('id'),
+             path=row.get('path', 'unknown'), stage=stage,
+             error=f'Encoding error: {e}')
         # Update file status to failed
-        if store and hasattr(store, 'update_file_status'):
-            try:
-                store.update_file_status(row.get('id'), 'failed', f'Encoding error: {str(e)}')
-            except:
-                pass
+        try:
+            buffer.add({'id': row.get('id'), 'status': 'failed',
+                        'error_message': f'Encoding error: {str(e)}'})
+        except Exception:
+            pass
                 
     except Exception as e:
-        error_msg = f"Error processing file {row.get('path', 'unknown')}: {e}"
-        console.print(error_msg, style="bold red")
+        emit('file failed', logging.ERROR, id=row.get('id'),
+             path=row.get('path', 'unknown'), stage=stage, error=str(e))
         
         # Print full traceback for debugging
         if debug:
             import traceback
             traceback.print_exc()
         
-        # Update file status to failed - only if store is available
-        if store and hasattr(store, 'update_file_status'):
-            try:
-                store.update_file_status(row.get('id'), 'failed', str(e))
-            except:
-                pass  # Avoid cascading database errors
+        # Update file status to failed
+        try:
+            buffer.add({'id': row.get('id'), 'status': 'failed',
+                        'error_message': str(e)})
+        except Exception:
+            pass  # Avoid cascading database errors
+    finally:
+        progress.add(status)
+        progress.add('done')
 
 
 def write_id_file_to_storage(tsv_source_path: str, source_dir: str,
@@ -532,10 +788,46 @@ def write_id_file_to_storage(tsv_source_path: str, source_dir: str,
                     table = etl.fromcsv(tsv_source_path, encoding='utf-8', errors='replace')
                 except:
                     # Fallback to simple text format
-                    with open(tsv_source_path, 'r', encoding='utf-8', errors='replace') as f:
-                        lines = f.readlines()
                     table = etl.fromtext(tsv_source_path, header=['filename'], strip="\n", encoding='utf-8', errors='replace')
+
+        row_count = write_filelist_to_storage(table, store, unpacked_path, source_id)
+
+        # Clean up the temporary file
+        remove_file(tsv_source_path)
+        return row_count
         
+    except Exception as e:
+        console.print(f"Error writing file list to storage: {e}", style="bold red")
+        raise
+
+
+def fix_mime(mime: str, puid: str) -> str:
+    """Correct mime types reported by Siegfried for some formats"""
+    # Treat csv (detected from extension only) as plain text:
+    if puid == "x-fmt/18":
+        return "text/plain"
+    # Update for missing mime types where PUID is known:
+    if puid == "fmt/979":
+        return "application/xml"
+    return mime
+
+
+def write_filelist_to_storage(table, store: Storage, unpacked_path: str = '',
+                              source_id: int = None, progress: bool = True) -> int:
+    """
+    Insert file list into database storage
+
+    Args:
+        table: petl table in the format of Siegfried's csv output
+        store: database to insert into
+        unpacked_path: folder that paths in the list are relative to,
+                       for files unpacked from an archive
+        source_id: id of the archive the files are unpacked from
+        progress: print number of inserted rows while inserting
+    Returns:
+        number of rows inserted
+    """
+    try:
         # Rename columns to standard format
         table = etl.rename(
             table,
@@ -565,10 +857,13 @@ def write_id_file_to_storage(tsv_source_path: str, source_dir: str,
         table = etl.select(table, safe_path_filter)
         
         # Add required fields that may be missing
-        table = add_fields(table, 'mime', 'version', 'status', 'puid', 'source_id')
+        table = add_fields(table, 'mime', 'version', 'status', 'puid', 'source_id',
+                           'modified')
         
         # Remove Siegfried-specific columns that we don't need
-        table = remove_fields(table, "namespace", "basis", "warning", "errors", "modified")
+        table = remove_fields(table, "namespace", "basis", "warning", "errors")
+        table = etl.convert(table, 'modified', parse_modified)
+        table = etl.addfield(table, 'ext', lambda rec: Path(rec['path']).suffix)
         
         # Set default values
         table = etl.update(table, 'status', "new")
@@ -576,14 +871,8 @@ def write_id_file_to_storage(tsv_source_path: str, source_dir: str,
             table = etl.update(table, 'source_id', source_id)
         
         # Handle special cases for file type detection
-        # Treat csv (detected from extension only) as plain text:
-        table = etl.convert(table, "mime", lambda v, _row: 
-                          "text/plain" if getattr(_row, 'puid', '') == "x-fmt/18" else v,
-                          pass_row=True)
-        
-        # Update for missing mime types where PUID is known:
-        table = etl.convert(table, "mime", lambda v, _row: 
-                          "application/xml" if getattr(_row, 'puid', '') == "fmt/979" else v,
+        table = etl.convert(table, "mime", lambda v, _row:
+                          fix_mime(v, getattr(_row, 'puid', '')),
                           pass_row=True)
         
         # Handle unpacked files path adjustment
@@ -592,13 +881,19 @@ def write_id_file_to_storage(tsv_source_path: str, source_dir: str,
                               lambda v: os.path.join(unpacked_path, v))
         
         # Insert into database
-        row_count = store.append_rows(table)
-        console.print(f"Inserted {row_count} files into database", style="bold green")
-        
-        # Clean up the temporary file
-        remove_file(tsv_source_path)
+        t0 = time.time()
+        row_count = store.append_rows(
+            table,
+            chunk_size=cfg.get('insert_batch_size', 5000),
+            progress=(lambda n, rate: print(f"\rInserted {n} rows "
+                                            f"({rate:.0f} rows/s)", end=" ",
+                                            flush=True)) if progress else None
+        )
+        rate = row_count / max(time.time() - t0, 1e-6)
+        console.print(f"\nInserted {row_count} files into database "
+                      f"({rate:.0f} rows/s)", style="bold green")
         return row_count
-        
+
     except Exception as e:
         console.print(f"Error writing file list to storage: {e}", style="bold red")
         raise
@@ -607,33 +902,28 @@ def write_id_file_to_storage(tsv_source_path: str, source_dir: str,
 def check_files(source_dir, store):
     """ Check if files in database match files on disk """
 
-    files_count = sum([len(files) for r, d, files in os.walk(source_dir)])
+    disk_files = {os.path.relpath(entry.path, source_dir)
+                  for entry in scan_files(source_dir)}
     conds, params = store.get_conds(original=True)
     total_row_count = store.get_row_count(conds, params)
 
-    if files_count != total_row_count:
+    if len(disk_files) != total_row_count:
         console.print(f"Row count: {str(total_row_count)}", style="red")
-        console.print(f"File count: {str(files_count)}", style="red")
-        db_files = []
-        table = store.get_all_rows('')
-        for row in etl.dicts(table):
-            db_files.append(row['path'])
+        console.print(f"File count: {str(len(disk_files))}", style="red")
+        db_files = set()
+        for header, rows in store.get_pages(conds, params, columns='id, path'):
+            db_files.update(row[1] for row in rows)
         print("Following files don't exist in database:")
         extra_files = []
-        for r, d, files in os.walk(source_dir):
-            for file_ in files:
-                path = Path(r, file_)
-                commonprefix = os.path.commonprefix([source_dir, path])
-                relpath = os.path.relpath(path, commonprefix)
-                if relpath not in db_files:
-                    extra_files.append({'path': relpath, 'status': 'new'})
-                    print('- ' + relpath)
+        for relpath in sorted(disk_files - db_files):
+            extra_files.append({'path': relpath, 'status': 'new'})
+            print('- ' + relpath)
 
         answ = input(f"Files listed in database doesn't match "
                      "files on disk. Continue? [y]es, [n]o, [a]dd, [d]elete ")
         if answ == 'd':
             for file_ in extra_files:
-                Path(source_dir, file_['source_path']).unlink()
+                Path(source_dir, file_['path']).unlink()
             return 'deleted'
         elif answ == 'a':
             table = etl.fromdicts(extra_files)
@@ -643,34 +933,111 @@ def check_files(source_dir, store):
             return 'cancelled'
 
 
-def handle_unpacked_files(unpacked_path, dest_dir, store, src_file, count):
+def rescan_source(source_dir: str, store: Storage, mark_missing: bool = False):
+    """
+    Register files added, changed or removed in source since the last run
+
+    Size and modification time from a walk of the source are compared
+    with the file table, and only new and changed files are identified.
+    Changed files get status 'new', so they are converted again.
+
+    Args:
+        source_dir: source folder
+        store: database with the files of earlier runs
+        mark_missing: set status 'deleted' on files no longer in source
+    """
+    conds, params = store.get_conds(original=True)
+    known = {}
+    for header, rows in store.get_pages(conds, params,
+                                        columns='id, path, size, modified, status'):
+        for id, path, size, modified, status in rows:
+            known[path] = (id, size, modified, status)
+
+    now = datetime.datetime.now()
+    new_paths = []
+    changed = {}
+    updates = []
+    for entry in scan_files(source_dir, stat=True):
+        path = os.path.relpath(entry.path, source_dir)
+        row = known.pop(path, None)
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        if row is None:
+            new_paths.append(path)
+        elif row[1] != stat.st_size or row[3] == 'deleted':
+            changed[path] = row[0]
+        elif row[2] is None:
+            # Registered before modification time was stored
+            updates.append({'id': row[0], 'modified': int(stat.st_mtime)})
+        elif row[2] != int(stat.st_mtime):
+            changed[path] = row[0]
+
+    if new_paths:
+        write_filelist_to_storage(FileList(source_dir, paths=new_paths), store,
+                                  progress=False)
+
+    for row in etl.dicts(FileList(source_dir, paths=list(changed))):
+        updates.append({
+            'id': changed[row['filename']],
+            'size': row['filesize'],
+            'modified': row['modified'],
+            'mime': fix_mime(row['mime'], row['id']),
+            'format': row['format'],
+            'version': row['version'],
+            'puid': row['id'],
+            'class': row['class'],
+            'encoding': None,
+            'checksum': None,
+            'status': 'new',
+            'status_ts': now,
+        })
+    if updates:
+        store.update_rows(updates)
+
+    if mark_missing and known:
+        store.update_rows([{'id': row[0], 'status': 'deleted', 'status_ts': now}
+                           for row in known.values()])
+
+    console.print(f"{len(new_paths)} new, {len(changed)} changed and "
+                  f"{len(known)} missing files in source"
+                  + (" (marked as deleted)" if mark_missing and known else ""),
+                  style="bold green")
+
+
+def print_identify_progress(files: int, shards: int, total: int):
+    folders = f" ({shards}/{total} folders)" if total > 1 else ''
+    print(f"\rFound {files} files{folders}", end=" ", flush=True)
+
+
+def handle_unpacked_files(unpacked_path, dest_dir, store, src_file):
     """Handle files that were unpacked from archives"""
     try:
         # Add unpacked files to database
-        filelist_path = os.path.join('/tmp', f'unpacked-{src_file.id}.txt')
-        make_filelist(unpacked_path, filelist_path)
-        
-        row_count = write_id_file_to_storage(filelist_path, unpacked_path, store, 
-                                           unpacked_path, src_file.id)
-        
-        count['remains'].value += row_count
-        console.print(f"Added {row_count} unpacked files to queue", style="bold blue")
+        row_count = write_filelist_to_storage(FileList(unpacked_path), store,
+                                              unpacked_path, src_file.id,
+                                              progress=False)
         
+        get_progress().add('unpacked', row_count)
+        emit('unpacked', id=src_file.id, path=src_file.path, files=row_count)
+
     except Exception as e:
-        console.print(f"Error handling unpacked files: {e}", style="bold red")
+        emit('unpacking failed', logging.ERROR, id=src_file.id,
+             path=src_file.path, stage='store', error=str(e))
 
 
-def handle_converted_file(converted_file, store):
+def handle_converted_file(converted_file, buffer):
     """Handle successfully converted file"""
     try:
         # Update database with conversion result
         if hasattr(converted_file, '__dict__'):
-            store.update_row(converted_file.__dict__)
-        else:
-            console.print("Conversion completed successfully", style="bold green")
-            
+            buffer.add(converted_file.__dict__)
+
     except Exception as e:
-        console.print(f"Error updating converted file: {e}", style="bold red")
+        emit('database update failed', logging.ERROR,
+             path=getattr(converted_file, 'path', None), stage='store',
+             error=str(e))
 
 
 if __name__ == "__main__":
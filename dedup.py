@@ -0,0 +1,213 @@
+from __future__ import annotations
+import os
+import hashlib
+import datetime
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import petl as etl
+from rich.console import Console
+
+from storage import Storage, RowBuffer
+from util.transfer import transfer_file
+
+console = Console()
+
+# Bytes read from the start of a file for the partial hash
+PARTIAL_SIZE = 64 * 1024
+# Statuses that a duplicate can take over from the file it duplicates
+LINKABLE = ('converted', 'accepted', 'skipped', 'removed', 'protected',
+            'failed', 'timeout')
+
+
+def hash_file(path: str, limit: int = None) -> str:
+    """
+    Get sha256 hex digest of file
+
+    Args:
+        path: path to file
+        limit: only hash the first `limit` bytes
+    """
+    digest = hashlib.sha256()
+    remaining = limit
+    with open(path, 'rb') as f:
+        while True:
+            size = 1024 * 1024 if remaining is None else min(remaining, 1024 * 1024)
+            block = f.read(size)
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+                if not remaining:
+                    break
+
+    return digest.hexdigest()
+
+
+def _group_by(paths, func, executor):
+    """Group paths by the value of func, leaving out paths that fail"""
+    groups = {}
+    for path, value in zip(paths, executor.map(_safe(func), paths)):
+        if value is not None:
+            groups.setdefault(value, []).append(path)
+    return groups
+
+
+def _safe(func):
+    def wrapper(path):
+        try:
+            return func(path)
+        except OSError:
+            return None
+    return wrapper
+
+
+def find_duplicates(store: Storage, source_dir: str, conds: str, params: list,
+                    threads: int = 8) -> int:
+    """
+    Mark original files with identical content
+
+    Files are compared in three steps, so that only files that may be
+    equal are read in full: equal size, equal hash of the first 64 KB,
+    and equal hash of the whole file. The full hash is stored in
+    `checksum`, and all files but the first in a group get `duplicate_of`
+    set to the id of the first.
+
+    Returns:
+        number of files marked as duplicates
+    """
+    rows = []
+    marked = 0
+    with ThreadPoolExecutor(threads) as executor:
+        for size in store.get_duplicate_sizes(conds, params):
+            size_conds, size_params = store.get_conds(size=size)
+            table = store.get_rows(f"({conds}) AND {size_conds} AND source_id IS NULL",
+                                   list(params) + size_params)
+            files = {str(Path(source_dir, row['path'])): row['id']
+                     for row in etl.dicts(table)}
+
+            partial = _group_by(list(files), lambda p: hash_file(p, PARTIAL_SIZE),
+                                executor)
+            for paths in partial.values():
+                if len(paths) < 2:
+                    continue
+                if int(size) <= PARTIAL_SIZE:
+                    full = {hash_file(paths[0], PARTIAL_SIZE): paths}
+                else:
+                    full = _group_by(paths, hash_file, executor)
+
+                for checksum, equal in full.items():
+                    if len(equal) < 2:
+                        continue
+                    ids = sorted(files[path] for path in equal)
+                    rows.append({'id': ids[0], 'checksum': checksum})
+                    for id in ids[1:]:
+                        rows.append({'id': id, 'checksum': checksum,
+                                     'duplicate_of': ids[0]})
+                    marked += len(ids) - 1
+
+            if len(rows) >= 1000:
+                store.update_rows(rows)
+                rows = []
+
+    if rows:
+        store.update_rows(rows)
+
+    return marked
+
+
+def link_or_copy(src: str, dst: str):
+    """Hardlink file, or copy it as cheaply as possible if it can't be linked"""
+    Path(dst).parent.mkdir(parents=True, exist_ok=True)
+    transfer_file(src, dst, ['hardlink', 'reflink', 'kernel'])
+
+
+def _counterpart(path: str, primary_path: str, dup_path: str) -> str | None:
+    """
+    Get the path the duplicate would get for an output of the primary
+
+    Outputs are named after the file they are converted from, e.g.
+    `a/x.doc` -> `a/x.doc.pdf` or `a/x.pdf`, so the name of the primary is
+    replaced with the name of the duplicate.
+    """
+    if Path(path).parent != Path(primary_path).parent:
+        return None
+    name = Path(path).name
+    for old, new in ((Path(primary_path).name, Path(dup_path).name),
+                     (Path(primary_path).stem, Path(dup_path).stem)):
+        if name.startswith(old):
+            return str(Path(Path(dup_path).parent, new + name[len(old):]))
+    return None
+
+
+def link_duplicates(store: Storage, buffer: RowBuffer, source_dir: str,
+                    dest_dir: str, conds: str, params: list) -> list[int]:
+    """
+    Give duplicates the result of the file they duplicate
+
+    The output files of the first file are hardlinked, or copied, to the
+    names the duplicate would have given them, and the duplicate gets
+    the status of the first file. Duplicates where this isn't possible,
+    e.g. when the first file was unpacked to a folder, have their mark
+    removed, so that they can be converted themselves.
+
+    Returns:
+        ids of duplicates that must be converted
+    """
+    dup_conds, dup_params = store.get_conds(duplicate=True)
+    table = store.get_rows(f"({conds}) AND {dup_conds}", list(params) + dup_params)
+    primaries = {}
+    unlinked = []
+
+    for dup in etl.dicts(table):
+        primary_id = dup['duplicate_of']
+        if primary_id not in primaries:
+            rows = list(etl.dicts(store.get_rows(*store.get_conds(ids=[primary_id]))))
+            outputs = list(etl.dicts(store.get_rows(*store.get_conds(source_id=primary_id))))
+            if len(primaries) > 1000:
+                primaries = {}
+            primaries[primary_id] = (rows[0] if rows else None, outputs)
+        primary, outputs = primaries[primary_id]
+
+        links = []
+        if primary and primary['status'] in LINKABLE:
+            for output in outputs:
+                path = _counterpart(output['path'], primary['path'], dup['path'])
+                if path is None or not os.path.isfile(Path(dest_dir, output['path'])):
+                    links = None
+                    break
+                links.append((output, path))
+        else:
+            links = None
+
+        if links is None:
+            buffer.add({'id': dup['id'], 'duplicate_of': None})
+            unlinked.append(dup['id'])
+            continue
+
+        # Originals are treated as the primary's was: copied to destination
+        # when it was kept there, or removed when converting in place. This
+        # is done first, since an output may replace the copy.
+        primary_copy = Path(dest_dir, primary['path'])
+        dup_copy = Path(dest_dir, dup['path'])
+        if source_dir != dest_dir:
+            if primary_copy.is_file():
+                link_or_copy(str(Path(source_dir, dup['path'])), str(dup_copy))
+        elif not primary_copy.exists() and dup_copy.is_file():
+            dup_copy.unlink()
+
+        for output, path in links:
+            link_or_copy(str(Path(dest_dir, output['path'])), str(Path(dest_dir, path)))
+            row = {key: output[key] for key in ('mime', 'format', 'version', 'puid',
+                                                'encoding', 'size', 'status', 'kept')}
+            row.update({'id': None, 'path': path, 'source_id': dup['id']})
+            buffer.add(row)
+
+        row = {key: primary[key] for key in ('mime', 'format', 'version', 'puid',
+                                             'encoding', 'status', 'kept')}
+        row.update({'id': dup['id'], 'status_ts': datetime.datetime.now()})
+        buffer.add(row)
+
+    buffer.flush()
+    return unlinked
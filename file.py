@@ -1,21 +1,53 @@
 from __future__ import annotations
 import os
 import shutil
-import json
-import subprocess
 from os.path import relpath
 from inspect import currentframe, getframeinfo
 from pathlib import Path
 from typing import Any, Type, Dict
 from shlex import quote
 import time
+import threading
 import mimetypes
-
-import magic
-import chardet
+from contextlib import nullcontext
 
 from config import cfg, converters
-from util import run_shell_cmd
+from cache import get_cache
+from dedup import hash_file
+from util import function_command, run_function, run_shell_cmd
+from util.daemon import run_in_daemon
+from util.identify import detect_encoding, identify_file, sniff_type
+from util.orchestrator import get_orchestrator
+from util.transfer import is_same_file, transfer_file
+from util.unopool import get_uno_pool
+
+
+def get_converter(mime: str, puid: str, ext: str) -> dict:
+    """Get converter for a file, with overrides for puid or extension merged in"""
+    if mime not in converters:
+        return {}
+
+    # Copy, since overrides for puid and source-ext are merged in
+    converter = dict(converters[mime])
+    if 'puid' in converter and puid in converter['puid']:
+        converter.update(converter['puid'][puid])
+    elif 'source-ext' in converter and ext in converter['source-ext']:
+        converter.update(converter['source-ext'][ext])
+
+    return converter
+
+
+def is_accepted(converter: dict, version: str, encoding: str) -> bool:
+    accept = False
+    if 'accept' in converter:
+        if converter['accept'] is True:
+            accept = True
+        elif 'version' in converter['accept'] and version:
+            accept = version in converter['accept']['version']
+        elif 'encoding' in converter['accept'] and encoding:
+            accept = encoding in converter['accept']['encoding']
+
+    return accept
 
 
 class File:
@@ -56,30 +88,33 @@ class File:
         self._stem = Path(self.path).stem
         self.ext = Path(self.path).suffix
         self.kept = None if unidentify else row['kept']
+        self.checksum = row.get('checksum')
+        self.transfer = row.get('transfer')
+        self.duration = row.get('duration')
+        self.converter = None
+        self.stage = row.get('stage')
+        # Writes a row to the database at once, for the journal
+        self._write_row = None
+        self.cached = False
 
     def set_metadata(self, source_path, source_dir):
         if cfg['use_siegfried']:
-            cmd = ['sf', '-json', source_path]
-            p = subprocess.Popen(cmd, cwd=source_dir, stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-            out, err = p.communicate()
+            fileinfo = identify_file(os.path.join(source_dir, source_path))
 
             self.encoding = None
-            if not err:
-                fileinfo = json.loads(out)
-                self.mime = fileinfo['files'][0]['matches'][0]['mime']
-                self.format = fileinfo['files'][0]['matches'][0]['format']
-                self.version = fileinfo['files'][0]['matches'][0]['version']
-                self.size = fileinfo['files'][0]['filesize']
-                self.puid = fileinfo['files'][0]['matches'][0]['id']
-
+            if fileinfo:
+                self.mime = fileinfo['matches'][0]['mime']
+                self.format = fileinfo['matches'][0]['format']
+                self.version = fileinfo['matches'][0]['version']
+                self.size = fileinfo['filesize']
+                self.puid = fileinfo['matches'][0]['id']
+
+        header = None
         if self.mime in ['', 'None', None]:
-            self.mime = magic.from_file(source_path, mime=True)
-            self.format = magic.from_file(source_path).split(',')[0]
+            self.mime, self.format, header = sniff_type(source_path)
 
         if self.mime.startswith('text/'):
-            blob = open(source_path, 'rb').read()
-            self.encoding = chardet.detect(blob)['encoding']
+            self.encoding = detect_encoding(source_path, header)
 
         extensions = mimetypes.guess_all_extensions(self.mime, strict=False)
         if (
@@ -93,6 +128,13 @@ class File:
             self._stem = self._stem + self.ext
             self.ext = None
 
+    def journal(self, stage: str, dest_path: str, dest_dir: str):
+        """Record the step the conversion is in, see recovery.py"""
+        if self._write_row and self.id:
+            self.stage = stage
+            self._write_row({'id': self.id, 'stage': stage,
+                             'target_path': relpath(dest_path, start=dest_dir)})
+
     def get_dest_ext(self, converter, dest_path, orig_ext):
         if 'dest-ext' not in converter:
             dest_ext = self.ext
@@ -105,36 +147,50 @@ class File:
 
         return dest_ext
 
+    def get_placeholders(self, source_path, dest_path, temp_path):
+        pid = str(os.getpid())
+        if get_orchestrator():
+            # Threads convert side by side in this process
+            pid += f'-{threading.get_native_id()}'
+        return {
+            '<temp>': temp_path,
+            '<source>': source_path,
+            '<dest>': dest_path,
+            '<source-parent>': str(Path(source_path).parent),
+            '<dest-parent>': str(Path(dest_path).parent),
+            '<pid>': pid,
+            '<stem>': self._stem,
+        }
+
     def get_conversion_cmd(self, converter, source_path, dest_path, temp_path):
         cmd = converter["command"] if 'command' in converter else None
 
         if cmd:
             if '<temp>' in cmd:
                 Path(Path(temp_path).parent).mkdir(parents=True, exist_ok=True)
-                cmd = cmd.replace("<temp>", quote(temp_path))
 
-            cmd = cmd.replace("<source>", quote(source_path))
-            cmd = cmd.replace("<dest>", quote(dest_path))
-            cmd = cmd.replace("<source-parent>",
-                              quote(str(Path(source_path).parent)))
-            cmd = cmd.replace("<dest-parent>",
-                              quote(str(Path(dest_path).parent)))
-            cmd = cmd.replace("<pid>", str(os.getpid()))
-            cmd = cmd.replace("<stem>", quote(self._stem))
+            placeholders = self.get_placeholders(source_path, dest_path, temp_path)
+            for placeholder, value in placeholders.items():
+                cmd = cmd.replace(placeholder, quote(value))
 
         return cmd
 
-    def is_accepted(self, converter):
-        accept = False
-        if 'accept' in converter:
-            if converter['accept'] is True:
-                accept = True
-            elif 'version' in converter['accept'] and self.version:
-                accept = self.version in converter['accept']['version']
-            elif 'encoding' in converter['accept'] and self.encoding:
-                accept = self.encoding in converter['accept']['encoding']
+    def get_function_args(self, converter, source_path, dest_path, temp_path):
+        """Arguments for a converter run as a Python function"""
+        placeholders = self.get_placeholders(source_path, dest_path, temp_path)
+        args = []
+        for arg in converter.get('args', ['<source>', '<dest>']):
+            arg = str(arg)
+            if '<temp>' in arg:
+                Path(Path(temp_path).parent).mkdir(parents=True, exist_ok=True)
+            for placeholder, value in placeholders.items():
+                arg = arg.replace(placeholder, value)
+            args.append(arg)
 
-        return accept
+        return args
+
+    def is_accepted(self, converter):
+        return is_accepted(converter, self.version, self.encoding)
 
     def convert(
         self, source_dir: str, dest_dir: str, orig_ext: bool, debug: bool,
@@ -159,11 +215,8 @@ class File:
 
         if self.mime not in converters:
             self.status = 'skipped'
-            converter = {}
-        else:
-            converter = converters[self.mime]
 
-        mime_ext = converter.get('ext')
+        mime_ext = converters.get(self.mime, {}).get('ext')
         mime_ext = '.' + mime_ext.lstrip('.') if mime_ext else None
         if not mime_ext:
             if self.mime == 'application/xml':
@@ -186,7 +239,7 @@ class File:
         copy_path = Path(dest_dir, self.path)
         os.makedirs(os.path.dirname(copy_path), exist_ok=True)
         norm_path = None
-        keep = keep_originals or converter.get('keep', False) 
+        keep = keep_originals or converters.get(self.mime, {}).get('keep', False)
         if self.source_id is None:
             mime, encoding = mimetypes.guess_type(self.path)
             # Changes extension if it's not right
@@ -197,7 +250,8 @@ class File:
                 norm_path = relpath(copy_path, start=dest_dir)
             if source_dir != dest_dir:
                 try:
-                    shutil.copyfile(Path(source_dir, self.path), copy_path)
+                    self.transfer = transfer_file(Path(source_dir, self.path),
+                                                  copy_path)
                 except Exception as e:
                     frame = getframeinfo(currentframe())
                     filename = frame.filename
@@ -206,11 +260,7 @@ class File:
             elif norm_path:
                 shutil.move(Path(source_dir, self.path), copy_path)
 
-        if 'puid' in converter and self.puid in converter['puid']:
-            converter.update(converter['puid'][self.puid])
-        elif 'source-ext' in converter and self.ext in converter['source-ext']:
-            converter.update(converter['source-ext'][self.ext])
-
+        converter = get_converter(self.mime, self.puid, self.ext)
         accept = self.is_accepted(converter)
 
         dest_path = os.path.join(dest_dir, self._parent, self._stem)
@@ -225,12 +275,18 @@ class File:
         elif self.mime == 'application/encrypted':
             self.status = 'protected'
             self.kept = True
-        elif 'command' in converter:
+        elif 'command' in converter or 'function' in converter:
             from_path = source_path
 
             dest_ext = self.get_dest_ext(converter, dest_path, orig_ext)
             dest_path = dest_path + dest_ext
 
+            # Journaled before the source can be moved or the output
+            # written, so that an interrupted run can be recovered
+            if (not os.path.exists(dest_path)
+                    or os.path.getsize(dest_path) == self.size):
+                self.journal('convert', dest_path, dest_dir)
+
             if from_path.lower() == dest_path.lower():
                 os.makedirs(os.path.dirname(temp_path), exist_ok=True)
                 shutil.move(source_path, temp_path)
@@ -238,6 +294,23 @@ class File:
 
             cmd = self.get_conversion_cmd(converter, from_path, dest_path,
                                           temp_path)
+            orchestrator = get_orchestrator()
+            func = converter.get('function')
+            if cmd and not cfg.get('in-process-converters', True):
+                func = None
+            elif cmd and orchestrator and not converter.get('daemon'):
+                # With --threads the command is run from the event loop
+                func = None
+            self.converter = func or converter.get('command')
+            # Functions are run in a child process, or in the converter daemon
+            forked = func and (converter.get('daemon') or not orchestrator)
+            if func:
+                args = self.get_function_args(converter, from_path, dest_path,
+                                              temp_path)
+                if forked:
+                    cmd = f"{func}({', '.join(map(quote, args))})"
+                else:
+                    cmd = function_command(func, args)
 
             # Disabled because not in use, and file command doesn't have version
             # with option --mime-type
@@ -246,11 +319,52 @@ class File:
                        else cfg['timeout'])
 
             returncode = 0
+            # The copy of the original may be a hardlink to it, and must
+            # not be overwritten by the output
+            unlinked = is_same_file(dest_path, from_path)
+            if unlinked:
+                os.remove(dest_path)
+
             # Don't run convert command if file is converted manually
             if (not os.path.exists(dest_path) or os.path.getsize(dest_path) == self.size):
 
-                returncode, out, err = run_shell_cmd(cmd, cwd=self._pwconv_path,
-                                                     shell=True, timeout=timeout)
+                # Use output from an earlier conversion of the same content
+                # with the same converter, if any
+                cache = get_cache()
+                key = None
+                if cache and os.path.isfile(from_path):
+                    if not self.checksum:
+                        self.checksum = hash_file(from_path)
+                    key = cache.key(self.checksum, self.converter, dest_ext)
+
+                if key and cache.get(key, dest_path):
+                    self.cached = True
+                    out = err = ''
+                elif forked:
+                    runner = run_in_daemon if converter.get('daemon') else run_function
+                    returncode, out, err = runner(func, args, timeout=timeout)
+                else:
+                    # Office conversions are spread over the pool of unoservers
+                    uno = cmd.startswith('unoconvert')
+                    with get_uno_pool().acquire() if uno else nullcontext() as server:
+                        if server:
+                            cmd = server.wrap(cmd)
+                        if orchestrator:
+                            returncode, out, err = orchestrator.run(
+                                cmd, cwd=self._pwconv_path, timeout=timeout,
+                                key=self.mime, key_limit=converter.get('concurrency')
+                            )
+                        else:
+                            returncode, out, err = run_shell_cmd(
+                                cmd, cwd=self._pwconv_path, shell=True,
+                                timeout=timeout
+                            )
+                        if server and out == 'timeout':
+                            # LibreOffice probably hangs on the document
+                            server.restart()
+
+                if key and not returncode and not self.cached:
+                    cache.put(key, dest_path)
 
             if returncode or not os.path.exists(dest_path):
                 if from_path == dest_path:
@@ -278,11 +392,16 @@ class File:
                     # use shutil.copyfile to not get any file permission error
                     shutil.copyfile(from_path, source_path)
                     os.remove(from_path)
+                elif unlinked:
+                    # Put back the copy of the original
+                    transfer_file(from_path, dest_path)
 
                 norm_path = False
             else:
                 self.status = 'converted'
                 norm_path = relpath(dest_path, start=dest_dir)
+                if self.stage:
+                    self.journal('converted', dest_path, dest_dir)
 
             if os.path.isfile(temp_path):
                 os.remove(temp_path)
@@ -0,0 +1,92 @@
+from __future__ import annotations
+import os
+import time
+import socket
+import threading
+from typing import Iterator
+
+from storage import Storage
+
+
+def get_worker_id() -> str:
+    """Get id of this converter, unique across hosts"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def is_expired(worker: str, lease_expires: int | None) -> bool:
+    """
+    Check if a lease has run out
+
+    A lease held by a process on this host that is gone, e.g. after a
+    crash, is expired as well, so that a new run doesn't wait for it.
+    """
+    if not lease_expires or lease_expires < time.time():
+        return True
+    host, _, pid = (worker or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        # Running as another user
+        pass
+    return False
+
+
+def lease_fields(worker: str, seconds: int) -> dict:
+    """Columns giving a row to worker for the next `seconds` seconds"""
+    return {'worker': worker, 'lease_expires': int(time.time()) + seconds}
+
+
+class Lease:
+    """
+    Files claimed by this converter from a database shared with others
+
+    Files are claimed in batches as the workers need them, and the
+    lease on them is renewed by a heartbeat thread while they wait or
+    are converted. If the converter dies, the lease runs out and the
+    files are claimed by another converter.
+
+    Runs without --worker don't claim files, but hold a lease on the
+    files they journal a conversion step for, so that other runs don't
+    recover them while they are converted.
+    """
+
+    def __init__(self, db: str, seconds: int = 300, batch_size: int = 100):
+        self.db = db
+        self.seconds = seconds
+        self.batch_size = batch_size
+        self.worker = get_worker_id()
+        self.claimed = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def iter_ids(self, conds: str, params: list) -> Iterator[int]:
+        """Claim files matching conds batch by batch, until none are left"""
+        with Storage(self.db, persistent=True) as store:
+            while ids := store.claim_rows(conds, params, self.worker,
+                                          self.batch_size, self.seconds):
+                self.claimed += len(ids)
+                yield from ids
+
+    def start(self):
+        """Renew the lease three times within its duration"""
+        def run():
+            with Storage(self.db, persistent=True) as store:
+                while not self._stop.wait(self.seconds / 3):
+                    store.renew_leases(self.worker, self.seconds)
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop renewing, and give back files that weren't converted"""
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        with Storage(self.db, persistent=True) as store:
+            store.release_rows(self.worker)
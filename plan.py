@@ -0,0 +1,182 @@
+from __future__ import annotations
+import os
+import datetime
+from collections import defaultdict
+
+import typer
+from dotenv import load_dotenv
+from rich.console import Console
+from rich.table import Table
+
+from config import cfg
+from file import get_converter
+from storage import Storage
+from triage import resolve_rule
+
+console = Console()
+load_dotenv()
+
+
+def get_label(mime, puid, ext, version, encoding) -> tuple[str, bool]:
+    """
+    Get name of the converter File.convert would use for these files
+
+    Returns:
+        tuple of the name, and whether the files are converted
+    """
+    rule = resolve_rule(mime, puid, ext, version, encoding)
+    if rule:
+        return f"({rule[0]})", not cfg.get('sql-triage', True)
+    if mime in ('', 'None', None):
+        return "(identify first)", True
+    if not ext and mime != 'application/octet-stream':
+        return "(rename)", True
+
+    converter = get_converter(mime, puid, ext)
+    func = converter.get('function')
+    if func and (cfg.get('in-process-converters', True)
+                 or not converter.get('command')):
+        return func, True
+    if converter.get('command'):
+        return converter['command'], True
+    # Accepted or not by version or encoding, which is found when converting
+    return "(check accept)", True
+
+
+def format_size(size: float) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if size < 1024 or unit == 'TB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def format_duration(seconds: float) -> str:
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+
+def estimate(group: dict, history: dict) -> float | None:
+    """
+    Estimate seconds needed to convert files in group by one worker
+
+    Uses the time per byte measured for the same converter on earlier
+    runs, or the time per file if the sizes are unknown.
+    """
+    if not history or not history['timed']:
+        return None
+    if history['timed_size'] and group['size']:
+        return group['size'] * history['time'] / history['timed_size']
+    return group['count'] * history['time'] / history['timed']
+
+
+def get_groups(store: Storage, conds: str, params: list) -> dict:
+    """Sum up files matching conds by the converter they get"""
+    # Rules match on the extension, which File finds from the path
+    store.fill_ext(conds, params)
+    groups = defaultdict(lambda: {'count': 0, 'size': 0, 'timed': 0,
+                                  'timed_size': 0, 'time': 0.0,
+                                  'converted': True})
+    for row in store.get_rule_groups(conds, params):
+        key = row[:5]
+        count, size, timed, timed_size, time = row[5:]
+        label, converted = get_label(*key)
+        group = groups[label]
+        group['converted'] = converted
+        group['count'] += count
+        group['size'] += int(size or 0)
+        group['timed'] += timed
+        group['timed_size'] += int(timed_size or 0)
+        group['time'] += float(time or 0)
+
+    return groups
+
+
+def plan(
+    source: str,
+    dest: str = typer.Option(default=None, help="Path to destination folder"),
+    db: str = typer.Option(default=None, help="Name of MySQL base"),
+    mime: str = typer.Option(default=None, help="Filter on mime-type"),
+    puid: str = typer.Option(default=None,
+                             help="Filter on PRONOM Unique Identifier"),
+    status: str = typer.Option(default=None,
+                               help="Filter on conversion status"),
+    from_path: str = typer.Option(default=None,
+                                  help="Plan files where path ≥ this value"),
+    to_path: str = typer.Option(default=None,
+                                help="Plan files where path < this value"),
+    reconvert: bool = typer.Option(default=False,
+                                   help="Plan reconversion of files"),
+    retry: bool = typer.Option(
+        default=False,
+        help="Plan conversion of files where conversion previously failed"
+    ),
+    workers: int = typer.Option(
+        default=None,
+        help="Number of worker processes. Defaults to cpu count"
+    )
+):
+    """
+    Show what a conversion would do, without converting anything
+
+    Files that `convert.py` would convert with the same options are
+    grouped by the converter they get, with estimated time based on how
+    long the converter took on files converted earlier.
+    """
+    if dest is None:
+        dest = source
+    dest = os.path.abspath(dest)
+    workers = workers or os.cpu_count() or 1
+    # --reconvert and --retry select files by status themselves
+    if not status and not (reconvert or retry):
+        status = 'new'
+
+    if not db:
+        db = 'mysql' if os.getenv('DB_HOST') else os.path.join(dest, 'convert.db')
+        if db != 'mysql' and not os.path.exists(db):
+            console.print(f"No database at {db}. Files are registered on the "
+                          "first run of convert.py", style="bold red")
+            raise typer.Exit(1)
+
+    with Storage(db) as store:
+        conds, params = store.get_conds(mime=mime, puid=puid, status=status,
+                                        reconvert=reconvert, retry=retry,
+                                        from_path=from_path, to_path=to_path)
+        groups = get_groups(store, conds, params)
+        history = get_groups(store, "duration IS NOT NULL", [])
+
+    if not groups:
+        console.print("No files to convert found.", style="bold yellow")
+        return
+
+    count = sum(group['count'] for group in groups.values())
+    table = Table(title=f"Conversion plan for {count} files")
+    table.add_column("Converter", overflow='fold')
+    table.add_column("Files", justify='right')
+    table.add_column("Size", justify='right')
+    table.add_column("Est. time", justify='right')
+    table.add_column("Based on", justify='right')
+
+    total = 0.0
+    unknown = 0
+    for label, group in sorted(groups.items(), key=lambda item: -item[1]['size']):
+        seconds = estimate(group, history.get(label)) if group['converted'] else 0
+        if seconds is None:
+            unknown += group['count']
+            time_text = "unknown"
+        else:
+            total += seconds
+            time_text = format_duration(seconds)
+        basis = history.get(label, {}).get('timed', 0)
+        table.add_row(label, str(group['count']), format_size(group['size']),
+                      time_text, f"{basis} files" if basis else "-")
+
+    console.print(table)
+    console.print(f"Estimated time with {workers} workers: "
+                  f"{format_duration(total / workers)}", style="bold cyan")
+    if unknown:
+        console.print(f"{unknown} files have converters without measured time "
+                      "on earlier runs, and are not in the estimate",
+                      style="bold yellow")
+
+
+if __name__ == "__main__":
+    typer.run(plan)
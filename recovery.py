@@ -0,0 +1,97 @@
+from __future__ import annotations
+import time
+import shutil
+import socket
+from pathlib import Path
+
+from lease import is_expired
+from storage import Storage
+
+# Where File.convert moves a source that is converted to the same path
+TEMP_DIR = '/tmp/convert'
+
+
+def _remove(path: Path):
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    elif path.exists() or path.is_symlink():
+        path.unlink()
+
+
+def recover_row(row: dict, source_dir: str, dest_dir: str) -> str | None:
+    """
+    Clean up after a conversion that was interrupted
+
+    File.convert journals the step it is in to the `stage` column before
+    running the converter ('convert') and after it succeeds
+    ('converted'). The stage is cleared when the result is recorded, so
+    a stage left on a row means the process died in between.
+
+    An interrupted conversion is rolled back: the output, which may be
+    partly written, is removed, and a source moved to the temp folder is
+    moved back. A finished conversion is kept, so that the next attempt
+    finds the output and only records it.
+
+    Returns:
+        the stage the file was left in
+    """
+    stage = row.get('stage')
+    if not stage:
+        return None
+
+    base_dir = dest_dir if row['source_id'] else source_dir
+    source_path = Path(base_dir, row['path'])
+    temp_path = Path(TEMP_DIR, row['path'])
+
+    if stage == 'convert' and row.get('target_path'):
+        target = Path(dest_dir, row['target_path'])
+        # If the source was converted to its own path, the target is the
+        # original until it has been moved to the temp folder
+        if target != source_path or temp_path.exists():
+            _remove(target)
+
+    if temp_path.is_file() and not source_path.exists():
+        shutil.move(temp_path, source_path)
+    elif temp_path.exists():
+        _remove(temp_path)
+
+    return stage
+
+
+def recover(store: Storage, source_dir: str, dest_dir: str,
+            conds: str = None, params: list = None) -> int:
+    """
+    Recover files left by an interrupted run
+
+    Only files matching conds are recovered, so that a run on one part
+    of the files leaves the rest alone. Files with a live lease are
+    being converted by another run, and are left alone too, unless the
+    run was on this host and its process is gone. Recovered files get
+    status 'new'.
+
+    Returns:
+        number of files recovered
+    """
+    mark = '%s' if store.is_mysql else '?'
+    conds = (f"({conds or '1=1'}) AND stage IS NOT NULL AND "
+             f"(lease_expires IS NULL OR lease_expires < {mark} "
+             f"OR worker LIKE {mark})")
+    params = list(params or []) + [int(time.time()),
+                                   f"{socket.gethostname()}:%"]
+    count = 0
+    for header, rows in store.get_pages(conds, params,
+                                        columns='id, path, source_id, stage, '
+                                                'target_path, worker, '
+                                                'lease_expires'):
+        updates = []
+        for values in rows:
+            row = dict(zip(header, values))
+            if not is_expired(row['worker'], row['lease_expires']):
+                continue
+            recover_row(row, source_dir, dest_dir)
+            updates.append({'id': row['id'], 'stage': None, 'status': 'new'})
+        if updates:
+            store.update_rows(updates)
+        count += len(updates)
+
+    return count
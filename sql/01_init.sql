@@ -3,6 +3,7 @@ CREATE DATABASE IF NOT EXISTS pwconvert;
 USE pwconvert;
 
 -- Main files table
+-- The status values must match STATUSES in storage.py
 CREATE TABLE IF NOT EXISTS file (
     id INT AUTO_INCREMENT PRIMARY KEY,
     path VARCHAR(1000) NOT NULL,
@@ -10,7 +11,7 @@ CREATE TABLE IF NOT EXISTS file (
     mime VARCHAR(255),
     format VARCHAR(255),
     version VARCHAR(100),
-    status ENUM('new', 'processing', 'converted', 'failed', 'accepted', 'skipped', 'protected', 'timeout', 'deleted', 'removed') DEFAULT 'new',
+    status ENUM('new', 'processing', 'converted', 'failed', 'accepted', 'skipped', 'protected', 'timeout', 'deleted', 'removed', 'renamed') DEFAULT 'new',
     puid VARCHAR(50),
     class VARCHAR(100),
     source_id INT,
@@ -24,11 +25,22 @@ CREATE TABLE IF NOT EXISTS file (
     original BOOLEAN DEFAULT TRUE,
     finished BOOLEAN DEFAULT FALSE,
     subpath VARCHAR(500),
+    checksum VARCHAR(64),
+    duplicate_of INT,
+    modified BIGINT,
+    transfer VARCHAR(20),
+    ext VARCHAR(50),
+    duration DOUBLE,
+    worker VARCHAR(100),
+    lease_expires BIGINT,
+    stage VARCHAR(20),
     INDEX idx_status (status),
     INDEX idx_path (path(255)),
     INDEX idx_source_id (source_id),
     INDEX idx_puid (puid),
-    INDEX idx_mime (mime)
+    INDEX idx_mime (mime),
+    INDEX idx_checksum (checksum),
+    INDEX idx_stage (stage)
 );
 
 -- CTE (Conversion Type Extensions) table for file type mappings
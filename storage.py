@@ -1,14 +1,112 @@
 import os
+import time
+import atexit
 import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import islice
+from multiprocessing import util as mp_util
 from pathlib import Path
 import petl as etl
 
+# Columns that can be written from a row dict, e.g. `File.__dict__`
+COLUMNS = (
+    'path', 'size', 'mime', 'format', 'version', 'status', 'puid', 'class',
+    'source_id', 'encoding', 'status_ts', 'error_message', 'target_path',
+    'kept', 'original', 'finished', 'subpath', 'checksum', 'duplicate_of',
+    'modified', 'transfer', 'ext', 'duration', 'worker', 'lease_expires',
+    'stage'
+)
+
+
+# Columns added after the first release, as (name, MySQL type, SQLite type,
+# indexed). They are added to existing databases when the storage is opened.
+ADDED_COLUMNS = [
+    ('checksum', 'VARCHAR(64)', 'TEXT', True),
+    ('duplicate_of', 'INT', 'INTEGER', False),
+    # Modification time of the file as seconds since epoch
+    ('modified', 'BIGINT', 'INTEGER', False),
+    # How the original was copied to destination, see util.transfer
+    ('transfer', 'VARCHAR(20)', 'TEXT', False),
+    # Extension of the file name, for matching converter rules in SQL
+    ('ext', 'VARCHAR(50)', 'TEXT', False),
+    # Seconds spent converting the file, for the estimates in plan.py
+    ('duration', 'DOUBLE', 'REAL', False),
+    # Host and process converting the file, and until when it has the file
+    # (seconds since epoch), see `Storage.claim_rows`
+    ('worker', 'VARCHAR(100)', 'TEXT', False),
+    ('lease_expires', 'BIGINT', 'INTEGER', False),
+    # Step of a conversion in progress, see recovery.py
+    ('stage', 'VARCHAR(20)', 'TEXT', True),
+]
+
+# Values of the status column, as a MySQL ENUM. The ENUM in sql/01_init.sql
+# must list the same values, which is checked by tests/test_storage.py.
+STATUSES = (
+    'new', 'processing', 'converted', 'failed', 'accepted', 'skipped',
+    'protected', 'timeout', 'deleted', 'removed', 'renamed'
+)
+STATUS_ENUM = ', '.join(f"'{status}'" for status in STATUSES)
+
+# Columns a triage rule matches on, see `Storage.set_rules`
+RULE_KEYS = ('mime', 'puid', 'ext', 'version', 'encoding')
+
+# Long-lived connections, keyed by (process id, thread id, db path)
+_connections = {}
+# Prepared MySQL cursors per long-lived connection, keyed by SQL
+_cursors = {}
+# Databases where the schema has been ensured in this process or a parent
+_schema_ready = set()
+# Seconds a long-lived connection may be idle before it is checked
+_PING_AFTER = 60
+_MAX_CURSORS = 64
+
+
+@lru_cache(maxsize=None)
+def _insert_sql(cols, mark):
+    return (f"INSERT INTO file ({', '.join(cols)}) "
+            f"VALUES ({', '.join([mark] * len(cols))})")
+
+
+@lru_cache(maxsize=None)
+def _update_sql(cols, mark):
+    set_clause = ', '.join(f"{col} = {mark}" for col in cols)
+    return f"UPDATE file SET {set_clause} WHERE id = {mark}"
+
+
+def close_connections():
+    """Close the long-lived connections opened by this process"""
+    pid = os.getpid()
+    for key in [key for key in _connections if key[0] == pid]:
+        for cursor in _cursors.pop(key, {}).values():
+            try:
+                cursor.close()
+            except Exception:
+                pass
+        conn, _ = _connections.pop(key)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+atexit.register(close_connections)
+
 
 class Storage:
-    def __init__(self, db_path):
+    def __init__(self, db_path, persistent=False):
+        """
+        Args:
+            db_path: path to SQLite database, or 'mysql'
+            persistent: reuse one connection per process and thread instead
+                        of connecting each time the storage is opened
+        """
         self.db_path = db_path
+        self.persistent = persistent
         self.connection = None
         self.is_mysql = self._is_mysql()
+        self._key = None
 
     def _is_mysql(self):
         """Check if we should use MySQL based on environment or db_path"""
@@ -18,7 +116,9 @@ class Storage:
 
     def __enter__(self):
         self.connect()
-        self._ensure_tables_exist()
+        if not (self.persistent and self.db_path in _schema_ready):
+            self._ensure_tables_exist()
+            _schema_ready.add(self.db_path)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -26,6 +126,9 @@ class Storage:
 
     def connect(self):
         """Establish database connection"""
+        if self.persistent:
+            return self._connect_persistent()
+
         try:
             if self.is_mysql:
                 try:
@@ -47,12 +150,17 @@ class Storage:
                 import sqlite3
                 # Create directory if it doesn't exist
                 Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+                # Autocommit like the MySQL connection, so that rows
+                # written here are visible to the worker processes
                 self.connection = sqlite3.connect(
                     self.db_path,
                     timeout=30,
-                    check_same_thread=False
+                    check_same_thread=False,
+                    isolation_level=None,
+                    cached_statements=256
                 )
                 self.connection.row_factory = sqlite3.Row
+                self.connection.execute("PRAGMA synchronous = NORMAL")
                 logging.info(f"Connected to SQLite database: {self.db_path}")
 
             return self.connection
@@ -60,6 +168,50 @@ class Storage:
             logging.error(f"Database connection failed: {e}")
             raise
 
+    def _connect_persistent(self):
+        """Reuse the connection of this process and thread, if any"""
+        self._key = (os.getpid(), threading.get_ident(), self.db_path)
+        if self._key in _connections:
+            conn, last_used = _connections[self._key]
+            if self.is_mysql and time.time() - last_used > _PING_AFTER:
+                # The server may have dropped an idle connection
+                conn.ping(reconnect=True, attempts=3, delay=1)
+            _connections[self._key] = (conn, time.time())
+            self.connection = conn
+            return conn
+
+        self.persistent = False
+        try:
+            conn = self.connect()
+        finally:
+            self.persistent = True
+        _connections[self._key] = (conn, time.time())
+        return conn
+
+    def _cursor(self, sql=None):
+        """
+        Get a cursor for the statement
+
+        On long-lived MySQL connections, a prepared cursor is kept per
+        statement, so the statement is only parsed once by the server.
+        """
+        if not (sql and self.persistent and self.is_mysql):
+            return self.connection.cursor()
+
+        cursors = _cursors.setdefault(self._key, OrderedDict())
+        if sql in cursors:
+            cursors.move_to_end(sql)
+        else:
+            cursors[sql] = self.connection.cursor(prepared=True)
+            if len(cursors) > _MAX_CURSORS:
+                _, cursor = cursors.popitem(last=False)
+                cursor.close()
+        return cursors[sql]
+
+    def _release(self, cursor):
+        if not (self.persistent and self.is_mysql):
+            cursor.close()
+
     def _ensure_tables_exist(self):
         """Create tables if they don't exist"""
         try:
@@ -67,16 +219,19 @@ class Storage:
 
             if self.is_mysql:
                 # MySQL table creation
-                cursor.execute("""
+                cursor.execute(f"""
                     CREATE TABLE IF NOT EXISTS file (
                         id INT AUTO_INCREMENT PRIMARY KEY,
                         path VARCHAR(1000) NOT NULL,
                         size BIGINT,
                         mime VARCHAR(255),
+                        format VARCHAR(255),
                         version VARCHAR(100),
-                        status ENUM('new', 'processing', 'converted', 'failed', 'accepted', 'skipped', 'protected', 'timeout', 'deleted', 'removed') DEFAULT 'new',
+                        status ENUM({STATUS_ENUM}) DEFAULT 'new',
                         puid VARCHAR(50),
+                        class VARCHAR(100),
                         source_id INT,
+                        encoding VARCHAR(100),
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
                         status_ts TIMESTAMP NULL,
@@ -99,10 +254,13 @@ class Storage:
                         path TEXT NOT NULL,
                         size INTEGER,
                         mime TEXT,
+                        format TEXT,
                         version TEXT,
                         status TEXT DEFAULT 'new',
                         puid TEXT,
+                        class TEXT,
                         source_id INTEGER,
+                        encoding TEXT,
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                         status_ts TIMESTAMP,
@@ -117,44 +275,100 @@ class Storage:
 
             # Create indexes for SQLite
             if not self.is_mysql:
+                # Lets readers in the worker processes run alongside a writer
+                cursor.execute("PRAGMA journal_mode = WAL")
                 cursor.execute("CREATE INDEX IF NOT EXISTS idx_status ON file(status)")
                 cursor.execute("CREATE INDEX IF NOT EXISTS idx_path ON file(path)")
                 cursor.execute("CREATE INDEX IF NOT EXISTS idx_source_id ON file(source_id)")
 
+            self._ensure_columns(cursor)
+            if self.is_mysql:
+                self._ensure_statuses(cursor)
+
             cursor.close()
             logging.info("Database tables ensured")
         except Exception as e:
             logging.error(f"Error creating tables: {e}")
             raise
 
-    def append_rows(self, table):
-        """Insert rows from petl table into database"""
-        try:
-            cursor = self.connection.cursor()
-            rows = list(etl.dicts(table))
+    def _ensure_columns(self, cursor):
+        """Add columns from `ADDED_COLUMNS` that the file table lacks"""
+        cursor.execute("SELECT * FROM file LIMIT 0")
+        existing = {desc[0] for desc in cursor.description}
+        cursor.fetchall()
+
+        for name, mysql_type, sqlite_type, indexed in ADDED_COLUMNS:
+            if name in existing:
+                continue
+            col_type = mysql_type if self.is_mysql else sqlite_type
+            cursor.execute(f"ALTER TABLE file ADD COLUMN {name} {col_type}")
+            if indexed:
+                cursor.execute(f"CREATE INDEX idx_{name} ON file({name})")
 
-            if not rows:
+    def _ensure_statuses(self, cursor):
+        """Add statuses from `STATUSES` that the MySQL status ENUM lacks"""
+        cursor.execute("SHOW COLUMNS FROM file LIKE 'status'")
+        column_type = cursor.fetchone()[1]
+        if isinstance(column_type, bytes):
+            column_type = column_type.decode()
+        if all(f"'{status}'" in column_type for status in STATUSES):
+            return
+        cursor.execute(f"ALTER TABLE file MODIFY COLUMN status "
+                       f"ENUM({STATUS_ENUM}) DEFAULT 'new'")
+
+    def append_rows(self, table, chunk_size=5000, progress=None):
+        """
+        Insert rows from petl table into database
+
+        The table is read as a stream and inserted in chunks, each chunk
+        with one executemany in its own transaction, so memory use doesn't
+        grow with the size of the table.
+
+        Args:
+            table: petl table with columns of the file table
+            chunk_size: number of rows per transaction
+            progress: called with number of rows inserted so far and
+                      rows per second after each chunk
+        Returns:
+            number of rows inserted
+        """
+        try:
+            columns = tuple(etl.header(table))
+            if not columns:
                 return 0
 
-            # Get column names from first row
-            columns = list(rows[0].keys())
+            insert_sql = _insert_sql(columns, '%s' if self.is_mysql else '?')
+            width = len(columns)
+            rows = iter(etl.data(table))
+            count = 0
+            t0 = time.time()
+            cursor = self.connection.cursor()
 
-            # Create INSERT statement
-            if self.is_mysql:
-                placeholders = ', '.join(['%s'] * len(columns))
-                insert_sql = f"INSERT INTO file ({', '.join(columns)}) VALUES ({placeholders})"
-            else:
-                placeholders = ', '.join(['?'] * len(columns))
-                insert_sql = f"INSERT INTO file ({', '.join(columns)}) VALUES ({placeholders})"
+            while True:
+                chunk = [
+                    tuple(row) if len(row) == width
+                    else (tuple(row) + (None,) * width)[:width]
+                    for row in islice(rows, chunk_size)
+                ]
+                if not chunk:
+                    break
 
-            # Insert rows
-            for row in rows:
-                values = [row.get(col) for col in columns]
-                cursor.execute(insert_sql, values)
+                self.begin()
+                try:
+                    cursor.executemany(insert_sql, chunk)
+                    self.commit()
+                except Exception:
+                    self.rollback()
+                    raise
+
+                count += len(chunk)
+                rate = count / max(time.time() - t0, 1e-6)
+                logging.info(f"Inserted {count} rows ({rate:.0f} rows/s)")
+                if progress:
+                    progress(count, rate)
 
             cursor.close()
-            logging.info(f"Inserted {len(rows)} rows into database")
-            return len(rows)
+            return count
 
         except Exception as e:
             logging.error(f"Error inserting rows: {e}")
@@ -163,16 +377,17 @@ class Storage:
     def get_row_count(self, conds=None, params=None):
         """Get count of rows matching conditions"""
         try:
-            cursor = self.connection.cursor()
-
-            if conds and params:
+            if conds:
                 sql = f"SELECT COUNT(*) as count FROM file WHERE {conds}"
-                cursor.execute(sql, params)
+                params = params or ()
             else:
-                cursor.execute("SELECT COUNT(*) as count FROM file")
+                sql = "SELECT COUNT(*) as count FROM file"
+                params = ()
 
+            cursor = self._cursor(sql)
+            cursor.execute(sql, params)
             result = cursor.fetchone()
-            cursor.close()
+            self._release(cursor)
 
             if self.is_mysql:
                 return result[0]
@@ -185,11 +400,34 @@ class Storage:
 
     def get_conds(self, mime=None, puid=None, status=None, subpath=None,
                   ext=None, from_path=None, to_path=None, timestamp=None,
-                  reconvert=False, retry=False, finished=None, original=None):
+                  reconvert=False, retry=False, finished=None, original=None,
+                  ids=None, max_id=None, source_id=None, duplicate=None,
+                  size=None, claimable=False):
         """Build WHERE conditions and parameters"""
         conditions = []
         params = []
 
+        if size is not None:
+            conditions.append("size = %s" if self.is_mysql else "size = ?")
+            params.append(size)
+
+        if source_id is not None:
+            conditions.append("source_id = %s" if self.is_mysql else "source_id = ?")
+            params.append(source_id)
+
+        if duplicate is not None:
+            conditions.append("duplicate_of IS NOT NULL" if duplicate
+                              else "duplicate_of IS NULL")
+
+        if max_id is not None:
+            conditions.append("id <= %s" if self.is_mysql else "id <= ?")
+            params.append(max_id)
+
+        if ids is not None:
+            placeholders = ', '.join(['%s' if self.is_mysql else '?'] * len(ids))
+            conditions.append(f"id IN ({placeholders})")
+            params.extend(ids)
+
         if mime:
             conditions.append("mime = %s" if self.is_mysql else "mime = ?")
             params.append(mime)
@@ -219,12 +457,22 @@ class Storage:
             params.append(finished)
 
         if original is not None:
-            conditions.append("original_file = %s" if self.is_mysql else "original_file = ?")
-            params.append(original)
+            # Original files are the ones not converted from or unpacked
+            # from another file
+            conditions.append("source_id IS NULL" if original
+                              else "source_id IS NOT NULL")
 
         if reconvert:
             conditions.append("status IN ('converted', 'failed', 'timeout')")
 
+        if claimable:
+            # Files that `claim_rows` can take now
+            conditions.append("(status = 'new' OR (status = 'processing' AND "
+                              "lease_expires < %s))" if self.is_mysql else
+                              "(status = 'new' OR (status = 'processing' AND "
+                              "lease_expires < ?))")
+            params.append(int(time.time()))
+
         if retry:
             conditions.append("status = 'failed'")
 
@@ -233,11 +481,83 @@ class Storage:
 
         return " AND ".join(conditions), params
 
-    def get_rows(self, conds, params, limit=None, offset=None):
-        """Get rows matching conditions"""
+    def get_ids(self, conds, params):
+        """Get ids of rows matching conditions, in id order"""
         try:
-            cursor = self.connection.cursor()
+            sql = f"SELECT id FROM file WHERE {conds} ORDER BY id"
+            cursor = self._cursor(sql)
+            cursor.execute(sql, params)
+            ids = [row[0] for row in cursor.fetchall()]
+            self._release(cursor)
+
+            return ids
+
+        except Exception as e:
+            logging.error(f"Error getting ids: {e}")
+            return []
+
+    def get_pages(self, conds, params, size=1000, columns='*'):
+        """
+        Iterate over rows matching conditions, one page at a time
+
+        Pages are fetched with keyset pagination on id, so each query is
+        an index range scan, and rows that change status while the pages
+        are read are neither skipped nor repeated.
+
+        Yields:
+            tuple of column names and list of rows for each page
+        """
+        mark = '%s' if self.is_mysql else '?'
+        sql = (f"SELECT {columns} FROM file WHERE ({conds}) AND id > {mark} "
+               f"ORDER BY id LIMIT {int(size)}")
+        after_id = 0
+        while True:
+            cursor = self._cursor(sql)
+            cursor.execute(sql, list(params) + [after_id])
+            header = tuple(desc[0] for desc in cursor.description)
+            rows = [tuple(row) for row in cursor.fetchall()]
+            self._release(cursor)
+
+            yield header, rows
+
+            if len(rows) < size:
+                return
+            after_id = rows[-1][header.index('id')]
 
+    def iter_ids(self, conds, params, size=1000):
+        """Iterate over ids of rows matching conditions, in id order"""
+        for _, rows in self.get_pages(conds, params, size, columns='id'):
+            for row in rows:
+                yield row[0]
+
+    def get_duplicate_sizes(self, conds, params):
+        """Get file sizes shared by more than one original file"""
+        sql = (f"SELECT size FROM file WHERE ({conds}) AND source_id IS NULL "
+               "AND size > 0 GROUP BY size HAVING COUNT(*) > 1")
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        sizes = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        return sizes
+
+    def get_max_id(self):
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT MAX(id) FROM file")
+        max_id = cursor.fetchone()[0]
+        cursor.close()
+        return max_id or 0
+
+    def get_rows(self, conds, params, limit=None, offset=None):
+        """
+        Get rows matching conditions
+
+        Without limit and offset, a lazy table is returned, which reads the
+        rows page by page from the database while it is iterated.
+        """
+        if not (limit or offset):
+            return RowView(self, conds, params)
+
+        try:
             sql = f"SELECT * FROM file WHERE {conds}"
 
             if limit:
@@ -245,6 +565,7 @@ class Storage:
             if offset:
                 sql += f" OFFSET {offset}"
 
+            cursor = self._cursor(sql)
             cursor.execute(sql, params)
 
             if self.is_mysql:
@@ -255,7 +576,7 @@ class Storage:
             else:
                 result = [dict(row) for row in cursor.fetchall()]
 
-            cursor.close()
+            self._release(cursor)
 
             # Convert to petl table
             if result:
@@ -270,26 +591,69 @@ class Storage:
     def update_row(self, row_data):
         """Update a single row"""
         try:
-            cursor = self.connection.cursor()
+            cols = tuple(key for key in row_data if key in COLUMNS)
+            params = [row_data[col] for col in cols] + [row_data['id']]
+            sql = _update_sql(cols, '%s' if self.is_mysql else '?')
 
-            # Build UPDATE statement
-            set_clauses = []
-            params = []
+            cursor = self._cursor(sql)
+            cursor.execute(sql, params)
+            self._release(cursor)
 
-            for key, value in row_data.items():
-                if key != 'id':
-                    set_clauses.append(f"{key} = %s" if self.is_mysql else f"{key} = ?")
-                    params.append(value)
+        except Exception as e:
+            logging.error(f"Error updating row: {e}")
+            raise
 
-            params.append(row_data['id'])
+    def begin(self, immediate=False):
+        """
+        Start an explicit transaction on the autocommitted connection
 
-            sql = f"UPDATE file SET {', '.join(set_clauses)} WHERE id = %s" if self.is_mysql else f"UPDATE file SET {', '.join(set_clauses)} WHERE id = ?"
+        With immediate, an SQLite transaction takes the write lock at
+        once, so that rows read in it can't be changed by others before
+        it writes.
+        """
+        if self.is_mysql:
+            self.connection.start_transaction()
+        else:
+            self.connection.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
 
-            cursor.execute(sql, params)
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def update_rows(self, rows):
+        """
+        Write several rows in one transaction
+
+        Rows with an id are updated, rows without are inserted. Rows are
+        grouped by the columns they set, and each group is written with
+        a single executemany.
+        """
+        groups = {}
+        for row in rows:
+            cols = tuple(key for key in row if key in COLUMNS)
+            groups.setdefault((row.get('id') is None, cols), []).append(row)
+
+        mark = '%s' if self.is_mysql else '?'
+        try:
+            cursor = self.connection.cursor()
+            self.begin()
+            for (insert, cols), group in groups.items():
+                if insert:
+                    sql = _insert_sql(cols, mark)
+                    values = [[row[col] for col in cols] for row in group]
+                else:
+                    sql = _update_sql(cols, mark)
+                    values = [[row[col] for col in cols] + [row['id']]
+                              for row in group]
+                cursor.executemany(sql, values)
+            self.commit()
             cursor.close()
 
         except Exception as e:
-            logging.error(f"Error updating row: {e}")
+            self.rollback()
+            logging.error(f"Error updating rows: {e}")
             raise
 
     def update_status(self, conds, params, new_status):
@@ -305,8 +669,211 @@ class Storage:
             logging.error(f"Error updating status: {e}")
             raise
 
+    def claim_rows(self, conds, params, worker, size, lease):
+        """
+        Claim rows to convert, so that other workers leave them alone
+
+        Takes up to `size` rows with status 'new', or 'processing' with
+        an expired lease, and sets them to 'processing' with this worker
+        and a lease of `lease` seconds. On MySQL the rows are locked
+        with SKIP LOCKED, so workers claiming at the same time get
+        different rows without waiting for each other. On SQLite the
+        claim is made under the write lock.
+
+        Returns:
+            ids of the claimed rows
+        """
+        mark = '%s' if self.is_mysql else '?'
+        now = int(time.time())
+        sql = (f"SELECT id FROM file WHERE ({conds}) AND (status = 'new' OR "
+               f"(status = 'processing' AND lease_expires < {mark})) "
+               f"ORDER BY id LIMIT {int(size)}")
+        if self.is_mysql:
+            sql += " FOR UPDATE SKIP LOCKED"
+
+        cursor = self.connection.cursor()
+        self.begin(immediate=True)
+        try:
+            cursor.execute(sql, list(params) + [now])
+            ids = [row[0] for row in cursor.fetchall()]
+            if ids:
+                marks = ', '.join([mark] * len(ids))
+                cursor.execute(f"UPDATE file SET status = 'processing', "
+                               f"worker = {mark}, lease_expires = {mark} "
+                               f"WHERE id IN ({marks})",
+                               [worker, now + lease] + ids)
+            self.commit()
+        except Exception:
+            self.rollback()
+            raise
+        finally:
+            cursor.close()
+        return ids
+
+    def renew_leases(self, worker, lease):
+        """
+        Extend the lease on rows this worker is still converting
+
+        These are the rows it has claimed, and the rows it has journaled
+        a conversion step for, see recovery.py.
+        """
+        mark = '%s' if self.is_mysql else '?'
+        cursor = self.connection.cursor()
+        cursor.execute(f"UPDATE file SET lease_expires = {mark} "
+                       f"WHERE worker = {mark} AND "
+                       f"(status = 'processing' OR stage IS NOT NULL)",
+                       [int(time.time()) + lease, worker])
+        cursor.close()
+
+    def release_rows(self, worker):
+        """
+        Give back rows this worker claimed but didn't convert
+
+        Rows left in a conversion step lose their lease, so that the
+        next run recovers them at once.
+        """
+        mark = '%s' if self.is_mysql else '?'
+        cursor = self.connection.cursor()
+        cursor.execute(f"UPDATE file SET status = 'new', lease_expires = NULL "
+                       f"WHERE worker = {mark} AND status = 'processing'",
+                       [worker])
+        cursor.execute(f"UPDATE file SET lease_expires = NULL "
+                       f"WHERE worker = {mark} AND stage IS NOT NULL",
+                       [worker])
+        cursor.close()
+
+    def fill_ext(self, conds, params):
+        """Set `ext` on rows registered before the column was added"""
+        rows = []
+        for header, page in self.get_pages(f"({conds}) AND ext IS NULL", params,
+                                           columns='id, path'):
+            rows.extend({'id': id, 'ext': Path(path).suffix} for id, path in page)
+            if len(rows) >= 5000:
+                self.update_rows(rows)
+                rows = []
+        if rows:
+            self.update_rows(rows)
+
+    def get_rule_keys(self, conds, params):
+        """Get distinct combinations of the columns converter rules match on"""
+        cols = ', '.join(RULE_KEYS)
+        sql = f"SELECT DISTINCT {cols} FROM file WHERE {conds}"
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        keys = [tuple(row) for row in cursor.fetchall()]
+        cursor.close()
+        return keys
+
+    def get_rule_groups(self, conds, params):
+        """
+        Get number, size and conversion time of files for each distinct
+        combination of the columns converter rules match on
+
+        Returns:
+            tuples of the values in RULE_KEYS, followed by number of files,
+            their size, number of files with a duration, their size and
+            the sum of their durations
+        """
+        cols = ', '.join(RULE_KEYS)
+        sql = (f"SELECT {cols}, COUNT(*), SUM(size), COUNT(duration), "
+               f"SUM(CASE WHEN duration IS NOT NULL THEN size END), "
+               f"SUM(duration) FROM file WHERE {conds} GROUP BY {cols}")
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        groups = [tuple(row) for row in cursor.fetchall()]
+        cursor.close()
+        return groups
+
+    def set_rules(self, rules):
+        """
+        Store triage rules in a temporary table
+
+        Args:
+            rules: tuples of the values in RULE_KEYS, followed by the
+                   status and kept value to set
+        """
+        cols = [f'rule_{key}' for key in RULE_KEYS] + ['rule_status', 'rule_kept']
+        text = 'VARCHAR(255)' if self.is_mysql else 'TEXT'
+        cursor = self.connection.cursor()
+        cursor.execute("DROP TABLE IF EXISTS triage_rule")
+        cursor.execute(f"CREATE TEMPORARY TABLE triage_rule "
+                       f"({', '.join(f'{col} {text}' for col in cols[:-1])}, "
+                       f"rule_kept INTEGER)")
+        self.begin()
+        try:
+            marks = ', '.join(['%s' if self.is_mysql else '?'] * len(cols))
+            cursor.executemany(f"INSERT INTO triage_rule ({', '.join(cols)}) "
+                               f"VALUES ({marks})", rules)
+            self.commit()
+        except Exception:
+            self.rollback()
+            raise
+        cursor.close()
+
+    def _rule_join(self):
+        equal = '<=>' if self.is_mysql else 'IS'
+        return ' AND '.join(f"file.{key} {equal} triage_rule.rule_{key}"
+                            for key in RULE_KEYS)
+
+    def get_rule_pages(self, conds, params, size=1000):
+        """Iterate over id and path of rows matched by a triage rule, by page"""
+        mark = '%s' if self.is_mysql else '?'
+        sql = (f"SELECT file.id, file.path FROM file JOIN triage_rule "
+               f"ON {self._rule_join()} WHERE ({conds}) AND file.id > {mark} "
+               f"ORDER BY file.id LIMIT {int(size)}")
+        after_id = 0
+        while True:
+            cursor = self.connection.cursor()
+            cursor.execute(sql, list(params) + [after_id])
+            rows = [tuple(row) for row in cursor.fetchall()]
+            cursor.close()
+
+            yield rows
+
+            if len(rows) < size:
+                return
+            after_id = rows[-1][0]
+
+    def apply_rules(self, conds, params, status_ts):
+        """
+        Set status and kept from triage rules on matching rows, in one
+        statement
+
+        Returns:
+            number of rows updated
+        """
+        mark = '%s' if self.is_mysql else '?'
+        if self.is_mysql:
+            sql = (f"UPDATE file JOIN triage_rule ON {self._rule_join()} "
+                   f"SET file.status = triage_rule.rule_status, "
+                   f"file.kept = COALESCE(triage_rule.rule_kept, file.kept), "
+                   f"file.status_ts = {mark} WHERE {conds}")
+        else:
+            sql = (f"UPDATE file SET status = triage_rule.rule_status, "
+                   f"kept = COALESCE(triage_rule.rule_kept, file.kept), "
+                   f"status_ts = {mark} FROM triage_rule "
+                   f"WHERE {self._rule_join()} AND ({conds})")
+        cursor = self.connection.cursor()
+        self.begin()
+        try:
+            cursor.execute(sql, [status_ts] + list(params))
+            count = cursor.rowcount
+            cursor.execute("DROP TABLE triage_rule")
+            self.commit()
+        except Exception:
+            self.rollback()
+            raise
+        finally:
+            cursor.close()
+        return count
+
     def close(self):
         """Close database connection"""
+        if self.persistent:
+            # Kept open for the next use, see `close_connections`
+            self.connection = None
+            return
+
         if self.connection:
             try:
                 self.connection.close()
@@ -316,3 +883,157 @@ class Storage:
             finally:
                 self.connection = None
 
+
+
+class RowView(etl.Table):
+    """Lazy petl table over the rows of the file table matching conditions"""
+
+    def __init__(self, store, conds, params, page_size=1000):
+        self.store = store
+        self.conds = conds
+        self.params = params
+        self.page_size = page_size
+
+    def __iter__(self):
+        header = None
+        try:
+            for page_header, rows in self.store.get_pages(
+                self.conds, self.params, self.page_size
+            ):
+                if header is None:
+                    header = page_header
+                    yield header
+                yield from rows
+        except Exception as e:
+            logging.error(f"Error getting rows: {e}")
+            raise
+
+
+class RowBuffer:
+    """
+    Write-behind buffer for row updates
+
+    Rows are collected and written with `Storage.update_rows` when
+    `size` rows are waiting, and by a timer thread `interval` seconds
+    after the last write, so that rows don't wait on a worker busy with
+    a slow file. Remaining rows are written when the process exits, also
+    when a worker process is stopped by SIGINT or SIGTERM.
+
+    If a batch fails, its rows are written one at a time, so that one bad
+    row doesn't hold back the updates of the rest. Rows that fail are kept
+    for the next `retries` writes. After that, or when the process exits,
+    the file is set to status 'failed' so that it's picked up by --retry,
+    and the number of rows that couldn't be written is logged.
+    """
+
+    def __init__(self, db_path, size=500, interval=5, retries=3):
+        self.db_path = db_path
+        self.size = size
+        self.interval = interval
+        self.retries = retries
+        self._rows = []
+        # Failed writes of rows kept for retry, keyed by id of the row dict
+        self._attempts = {}
+        # Rows set to 'failed' or lost because they couldn't be written
+        self.failed = 0
+        self.lost = 0
+        self._last_flush = time.time()
+        # Threads converting in the same process share the buffer
+        self._lock = threading.RLock()
+        self._timer = None
+        # Pool workers don't run atexit handlers, but they do run
+        # multiprocessing finalizers on exit
+        mp_util.Finalize(self, self.close, exitpriority=10)
+        atexit.register(self.close)
+
+    def add(self, row):
+        row = {key: value for key, value in row.items()
+               if key == 'id' or key in COLUMNS}
+        with self._lock:
+            self._rows.append(row)
+            if self._timer is None:
+                self._start_timer()
+            if len(self._rows) >= self.size:
+                self.flush()
+
+    def _start_timer(self):
+        def run():
+            while True:
+                wait = self._last_flush + self.interval - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                else:
+                    try:
+                        self.flush()
+                    except Exception as e:
+                        logging.error(f"Error writing rows: {e}")
+
+        self._timer = threading.Thread(target=run, daemon=True)
+        self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._last_flush = time.time()
+            if not self._rows:
+                return
+            rows, self._rows = self._rows, []
+            try:
+                with Storage(self.db_path, persistent=True) as store:
+                    try:
+                        store.update_rows(rows)
+                        self._attempts.clear()
+                        return
+                    except Exception:
+                        pass
+                    for row in rows:
+                        try:
+                            store.update_rows([row])
+                            self._attempts.pop(id(row), None)
+                        except Exception as e:
+                            self._retry(row, e)
+            except Exception as e:
+                # No connection, so none of the rows were written
+                for row in rows:
+                    self._retry(row, e)
+
+    def _retry(self, row, error):
+        attempts = self._attempts.get(id(row), 0) + 1
+        if attempts <= self.retries:
+            self._attempts[id(row)] = attempts
+            self._rows.append(row)
+        else:
+            self._attempts.pop(id(row), None)
+            self._give_up(row, error)
+
+    def _give_up(self, row, error):
+        """Mark the file of a row that can't be written as failed"""
+        logging.error(f"Could not write update of row {row.get('id')}: "
+                      f"{error}")
+        if row.get('id'):
+            try:
+                with Storage(self.db_path, persistent=True) as store:
+                    store.update_rows([{
+                        'id': row['id'], 'status': 'failed',
+                        'error_message': f"Status update failed: {error}"
+                    }])
+                self.failed += 1
+                return
+            except Exception:
+                pass
+        self.lost += 1
+
+    def close(self):
+        """Write remaining rows, giving up on those that still fail"""
+        with self._lock:
+            self.flush()
+            rows, self._rows = self._rows, []
+            for row in rows:
+                self._attempts.pop(id(row), None)
+                self._give_up(row, "still failing when the process exited")
+            if self.failed or self.lost:
+                logging.error(
+                    f"{self.failed + self.lost} row updates could not be "
+                    f"written: {self.failed} set to status 'failed', "
+                    f"{self.lost} lost"
+                )
+                self.failed = self.lost = 0
@@ -0,0 +1,40 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from config import cfg  # noqa: E402
+from storage import Storage  # noqa: E402
+
+# Tests don't depend on Siegfried being installed, and turn it on where needed
+cfg['use_siegfried'] = False
+
+
+@pytest.fixture
+def db(tmp_path):
+    """Path to an empty SQLite database"""
+    path = str(tmp_path / 'convert.db')
+    with Storage(path):
+        pass
+    return path
+
+
+def add_rows(db, rows):
+    """Insert rows into the file table, returning their ids"""
+    with Storage(db) as store:
+        # One at a time, since update_rows groups rows by their columns
+        for row in rows:
+            store.update_rows([dict(row)])
+        cursor = store.connection.execute("SELECT id FROM file ORDER BY id")
+        return [row[0] for row in cursor.fetchall()]
+
+
+def get_rows(db, conds='1 = 1', params=()):
+    """Rows of the file table as dicts, ordered by id"""
+    with Storage(db) as store:
+        cursor = store.connection.execute(
+            f"SELECT * FROM file WHERE {conds} ORDER BY id", list(params)
+        )
+        return [dict(row) for row in cursor.fetchall()]
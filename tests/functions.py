@@ -0,0 +1,21 @@
+"""Converter functions for the tests of running functions"""
+import sys
+import time
+
+
+def exit_with(code):
+    print('converting')
+    return int(code)
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+def sleep(seconds):
+    time.sleep(float(seconds))
+
+
+def script_exit(code):
+    print('done', file=sys.stderr)
+    sys.exit(int(code))
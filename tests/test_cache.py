@@ -0,0 +1,115 @@
+import os
+import time
+import shutil
+import threading
+from pathlib import Path
+
+import cache as cache_module
+import file as file_module
+from cache import ConversionCache
+from config import cfg, converters, pwconv_path
+from file import File
+
+from conftest import add_rows, get_rows
+
+
+def test_cached_output_is_copied(tmp_path):
+    cache = ConversionCache(str(tmp_path / 'cache'), 1000)
+    key = cache.key('abc', 'convert <source> <dest>', '.pdf')
+    output = tmp_path / 'out.pdf'
+    output.write_bytes(b'converted')
+
+    assert not cache.get(key, str(tmp_path / 'a.pdf'))
+    cache.put(key, str(output))
+    assert cache.get(key, str(tmp_path / 'b.pdf'))
+    assert (tmp_path / 'b.pdf').read_bytes() == b'converted'
+    # A copy, so that changing the output doesn't change the cache
+    assert not os.path.samefile(tmp_path / 'b.pdf', cache._path(key))
+
+
+def test_key_depends_on_converter_and_extension():
+    converter = 'convert <source> <dest>'
+    key = ConversionCache.key('abc', converter, '.pdf')
+    assert key != ConversionCache.key('abd', converter, '.pdf')
+    assert key != ConversionCache.key('abc', 'other', '.pdf')
+    assert key != ConversionCache.key('abc', converter, '.png')
+    # The function and the command of the same converter give different
+    # output, so they don't share cached outputs
+    assert (ConversionCache.key('abc', 'bin.pdf2pdfa:pdf2pdfa', '.pdf')
+            != ConversionCache.key('abc', 'bin/pdf2pdfa.sh', '.pdf'))
+
+
+def test_file_is_cached_by_the_converter_that_ran(tmp_path, db, monkeypatch):
+    converter = {'command': 'python3 -m bin.text2utf8 <source> <dest>',
+                 'function': 'bin.text2utf8:text2utf8'}
+    monkeypatch.setitem(converters, 'text/x-test', converter)
+    monkeypatch.setitem(cfg, 'cache', {'enabled': True,
+                                       'dir': str(tmp_path / 'cache'),
+                                       'max_size_gb': 1})
+    monkeypatch.setattr(cache_module, '_local', threading.local())
+
+    def run_function(func, args, timeout):
+        Path(args[1]).write_text('by function')
+        return 0, '', ''
+
+    def run_shell_cmd(cmd, **kwargs):
+        (tmp_path / 'dest' / 'a.txt').write_text('by command')
+        return 0, '', ''
+
+    monkeypatch.setattr(file_module, 'run_function', run_function)
+    monkeypatch.setattr(file_module, 'run_shell_cmd', run_shell_cmd)
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'a.txt').write_text('hello')
+
+    def convert():
+        dest = tmp_path / 'dest'
+        if dest.exists():
+            shutil.rmtree(dest)
+        add_rows(db, [{'path': 'a.txt', 'mime': 'text/x-test', 'size': 5,
+                       'status': 'new', 'ext': '.txt'}])
+        text = File(get_rows(db)[-1], pwconv_path, False)
+        text.convert(str(source), str(dest), False, False, False, False, False)
+        return text, (dest / 'a.txt').read_text()
+
+    monkeypatch.setitem(cfg, 'in-process-converters', True)
+    text, output = convert()
+    assert (text.converter, text.cached, output) == (converter['function'], False,
+                                                     'by function')
+    text, output = convert()
+    assert (text.cached, output) == (True, 'by function')
+
+    # Turning the function off doesn't give the output of the function
+    monkeypatch.setitem(cfg, 'in-process-converters', False)
+    text, output = convert()
+    assert (text.converter, text.cached, output) == (converter['command'], False,
+                                                     'by command')
+
+
+def test_least_recently_used_outputs_are_evicted(tmp_path):
+    cache = ConversionCache(str(tmp_path / 'cache'), 25)
+    output = tmp_path / 'out'
+    output.write_bytes(b'x' * 10)
+    for key in ('a', 'b'):
+        cache.put(key, str(output))
+        time.sleep(0.01)
+    # Used, so 'b' is the least recently used
+    assert cache.get('a', str(tmp_path / 'copy'))
+    time.sleep(0.01)
+    cache.put('c', str(output))
+
+    assert cache.get('a', str(tmp_path / 'copy'))
+    assert not cache.get('b', str(tmp_path / 'copy'))
+    assert not cache._path('b').exists()
+    assert cache.get('c', str(tmp_path / 'copy'))
+
+
+def test_missing_object_is_dropped(tmp_path):
+    cache = ConversionCache(str(tmp_path / 'cache'), 1000)
+    output = tmp_path / 'out'
+    output.write_bytes(b'converted')
+    cache.put('a', str(output))
+    cache._path('a').unlink()
+
+    assert not cache.get('a', str(tmp_path / 'copy'))
+    assert cache._db.execute("SELECT COUNT(*) FROM entry").fetchone()[0] == 0
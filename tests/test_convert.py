@@ -0,0 +1,73 @@
+import threading
+import time
+
+from convert import iter_chunks, submit_chunks
+
+
+def test_iter_chunks_reads_lazily():
+    read = []
+
+    def ids():
+        for i in range(7):
+            read.append(i)
+            yield i
+
+    chunks = iter_chunks(ids(), 3)
+    assert next(chunks) == [0, 1, 2]
+    assert read == [0, 1, 2]
+    assert list(chunks) == [[3, 4, 5], [6]]
+
+
+class FakePool:
+    """Pool running each task in a thread after a short delay"""
+
+    def __init__(self):
+        self.queued = 0
+        self.most_queued = 0
+        self.done = []
+        self._lock = threading.Lock()
+
+    def apply_async(self, task, args, callback, error_callback):
+        with self._lock:
+            self.queued += 1
+            self.most_queued = max(self.most_queued, self.queued)
+
+        def run():
+            time.sleep(0.01)
+            with self._lock:
+                self.queued -= 1
+            try:
+                result = task(*args)
+            except Exception as e:
+                error_callback(e)
+            else:
+                callback(result)
+            self.done.append(args[0])
+
+        threading.Thread(target=run).start()
+
+
+def test_submit_chunks_keeps_window_of_chunks_queued():
+    pool = FakePool()
+    chunks = iter_chunks(range(40), 2)
+    submit_chunks(pool, lambda chunk: None, chunks, window=3)
+
+    deadline = time.time() + 5
+    while len(pool.done) < 20 and time.time() < deadline:
+        time.sleep(0.01)
+    assert pool.most_queued <= 3
+    assert sorted(i for chunk in pool.done for i in chunk) == list(range(40))
+
+
+def test_submit_chunks_goes_on_after_failed_chunk():
+    pool = FakePool()
+
+    def task(chunk):
+        if 0 in chunk:
+            raise ValueError('bad chunk')
+
+    submit_chunks(pool, task, iter_chunks(range(10), 2), window=1)
+    deadline = time.time() + 5
+    while len(pool.done) < 5 and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(pool.done) == 5
@@ -0,0 +1,50 @@
+import threading
+
+import pytest
+
+from config import cfg, converters
+from util.daemon import ConverterDaemon, daemon_functions, get_settings, run_in_daemon
+
+
+@pytest.fixture
+def daemon(tmp_path, monkeypatch):
+    monkeypatch.setitem(converters, 'text/x-test', {
+        'function': 'bin.text2utf8:text2utf8',
+        'daemon': True,
+    })
+    monkeypatch.setitem(cfg, 'converter-daemon', {
+        'socket': str(tmp_path / 'daemon.sock'),
+        'workers': 1,
+    })
+    server = ConverterDaemon(get_settings())
+    threading.Thread(target=server.serve, daemon=True).start()
+    for _ in range(100):
+        if (tmp_path / 'daemon.sock').exists():
+            break
+        threading.Event().wait(0.05)
+    return server
+
+
+def test_daemon_functions_include_overrides(monkeypatch):
+    monkeypatch.setitem(converters, 'text/x-test', {
+        'function': 'bin.a:a',
+        'puid': {'x-fmt/1': {'daemon': True}, 'x-fmt/2': {'function': 'bin.b:b'}},
+    })
+    assert 'bin.a:a' in daemon_functions()
+    assert 'bin.b:b' not in daemon_functions()
+
+
+def test_daemon_runs_converter(daemon, tmp_path):
+    source = tmp_path / 'a.txt'
+    source.write_text('hello\n')
+    returncode, _, err = run_in_daemon('bin.text2utf8:text2utf8',
+                                       [str(source), str(tmp_path / 'b.txt')])
+    assert returncode == 0, err
+    assert (tmp_path / 'b.txt').read_text() == 'hello\n'
+
+
+def test_daemon_refuses_other_functions(daemon, tmp_path):
+    returncode, _, err = run_in_daemon('shutil:rmtree', [str(tmp_path)])
+    assert returncode == 1
+    assert 'not a daemon converter' in err
+    assert tmp_path.exists()
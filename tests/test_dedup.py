@@ -0,0 +1,85 @@
+import os
+
+import dedup
+from dedup import PARTIAL_SIZE, find_duplicates, link_duplicates
+from storage import RowBuffer, Storage
+
+from conftest import add_rows, get_rows
+
+
+def write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return {'path': path.name, 'size': len(content), 'status': 'new'}
+
+
+def test_find_duplicates_by_size_partial_and_full_hash(db, tmp_path, monkeypatch):
+    source = tmp_path / 'source'
+    big = os.urandom(PARTIAL_SIZE + 100)
+    rows = [
+        write(source / 'a.bin', big),
+        write(source / 'b.bin', big),
+        # Same size and start, different end
+        write(source / 'c.bin', big[:-1] + bytes([big[-1] ^ 1])),
+        write(source / 'd.txt', b'small'),
+        write(source / 'e.txt', b'small'),
+        write(source / 'f.txt', b'unique size'),
+    ]
+    add_rows(db, rows)
+
+    hashed = []
+    hash_file = dedup.hash_file
+
+    def record(path, limit=None):
+        hashed.append((os.path.basename(path), limit))
+        return hash_file(path, limit)
+
+    monkeypatch.setattr(dedup, 'hash_file', record)
+
+    with Storage(db) as store:
+        conds, params = store.get_conds(status='new')
+        assert find_duplicates(store, str(source), conds, params) == 2
+
+    by_path = {row['path']: row for row in get_rows(db)}
+    assert by_path['b.bin']['duplicate_of'] == by_path['a.bin']['id']
+    assert by_path['e.txt']['duplicate_of'] == by_path['d.txt']['id']
+    assert by_path['c.bin']['duplicate_of'] is None
+    assert by_path['a.bin']['checksum'] == hash_file(str(source / 'a.bin'))
+    # Only files with the same size are read, and only those with the
+    # same start in full
+    assert 'f.txt' not in {name for name, _ in hashed}
+    assert {name for name, limit in hashed if limit is None} == {
+        'a.bin', 'b.bin', 'c.bin'
+    }
+
+
+def test_link_duplicates(db, tmp_path):
+    source = tmp_path / 'source'
+    dest = tmp_path / 'dest'
+    for name in ('x.doc', 'y.doc', 'z.doc', 'w.doc'):
+        write(source / name, b'same')
+    write(dest / 'x.pdf', b'converted')
+    add_rows(db, [
+        {'path': 'x.doc', 'status': 'converted', 'mime': 'application/msword'},
+        {'path': 'y.doc', 'status': 'new', 'duplicate_of': 1},
+        {'path': 'x.pdf', 'status': 'accepted', 'source_id': 1,
+         'mime': 'application/pdf'},
+        # Duplicate of a file that isn't converted
+        {'path': 'z.doc', 'status': 'new'},
+        {'path': 'w.doc', 'status': 'new', 'duplicate_of': 4},
+    ])
+
+    buffer = RowBuffer(db, interval=60)
+    with Storage(db) as store:
+        unlinked = link_duplicates(store, buffer, str(source), str(dest),
+                                   "source_id IS NULL", [])
+
+    assert unlinked == [5]
+    assert (dest / 'y.pdf').read_bytes() == b'converted'
+    rows = {row['path']: row for row in get_rows(db)}
+    assert rows['y.doc']['status'] == 'converted'
+    assert rows['y.doc']['mime'] == 'application/msword'
+    assert rows['y.pdf']['source_id'] == rows['y.doc']['id']
+    assert rows['y.pdf']['status'] == 'accepted'
+    assert rows['w.doc']['duplicate_of'] is None
+    assert rows['w.doc']['status'] == 'new'
@@ -0,0 +1,66 @@
+import os
+import time
+import json
+import logging
+import multiprocessing
+
+from util.events import EventLog, attach, emit
+
+
+def convert_files(ids):
+    for id in ids:
+        emit('converted', id=id, path=f'{id}.txt', duration=0.5)
+    emit('skipped', level=logging.DEBUG, id=ids[0])
+    return os.getpid()
+
+
+def read_events(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_events_of_workers_are_written_by_listener(tmp_path):
+    log = EventLog(str(tmp_path / 'log' / 'events.jsonl'), batch_size=10)
+    log.start()
+    emit('run started', files=40)
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(3, initializer=attach, initargs=(log.queue,)) as pool:
+        pids = set(pool.map(convert_files,
+                            [list(range(i, i + 5)) for i in range(0, 40, 5)],
+                            chunksize=1))
+    log.stop()
+
+    events = read_events(log.path)
+    assert events[0]['event'] == 'run started'
+    assert events[0]['pid'] == os.getpid()
+    converted = [event for event in events if event['event'] == 'converted']
+    assert sorted(event['id'] for event in converted) == list(range(40))
+    assert {event['pid'] for event in converted} == pids
+    assert converted[0]['level'] == 'info'
+    assert converted[0]['path'] == f"{converted[0]['id']}.txt"
+    # Below event_level
+    assert not any(event['event'] == 'skipped' for event in events)
+
+
+def test_errors_are_written_at_once_and_printed(tmp_path, capsys):
+    log = EventLog(str(tmp_path / 'events.jsonl'), batch_size=100)
+    log.start()
+    try:
+        emit('converted', id=1)
+        emit('conversion failed', level=logging.ERROR, id=2, path='b.doc',
+             error='timeout')
+        # The listener writes the batch when it gets the error
+        for _ in range(100):
+            if os.path.getsize(log.path):
+                break
+            time.sleep(0.05)
+        assert [event['id'] for event in read_events(log.path)] == [1, 2]
+    finally:
+        log.stop()
+    assert 'conversion failed: b.doc (timeout)' in capsys.readouterr().out
+
+
+def test_nothing_is_sent_without_event_log(tmp_path):
+    attach(None)
+    # Doesn't fail or block
+    emit('converted', id=1)
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+import file as file_module
+from config import converters, pwconv_path
+from file import File
+
+from conftest import add_rows, get_rows
+
+
+@pytest.fixture
+def commands(monkeypatch):
+    """Commands run by File.convert, answered by `results`"""
+    run = []
+    results = {}
+
+    def run_shell_cmd(cmd, cwd=None, shell=False, timeout=None):
+        run.append(cmd)
+        returncode = results.get('returncode', 0)
+        if not returncode:
+            dest = results['dest']
+            with open(dest, 'wb') as f:
+                f.write(b'%PDF-1.7 converted')
+        return returncode, '', ''
+
+    monkeypatch.setattr(file_module, 'run_shell_cmd', run_shell_cmd)
+    return run, results
+
+
+def convert_pdf(tmp_path, db):
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'a.pdf').write_bytes(b'%PDF-1.4 original')
+    add_rows(db, [{'path': 'a.pdf', 'mime': 'application/pdf',
+                   'puid': 'fmt/18', 'version': '1.4', 'size': 17,
+                   'status': 'new', 'ext': '.pdf', 'kept': True}])
+    pdf = File(get_rows(db)[0], pwconv_path, False)
+    pdf.convert(str(source), str(tmp_path / 'dest'), False, False, False,
+                False, False)
+    return pdf
+
+
+def test_pdf_is_validated_before_conversion(tmp_path, db, commands):
+    run, results = commands
+    results['dest'] = tmp_path / 'dest' / 'a.pdf'
+    pdf = convert_pdf(tmp_path, db)
+    assert pdf.status == 'converted'
+    assert pdf.converter == converters['application/pdf']['command']
+    assert run[0].startswith('pdfcpu validate ')
+    assert ' && bin/pdf2pdfa.sh ' in run[0]
+
+
+def test_invalid_pdf_fails(tmp_path, db, commands):
+    run, results = commands
+    # pdfcpu validate fails
+    results['returncode'] = 1
+    pdf = convert_pdf(tmp_path, db)
+    assert pdf.status == 'failed'
+    assert os.path.exists(tmp_path / 'source' / 'a.pdf')
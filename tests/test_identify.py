@@ -0,0 +1,152 @@
+import os
+import sys
+from collections import OrderedDict
+
+import pytest
+
+import util.identify as identify
+from config import cfg
+from util.identify import (HEADER, SiegfriedServer, get_sf_server, get_shards,
+                           identify_file, iter_filelist, list_files,
+                           sniff_type)
+
+
+def test_failed_sf_server_is_not_started_again(tmp_path, monkeypatch):
+    starts = []
+
+    def start(self, timeout=30):
+        starts.append(self)
+        return False
+
+    monkeypatch.setattr(identify, '_server', None)
+    monkeypatch.setattr(identify, '_server_failed', False)
+    monkeypatch.setattr(SiegfriedServer, 'start', start)
+    # No sf on the path either, so files are left to magic
+    monkeypatch.setenv('PATH', str(tmp_path))
+
+    assert get_sf_server() is None
+    assert get_sf_server() is None
+    (tmp_path / 'a.txt').write_text('hello')
+    assert identify_file(str(tmp_path / 'a.txt')) is None
+    assert len(starts) == 1
+
+
+FAKE_SF = '''#!{python}
+# Stand-in for sf -csv: reports each file as text/plain
+import csv, os, sys
+
+args = sys.argv[1:]
+recursive = '-nr' not in args
+top = args[-1]
+if os.path.basename(top) == 'broken':
+    sys.exit('cannot read directory')
+out = csv.writer(sys.stdout)
+out.writerow(['filename', 'filesize', 'modified', 'errors', 'id', 'format',
+              'version', 'mime', 'class'])
+for root, dirs, files in os.walk(top):
+    for name in sorted(files):
+        path = os.path.join(root, name)
+        out.writerow([path, os.path.getsize(path), '2024-01-02T03:04:05Z', '',
+                      'x-fmt/111', 'Plain Text File', '', 'text/plain', 'Text'])
+    if not recursive:
+        break
+'''
+
+
+@pytest.fixture
+def fake_sf(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    sf = bin_dir / 'sf'
+    sf.write_text(FAKE_SF.format(python=sys.executable))
+    sf.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setitem(cfg, 'use_siegfried', True)
+
+
+@pytest.fixture
+def tree(tmp_path):
+    source = tmp_path / 'source'
+    for path in ('a.txt', 'x/b.txt', 'x/y/c.txt', 'x/y/z/d.txt', 'w/e.txt',
+                 'broken/f.txt'):
+        (source / path).parent.mkdir(parents=True, exist_ok=True)
+        (source / path).write_text(path)
+    return source
+
+
+def test_shards_cover_tree_once(tree):
+    shards = get_shards(str(tree), 6)
+    assert len(shards) >= 6
+    files = []
+    for path, recursive in shards:
+        files.extend(row[0] for row in list_files(path, str(tree), recursive))
+    assert sorted(files) == ['a.txt', 'broken/f.txt', 'w/e.txt', 'x/b.txt',
+                             'x/y/c.txt', 'x/y/z/d.txt']
+
+
+def test_filelist_identifies_shards_in_parallel(tree, fake_sf):
+    progress = []
+    rows = list(iter_filelist(str(tree), workers=3,
+                              progress=lambda *args: progress.append(args)))
+    by_path = {row[0]: row for row in rows}
+    assert sorted(by_path) == ['a.txt', 'broken/f.txt', 'w/e.txt', 'x/b.txt',
+                               'x/y/c.txt', 'x/y/z/d.txt']
+    assert by_path['x/y/z/d.txt'][HEADER.index('mime')] == 'text/plain'
+    # Files of a shard sf failed on are listed without identification
+    assert by_path['broken/f.txt'][HEADER.index('mime')] is None
+    files, finished, total = progress[-1]
+    assert (files, finished) == (6, total)
+
+
+def test_filelist_without_siegfried_lists_files(tree):
+    rows = list(iter_filelist(str(tree)))
+    assert len(rows) == 6
+    assert all(row[HEADER.index('mime')] is None for row in rows)
+    assert {row[1] for row in rows if row[0] == 'a.txt'} == {5}
+
+
+def test_identify_result_is_cached_until_file_changes(tmp_path, monkeypatch):
+    calls = []
+
+    class Server:
+        def identify(self, path):
+            calls.append(path)
+            return {'files': [{'matches': [{'mime': 'text/plain'}]}]}
+
+    monkeypatch.setattr(identify, 'get_sf_server', lambda: Server())
+    monkeypatch.setattr(identify, '_results', OrderedDict())
+    path = tmp_path / 'a.txt'
+    path.write_text('hello')
+
+    assert identify_file(str(path))['matches'][0]['mime'] == 'text/plain'
+    identify_file(str(path))
+    assert len(calls) == 1
+
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    identify_file(str(path))
+    assert len(calls) == 2
+
+    path.write_text('hello, world')
+    identify_file(str(path))
+    assert len(calls) == 3
+
+
+def test_listing_includes_symlinked_files(tree):
+    os.symlink(tree / 'a.txt', tree / 'x' / 'link.txt')
+    os.symlink(tree / 'missing.txt', tree / 'x' / 'broken.txt')
+    rows = {row[0]: row for row in iter_filelist(str(tree))}
+    assert rows['x/link.txt'][1] == len('a.txt')
+    assert rows['x/broken.txt'][3].startswith('Error')
+
+
+def test_symlinked_files_are_identified_as_file_linked_to(tmp_path):
+    (tmp_path / 'a.txt').write_text('hello\n')
+    (tmp_path / 'empty.txt').write_text('')
+    os.symlink(tmp_path / 'a.txt', tmp_path / 'link.txt')
+    os.symlink(tmp_path / 'empty.txt', tmp_path / 'empty_link.txt')
+    os.symlink(tmp_path / 'missing.txt', tmp_path / 'broken.txt')
+    assert sniff_type(str(tmp_path / 'link.txt'))[0] == 'text/plain'
+    assert sniff_type(str(tmp_path / 'empty_link.txt'))[0] == 'inode/x-empty'
+    with pytest.raises(OSError):
+        sniff_type(str(tmp_path / 'broken.txt'))
@@ -0,0 +1,80 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lease import Lease
+from storage import Storage
+
+from conftest import add_rows, get_rows
+
+
+def test_claims_are_disjoint(db):
+    add_rows(db, [{'path': f'{i}.txt', 'status': 'new'} for i in range(50)])
+
+    def claim(worker):
+        ids = []
+        with Storage(db) as store:
+            while batch := store.claim_rows('1=1', [], worker, 7, 300):
+                ids.extend(batch)
+        return ids
+
+    with ThreadPoolExecutor(4) as executor:
+        claimed = list(executor.map(claim, ['w1', 'w2', 'w3', 'w4']))
+
+    ids = [id for batch in claimed for id in batch]
+    assert sorted(ids) == list(range(1, 51))
+    for worker, batch in zip(['w1', 'w2', 'w3', 'w4'], claimed):
+        assert {row['worker'] for row in get_rows(db) if row['id'] in batch} <= {worker}
+    assert {row['status'] for row in get_rows(db)} == {'processing'}
+
+
+def test_expired_lease_is_claimed_again(db):
+    now = int(time.time())
+    add_rows(db, [
+        {'path': 'expired.txt', 'status': 'processing', 'worker': 'dead:1',
+         'lease_expires': now - 1},
+        {'path': 'live.txt', 'status': 'processing', 'worker': 'live:1',
+         'lease_expires': now + 300},
+        {'path': 'done.txt', 'status': 'converted', 'worker': 'dead:1',
+         'lease_expires': now - 1},
+    ])
+    with Storage(db) as store:
+        assert store.claim_rows('1=1', [], 'w1', 10, 300) == [1]
+        conds, params = store.get_conds(claimable=True)
+        assert store.get_row_count(conds, params) == 0
+
+
+def test_renew_and_release(db):
+    now = int(time.time())
+    add_rows(db, [
+        {'path': 'a.txt', 'status': 'processing', 'worker': 'w1',
+         'lease_expires': now + 10},
+        # Journaled by a run without --worker
+        {'path': 'b.txt', 'status': 'new', 'stage': 'convert', 'worker': 'w1',
+         'lease_expires': now + 10},
+        {'path': 'c.txt', 'status': 'converted', 'worker': 'w1',
+         'lease_expires': now + 10},
+        {'path': 'd.txt', 'status': 'processing', 'worker': 'w2',
+         'lease_expires': now + 10},
+    ])
+    with Storage(db) as store:
+        store.renew_leases('w1', 300)
+    expires = [row['lease_expires'] for row in get_rows(db)]
+    assert expires[0] >= now + 300 and expires[1] >= now + 300
+    assert expires[2:] == [now + 10, now + 10]
+
+    with Storage(db) as store:
+        store.release_rows('w1')
+    rows = get_rows(db)
+    assert [row['status'] for row in rows] == [
+        'new', 'new', 'converted', 'processing'
+    ]
+    assert [row['lease_expires'] for row in rows] == [None, None, now + 10, now + 10]
+
+
+def test_lease_claims_in_batches(db):
+    add_rows(db, [{'path': f'{i}.txt', 'status': 'new'} for i in range(5)])
+    lease = Lease(db, seconds=300, batch_size=2)
+    assert list(lease.iter_ids('1=1', [])) == [1, 2, 3, 4, 5]
+    assert lease.claimed == 5
+    lease.stop()
+    assert {row['status'] for row in get_rows(db)} == {'new'}
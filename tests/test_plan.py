@@ -0,0 +1,33 @@
+from config import converters
+from plan import estimate, get_groups
+from storage import Storage
+
+from conftest import add_rows
+
+
+def test_files_are_grouped_by_converter(db):
+    add_rows(db, [
+        {'path': 'a.doc', 'mime': 'application/msword', 'ext': '.doc',
+         'size': 100, 'status': 'new'},
+        # Registered before the ext column was added
+        {'path': 'b.doc', 'mime': 'application/msword', 'size': 300,
+         'status': 'new'},
+        {'path': 'c', 'mime': 'text/plain', 'ext': '', 'size': 5,
+         'status': 'new'},
+        {'path': 'd.doc', 'mime': 'application/msword', 'ext': '.doc',
+         'size': 200, 'status': 'converted', 'duration': 4.0},
+    ])
+    with Storage(db) as store:
+        conds, params = store.get_conds(status='new')
+        groups = get_groups(store, conds, params)
+        history = get_groups(store, "duration IS NOT NULL", [])
+
+    command = converters['application/msword']['command']
+    assert groups[command]['count'] == 2
+    assert groups[command]['size'] == 400
+    assert groups['(rename)']['count'] == 1
+    assert set(groups) == {command, '(rename)'}
+
+    # Estimated from the time per byte of earlier conversions
+    assert estimate(groups[command], history[command]) == 8.0
+    assert estimate(groups['(rename)'], history.get('(rename)')) is None
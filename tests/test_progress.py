@@ -0,0 +1,53 @@
+import threading
+import multiprocessing
+
+import pytest
+
+from util.progress import Progress, get_progress, set_progress
+
+
+def count_files(n):
+    progress = get_progress()
+    for _ in range(n):
+        progress.add('done')
+        progress.add('converted')
+    progress.add('not a counter')
+    return n
+
+
+@pytest.mark.parametrize('processes', [4, 1])
+def test_counts_of_workers_are_summed(processes):
+    # With fewer rows than workers, the extra workers share the last row
+    progress = Progress(4000, processes=processes)
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(4, initializer=set_progress, initargs=(progress, True)) as pool:
+        assert sum(pool.map(count_files, [500] * 8, chunksize=1)) == 4000
+    progress.add('failed', 3)
+
+    assert progress.get('done') == 4000
+    assert progress.get('converted') == 4000
+    assert progress.get('failed') == 3
+    assert progress.render().startswith('100% | 4000/4000 files')
+    assert 'converted 4000, failed 3' in progress.render()
+
+
+def test_threads_share_row_under_lock():
+    progress = Progress(0, threaded=True)
+    threads = [threading.Thread(target=lambda: [progress.add('done')
+                                                for _ in range(20000)])
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert progress.get('done') == 80000
+
+
+def test_rows_are_claimed_again_by_new_pool():
+    progress = Progress(0, processes=2)
+    progress.claim_row()
+    progress.claim_row()
+    assert not progress._shared
+    progress.release_rows()
+    progress.claim_row()
+    assert progress._offset == len(progress._counts) // progress._rows
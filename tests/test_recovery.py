@@ -0,0 +1,144 @@
+import os
+import time
+import socket
+import subprocess
+
+import pytest
+
+import recovery
+from lease import is_expired
+from recovery import recover, recover_row
+from storage import Storage
+
+from conftest import add_rows, get_rows
+
+
+@pytest.fixture
+def dirs(tmp_path, monkeypatch):
+    source = tmp_path / 'source'
+    dest = tmp_path / 'dest'
+    temp = tmp_path / 'temp'
+    for path in (source, dest, temp):
+        path.mkdir()
+    monkeypatch.setattr(recovery, 'TEMP_DIR', str(temp))
+    return source, dest, temp
+
+
+def test_interrupted_conversion_is_rolled_back(dirs):
+    source, dest, _ = dirs
+    (source / 'a.doc').write_text('original')
+    (dest / 'a.pdf').write_text('partly written')
+    row = {'id': 1, 'path': 'a.doc', 'source_id': None, 'stage': 'convert',
+           'target_path': 'a.pdf'}
+
+    assert recover_row(row, str(source), str(dest)) == 'convert'
+    assert not (dest / 'a.pdf').exists()
+    assert (source / 'a.doc').read_text() == 'original'
+
+
+def test_source_moved_to_temp_is_moved_back(dirs):
+    source, dest, temp = dirs
+    # Converted to its own path, with the original moved away first
+    (temp / 'a.txt').write_text('original')
+    (source / 'a.txt').write_text('partly written')
+    row = {'id': 1, 'path': 'a.txt', 'source_id': None, 'stage': 'convert',
+           'target_path': 'a.txt'}
+
+    recover_row(row, str(source), str(source))
+    assert (source / 'a.txt').read_text() == 'original'
+    assert not (temp / 'a.txt').exists()
+
+
+def test_source_not_yet_moved_is_kept(dirs):
+    source, _, _ = dirs
+    (source / 'a.txt').write_text('original')
+    row = {'id': 1, 'path': 'a.txt', 'source_id': None, 'stage': 'convert',
+           'target_path': 'a.txt'}
+
+    recover_row(row, str(source), str(source))
+    assert (source / 'a.txt').read_text() == 'original'
+
+
+def test_finished_conversion_is_kept(dirs):
+    source, dest, _ = dirs
+    (source / 'a.doc').write_text('original')
+    (dest / 'a.pdf').write_text('converted')
+    row = {'id': 1, 'path': 'a.doc', 'source_id': None, 'stage': 'converted',
+           'target_path': 'a.pdf'}
+
+    assert recover_row(row, str(source), str(dest)) == 'converted'
+    assert (dest / 'a.pdf').read_text() == 'converted'
+
+
+def test_recover_leaves_leased_and_other_files(db, dirs):
+    source, dest, _ = dirs
+    for name in ('a', 'b', 'c'):
+        (dest / f'{name}.pdf').write_text('partly written')
+    now = int(time.time())
+    add_rows(db, [
+        {'path': 'a.doc', 'status': 'new', 'stage': 'convert',
+         'target_path': 'a.pdf', 'worker': 'host:1', 'lease_expires': now - 10},
+        # Being converted by a live run
+        {'path': 'b.doc', 'status': 'new', 'stage': 'convert',
+         'target_path': 'b.pdf', 'worker': 'host:2', 'lease_expires': now + 300},
+        # Outside the files of this run
+        {'path': 'x/c.doc', 'status': 'new', 'stage': 'convert',
+         'target_path': 'c.pdf'},
+        {'path': 'd.doc', 'status': 'converted'},
+    ])
+
+    with Storage(db) as store:
+        conds, params = store.get_conds(to_path='x')
+        assert recover(store, str(source), str(dest), conds, params) == 1
+
+    assert [row['stage'] for row in get_rows(db)] == [
+        None, 'convert', 'convert', None
+    ]
+    assert not (dest / 'a.pdf').exists()
+    assert (dest / 'b.pdf').exists()
+    assert (dest / 'c.pdf').exists()
+
+
+def dead_pid():
+    proc = subprocess.Popen(['true'])
+    proc.wait()
+    return proc.pid
+
+
+def test_lease_of_dead_process_on_this_host_is_expired():
+    later = int(time.time()) + 300
+    host = socket.gethostname()
+    assert is_expired(f'{host}:{dead_pid()}', later)
+    assert not is_expired(f'{host}:{os.getpid()}', later)
+    # The process can't be checked on another host
+    assert not is_expired(f'other-{host}:{dead_pid()}', later)
+    assert is_expired(f'other-{host}:1', int(time.time()) - 1)
+    assert is_expired(None, None)
+
+
+def test_files_of_crashed_run_are_recovered_at_once(db, dirs):
+    source, dest, _ = dirs
+    for name in ('a', 'b', 'c'):
+        (dest / f'{name}.pdf').write_text('partly written')
+    later = int(time.time()) + 300
+    host = socket.gethostname()
+    add_rows(db, [
+        # Lease still running, but the run was killed
+        {'path': 'a.doc', 'status': 'new', 'stage': 'convert',
+         'target_path': 'a.pdf', 'worker': f'{host}:{dead_pid()}',
+         'lease_expires': later},
+        {'path': 'b.doc', 'status': 'new', 'stage': 'convert',
+         'target_path': 'b.pdf', 'worker': f'{host}:{os.getpid()}',
+         'lease_expires': later},
+        {'path': 'c.doc', 'status': 'new', 'stage': 'convert',
+         'target_path': 'c.pdf', 'worker': f'other-{host}:{dead_pid()}',
+         'lease_expires': later},
+    ])
+
+    with Storage(db) as store:
+        assert recover(store, str(source), str(dest)) == 1
+
+    assert [row['stage'] for row in get_rows(db)] == [None, 'convert', 'convert']
+    assert not (dest / 'a.pdf').exists()
+    assert (dest / 'b.pdf').exists()
+    assert (dest / 'c.pdf').exists()
@@ -0,0 +1,37 @@
+import os
+
+from convert import rescan_source, write_filelist_to_storage
+from storage import Storage
+from util.identify import FileList
+
+from conftest import get_rows
+
+
+def test_rescan_registers_new_changed_and_missing_files(db, tmp_path):
+    source = tmp_path / 'source'
+    source.mkdir()
+    for name in ('same.txt', 'changed.txt', 'touched.txt', 'removed.txt'):
+        (source / name).write_text(name)
+    with Storage(db) as store:
+        write_filelist_to_storage(FileList(str(source)), store, progress=False)
+        store.update_status('1=1', [], 'converted')
+
+    (source / 'new.txt').write_text('new')
+    (source / 'changed.txt').write_text('changed, with another size')
+    stat = (source / 'touched.txt').stat()
+    os.utime(source / 'touched.txt', (stat.st_atime, stat.st_mtime + 10))
+    (source / 'removed.txt').unlink()
+
+    with Storage(db) as store:
+        rescan_source(str(source), store, mark_missing=True)
+
+    rows = {row['path']: row for row in get_rows(db)}
+    assert {path: row['status'] for path, row in rows.items()} == {
+        'same.txt': 'converted',
+        'changed.txt': 'new',
+        'touched.txt': 'new',
+        'removed.txt': 'deleted',
+        'new.txt': 'new',
+    }
+    assert rows['changed.txt']['size'] == len('changed, with another size')
+    assert rows['touched.txt']['modified'] == int(stat.st_mtime + 10)
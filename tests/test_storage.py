@@ -0,0 +1,162 @@
+import re
+import time
+import threading
+from pathlib import Path
+
+import petl as etl
+import pytest
+
+from storage import STATUSES, RowBuffer, Storage
+
+from conftest import add_rows, get_rows
+
+
+def test_row_buffer_writes_when_full(db):
+    ids = add_rows(db, [{'path': f'{i}.txt', 'status': 'new'} for i in range(3)])
+    buffer = RowBuffer(db, size=3, interval=60)
+    for id in ids[:2]:
+        buffer.add({'id': id, 'status': 'converted'})
+    assert [row['status'] for row in get_rows(db)] == ['new'] * 3
+
+    buffer.add({'id': ids[2], 'status': 'failed'})
+    assert [row['status'] for row in get_rows(db)] == [
+        'converted', 'converted', 'failed'
+    ]
+
+
+def test_row_buffer_retries_failing_row(db):
+    ids = add_rows(db, [{'path': f'{i}.txt', 'status': 'new'} for i in range(2)])
+    buffer = RowBuffer(db, size=100, interval=60, retries=2)
+    buffer.add({'id': ids[0], 'status': 'converted'})
+    # Inserted without the required path, so the batch fails
+    bad = {'status': 'new'}
+    buffer.add(bad)
+    buffer.add({'id': ids[1], 'status': 'accepted'})
+    buffer.flush()
+
+    # The other rows are written, and the failing row is kept for retry
+    assert [row['status'] for row in get_rows(db)] == ['converted', 'accepted']
+    assert buffer._rows == [bad]
+
+    buffer.add({'id': ids[0], 'status': 'failed'})
+    buffer.flush()
+    assert get_rows(db)[0]['status'] == 'failed'
+    assert buffer._rows == [bad]
+
+    # Given up after the last retry
+    buffer.flush()
+    assert buffer._rows == []
+    assert buffer.lost == 1
+
+    # Reported once when the buffer is closed
+    buffer.close()
+    assert buffer.lost == 0
+
+
+def test_row_buffer_marks_unwritable_row_failed(db):
+    ids = add_rows(db, [{'path': 'a.txt', 'status': 'new'}])
+    buffer = RowBuffer(db, size=100, interval=60, retries=5)
+    # Not null constraint fails for the update, but not for the status
+    buffer.add({'id': ids[0], 'status': 'converted', 'path': None})
+    buffer.flush()
+    assert get_rows(db)[0]['status'] == 'new'
+
+    buffer.close()
+    row = get_rows(db)[0]
+    assert row['status'] == 'failed'
+    assert 'Status update failed' in row['error_message']
+    assert buffer._rows == []
+
+
+def test_row_buffer_writes_on_timer(db):
+    ids = add_rows(db, [{'path': 'a.txt', 'status': 'new'}])
+    buffer = RowBuffer(db, size=100, interval=0.1)
+    buffer.add({'id': ids[0], 'status': 'converted'})
+
+    deadline = time.time() + 5
+    while get_rows(db)[0]['status'] != 'converted' and time.time() < deadline:
+        time.sleep(0.05)
+    assert get_rows(db)[0]['status'] == 'converted'
+
+
+def test_persistent_storage_reuses_connection(db):
+    with Storage(db, persistent=True) as store:
+        conn = store.connection
+    with Storage(db, persistent=True) as store:
+        assert store.connection is conn
+    with Storage(db) as store:
+        assert store.connection is not conn
+
+    # Threads get connections of their own
+    other = []
+
+    def run():
+        with Storage(db, persistent=True) as store:
+            other.append(store.connection)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    assert other[0] is not conn
+
+
+def test_pages_are_read_by_id_while_rows_change(db):
+    add_rows(db, [{'path': f'{i:02}.txt', 'status': 'new'} for i in range(25)])
+    seen = []
+    with Storage(db) as store:
+        conds, params = store.get_conds(status='new')
+        for header, rows in store.get_pages(conds, params, size=10,
+                                            columns='id, status'):
+            assert header == ('id', 'status')
+            assert len(rows) <= 10
+            seen.extend(row[0] for row in rows)
+            # Rows leaving the conditions don't shift the next page
+            store.update_status(f"id IN ({', '.join(str(row[0]) for row in rows)})",
+                                [], 'converted')
+
+    assert seen == list(range(1, 26))
+
+
+def test_iter_ids_when_rows_fill_last_page(db):
+    add_rows(db, [{'path': f'{i}.txt', 'status': 'new'} for i in range(20)])
+    with Storage(db) as store:
+        assert list(store.iter_ids('1=1', [], size=10)) == list(range(1, 21))
+        assert list(store.iter_ids("status = 'failed'", [], size=10)) == []
+
+
+def test_sql_status_enum_matches_statuses():
+    sql = (Path(__file__).parent.parent / 'sql' / '01_init.sql').read_text()
+    enum = re.search(r"status ENUM\(([^)]*)\)", sql).group(1)
+    assert tuple(re.findall(r"'(\w+)'", enum)) == STATUSES
+
+
+def test_append_rows_inserts_stream_in_chunks(db):
+    class Rows:
+        """Table generated each time it's read, like a petl source"""
+
+        def __iter__(self):
+            yield ('path', 'status', 'size')
+            for i in range(25):
+                # Short rows are padded with None
+                yield ((f'{i:02}.txt', 'new', i) if i % 2
+                       else (f'{i:02}.txt', 'new'))
+
+    reports = []
+    with Storage(db) as store:
+        count = store.append_rows(etl.wrap(Rows()), chunk_size=10,
+                                  progress=lambda n, rate: reports.append(n))
+    assert count == 25
+    assert reports == [10, 20, 25]
+    stored = get_rows(db)
+    assert [row['path'] for row in stored] == [f'{i:02}.txt' for i in range(25)]
+    assert [row['size'] for row in stored[:3]] == [None, 1, None]
+
+
+def test_append_rows_keeps_chunks_before_a_failing_one(db):
+    table = [('path', 'status')] + [(f'{i}.txt', 'new') for i in range(5)]
+    # Path is required
+    table.append((None, 'new'))
+    with Storage(db) as store:
+        with pytest.raises(Exception):
+            store.append_rows(table, chunk_size=5)
+    assert len(get_rows(db)) == 5
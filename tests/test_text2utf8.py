@@ -0,0 +1,43 @@
+import pytest
+
+import bin.text2utf8 as text2utf8_module
+from bin.text2utf8 import text2utf8
+
+TEXT = ('Blåbærsyltetøy på brødskiva, og rømmegrøt med smør og kanel.\r\n'
+        'Særlig i Ålesund og på Økern.\r\n') * 20
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64])
+def test_chunks_split_line_endings_and_characters(tmp_path, monkeypatch,
+                                                  chunk_size):
+    monkeypatch.setattr(text2utf8_module, 'CHUNK_SIZE', chunk_size)
+    source = tmp_path / 'in.txt'
+    dest = tmp_path / 'out.txt'
+    # Two byte characters and CRLF pairs are split at every chunk size
+    source.write_bytes(TEXT.encode('utf-8') + b'\rslutt\r')
+
+    text2utf8(str(source), str(dest))
+    assert dest.read_bytes() == (
+        TEXT.replace('\r\n', '\n') + '\nslutt\n'
+    ).encode('utf-8')
+
+
+def test_latin1_is_converted(tmp_path, monkeypatch):
+    monkeypatch.setattr(text2utf8_module, 'CHUNK_SIZE', 5)
+    source = tmp_path / 'in.txt'
+    dest = tmp_path / 'out.txt'
+    source.write_bytes(TEXT.encode('latin-1'))
+
+    text2utf8(str(source), str(dest))
+    assert dest.read_text(encoding='utf-8') == TEXT.replace('\r\n', '\n')
+
+
+def test_encoding_is_detected_again_from_whole_file(tmp_path):
+    source = tmp_path / 'in.txt'
+    dest = tmp_path / 'out.txt'
+    # Only ascii in the part used for detection
+    prefix = 'abc\n' * (text2utf8_module.SAMPLE_SIZE // 4 + 1)
+    source.write_bytes((prefix + TEXT).encode('latin-1'))
+
+    text2utf8(str(source), str(dest))
+    assert dest.read_text(encoding='utf-8') == prefix + TEXT.replace('\r\n', '\n')
@@ -0,0 +1,63 @@
+import errno
+import os
+
+import pytest
+
+from util import transfer
+from util.transfer import get_methods, transfer_file
+
+
+def fail(code):
+    def func(src, dst):
+        raise OSError(code, os.strerror(code))
+    return func
+
+
+def test_unsupported_method_falls_back(tmp_path, monkeypatch):
+    src = tmp_path / 'a.txt'
+    src.write_text('original')
+    monkeypatch.setitem(transfer._FUNCTIONS, 'reflink', fail(errno.EOPNOTSUPP))
+
+    dst = tmp_path / 'b.txt'
+    assert transfer_file(str(src), str(dst), ['reflink', 'hardlink']) == 'hardlink'
+    assert os.path.samefile(src, dst)
+
+
+def test_copy_is_last_resort(tmp_path, monkeypatch):
+    src = tmp_path / 'a.txt'
+    src.write_text('original')
+    monkeypatch.setitem(transfer._FUNCTIONS, 'hardlink', fail(errno.EXDEV))
+    monkeypatch.setitem(transfer._FUNCTIONS, 'kernel', fail(errno.ENOSYS))
+
+    dst = tmp_path / 'b.txt'
+    assert transfer_file(str(src), str(dst), ['hardlink', 'kernel']) == 'copy'
+    assert dst.read_text() == 'original'
+    assert not os.path.samefile(src, dst)
+
+
+def test_other_errors_are_raised(tmp_path, monkeypatch):
+    src = tmp_path / 'a.txt'
+    src.write_text('original')
+    monkeypatch.setitem(transfer._FUNCTIONS, 'reflink', fail(errno.ENOSPC))
+
+    with pytest.raises(OSError):
+        transfer_file(str(src), str(tmp_path / 'b.txt'), ['reflink'])
+
+
+def test_existing_link_is_not_written_through(tmp_path):
+    src = tmp_path / 'a.txt'
+    src.write_text('original')
+    dst = tmp_path / 'b.txt'
+    os.link(src, dst)
+    other = tmp_path / 'c.txt'
+    other.write_text('other')
+
+    transfer_file(str(other), str(dst), ['kernel'])
+    assert dst.read_text() == 'other'
+    assert src.read_text() == 'original'
+
+
+def test_get_methods():
+    assert get_methods('auto') == list(transfer.METHODS)
+    assert get_methods('copy') == ['copy']
+    assert get_methods(['unknown', 'hardlink']) == ['hardlink']
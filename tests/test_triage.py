@@ -0,0 +1,66 @@
+import os
+
+from config import pwconv_path
+from file import File
+from storage import Storage
+from triage import triage
+
+from conftest import add_rows, get_rows
+
+FILES = [
+    ('a.js', 'application/javascript', None),
+    ('Thumbs.db', 'application/CDFV2', None),
+    ('x.zzz', 'application/x-not-in-converters', None),
+    ('p.pdf', 'application/encrypted', None),
+    ('sub/.DS_Store', 'application/octet-stream', 'fmt/394'),
+    ('sub/~$owner.docx', 'application/octet-stream', 'fmt/473'),
+    ('d.doc', 'application/msword', 'fmt/40'),
+    # Gets an extension when converted
+    ('README', 'text/plain', 'x-fmt/111'),
+]
+
+
+def register(tmp_path, name):
+    source = tmp_path / 'source'
+    db = str(tmp_path / f'{name}.db')
+    rows = []
+    for path, mime, puid in FILES:
+        (source / path).parent.mkdir(parents=True, exist_ok=True)
+        (source / path).write_text(path)
+        rows.append({'path': path, 'mime': mime, 'puid': puid, 'status': 'new',
+                     'size': len(path), 'kept': True})
+    add_rows(db, rows)
+    return str(source), db
+
+
+def test_triage_gives_same_result_as_file_convert(tmp_path):
+    source, db = register(tmp_path, 'triage')
+    dest = str(tmp_path / 'triage')
+    with Storage(db) as store:
+        conds, params = store.get_conds(status='new')
+        count = triage(store, source, dest, conds, params)
+    triaged = {row['path']: row for row in get_rows(db) if row['status'] != 'new'}
+    assert count == len(triaged) == 6
+    assert set(path for path, _, _ in FILES) - set(triaged) == {'d.doc', 'README'}
+
+    _, db = register(tmp_path, 'convert')
+    dest_converted = str(tmp_path / 'convert')
+    with Storage(db) as store:
+        for row in get_rows(db):
+            if row['path'] not in triaged:
+                continue
+            file = File(row, pwconv_path, False)
+            file.convert(source, dest_converted, False, False, False, False, False)
+            store.update_rows([file.__dict__])
+    converted = {row['path']: row for row in get_rows(db) if row['path'] in triaged}
+
+    for path, row in triaged.items():
+        assert (row['status'], row['kept']) == (
+            converted[path]['status'], converted[path]['kept']
+        ), path
+        assert os.path.exists(os.path.join(dest, path)) == os.path.exists(
+            os.path.join(dest_converted, path)
+        ), path
+    assert {row['status'] for row in triaged.values()} == {
+        'accepted', 'removed', 'skipped', 'protected'
+    }
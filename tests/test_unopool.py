@@ -0,0 +1,79 @@
+import os
+import time
+import threading
+import multiprocessing
+
+import psutil
+
+from util.unopool import UnoServerPool
+
+
+def make_pool(tmp_path):
+    pool = UnoServerPool(1, base_dir=str(tmp_path), check_interval=0.01)
+    server = pool.servers[0]
+    server.dir.mkdir(parents=True)
+    server._lock_path.touch()
+    server.restarts = 0
+
+    def restart():
+        server.restarts += 1
+
+    server.is_running = lambda: True
+    server.is_responding = lambda: False
+    server.restart = restart
+    return pool, server
+
+
+def test_monitor_skips_server_busy_in_this_process(tmp_path):
+    pool, server = make_pool(tmp_path)
+    with pool.acquire() as acquired:
+        assert acquired is server
+        pool._monitor = threading.Thread(target=pool._watch, daemon=True)
+        pool._monitor.start()
+        time.sleep(0.2)
+        assert server.restarts == 0
+        # The monitor hasn't dropped the lock of the conversion
+        assert server.index in pool._busy
+
+    deadline = time.time() + 5
+    while server.restarts == 0 and time.time() < deadline:
+        time.sleep(0.01)
+    pool.stop()
+    assert server.restarts > 0
+
+
+def test_stop_kills_server_restarted_by_worker(tmp_path):
+    pool = UnoServerPool(1, base_dir=str(tmp_path))
+    server = pool.servers[0]
+    server.command = lambda: ['sleep', '60']
+    server.is_listening = lambda timeout=1: True
+    assert pool.start() == 1
+    first = server.pid
+
+    # A worker restarting the server owns the new process
+    ctx = multiprocessing.get_context('fork')
+    worker = ctx.Process(target=server.restart)
+    worker.start()
+    worker.join()
+    second = server.pid
+    assert second != first
+    assert server.is_running()
+
+    pool.stop()
+    assert not psutil.pid_exists(second) or \
+        psutil.Process(second).status() == psutil.STATUS_ZOMBIE
+
+
+def test_stop_leaves_servers_of_other_runs(tmp_path):
+    pool = UnoServerPool(1, base_dir=str(tmp_path))
+    server = pool.servers[0]
+    server.command = lambda: ['sleep', '60']
+    server.is_listening = lambda timeout=1: True
+    server.owner = os.getpid() + 1
+    server.start()
+    server.owner = os.getpid()
+    try:
+        pool.stop()
+        assert server.is_running()
+    finally:
+        server.kill()
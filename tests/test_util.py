@@ -0,0 +1,67 @@
+import time
+import multiprocessing
+
+import pytest
+
+from config import pwconv_path
+from util import function_command, run_function, run_shell_cmd
+
+
+def test_function_command_runs_function(tmp_path):
+    source = tmp_path / 'a.txt'
+    dest = tmp_path / 'b.txt'
+    source.write_bytes('Blåbærsyltetøy på brødskiva\n'.encode('latin-1'))
+
+    cmd = function_command('bin.text2utf8:text2utf8', [source, dest])
+    returncode, _, err = run_shell_cmd(cmd, cwd=pwconv_path, shell=True)
+    assert returncode == 0, err
+    assert dest.read_text(encoding='utf-8') == 'Blåbærsyltetøy på brødskiva\n'
+
+
+def test_function_command_exit_code(tmp_path):
+    cmd = function_command('bin.text2utf8:text2utf8',
+                           [tmp_path / 'missing.txt', tmp_path / 'b.txt'])
+    returncode, _, _ = run_shell_cmd(cmd, cwd=pwconv_path, shell=True)
+    assert returncode != 0
+
+
+@pytest.fixture(params=['interpreter', 'forkserver'])
+def context(request):
+    if request.param == 'forkserver':
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['util.util', 'tests.functions'])
+        return context
+    return None
+
+
+def test_run_function_exit_code_and_output(context):
+    returncode, out, _ = run_function('tests.functions:exit_with', [3],
+                                      timeout=30, context=context)
+    assert returncode == 3
+    assert out.strip() == 'converting'
+
+    returncode, out, err = run_function('tests.functions:script_exit', [0],
+                                        timeout=30, context=context)
+    assert returncode == 0
+    assert (out + (err or '')).strip() == 'done'
+
+
+def test_run_function_exception(context):
+    returncode, out, err = run_function('tests.functions:fail', ['broken file'],
+                                        timeout=30, context=context)
+    assert returncode == 1
+    assert 'ValueError: broken file' in out + (err or '')
+
+
+def test_run_function_timeout(context):
+    t0 = time.time()
+    returncode, out, _ = run_function('tests.functions:sleep', [30],
+                                      timeout=1, context=context)
+    assert (returncode, out) == (1, 'timeout')
+    assert time.time() - t0 < 10
+
+
+def test_run_function_missing_function(context):
+    returncode, _, _ = run_function('tests.functions:missing', [],
+                                    timeout=30, context=context)
+    assert returncode == 1
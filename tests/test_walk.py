@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+from util.walk import scan_files
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for path in ('b/2.txt', 'b/1.txt', 'a/c/x.txt', 'a/y.txt', 'z.txt',
+                 'b/d/e/f.txt'):
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text(path)
+    (tmp_path / 'empty').mkdir()
+    os.symlink(tmp_path / 'b', tmp_path / 'link')
+    return tmp_path
+
+
+def paths(top, **kwargs):
+    return [os.path.relpath(entry.path, top) for entry in scan_files(str(top), **kwargs)]
+
+
+def test_files_are_walked_depth_first_in_sorted_order(tree):
+    # Files of a directory come before its subdirectories, and
+    # symlinked directories are not followed
+    assert paths(tree, threads=1) == [
+        'z.txt', 'a/y.txt', 'a/c/x.txt', 'b/1.txt', 'b/2.txt', 'b/d/e/f.txt'
+    ]
+
+
+def test_symlinked_files_are_listed(tree):
+    os.symlink(tree / 'a' / 'y.txt', tree / 'a' / 'w.txt')
+    os.symlink(tree / 'missing.txt', tree / 'a' / 'broken.txt')
+    # A link back up the tree doesn't make the walk loop
+    os.symlink(tree, tree / 'a' / 'c' / 'up')
+    assert paths(tree, threads=1) == [
+        'z.txt', 'a/broken.txt', 'a/w.txt', 'a/y.txt', 'a/c/x.txt',
+        'b/1.txt', 'b/2.txt', 'b/d/e/f.txt'
+    ]
+    entries = {os.path.relpath(entry.path, tree): entry
+               for entry in scan_files(str(tree), threads=2, stat=True)}
+    # The stat is of the file linked to
+    assert entries['a/w.txt'].stat().st_size == len('a/y.txt')
+
+
+def test_walk_without_subdirectories(tree):
+    assert paths(tree, recursive=False, threads=1) == ['z.txt']
+
+
+def test_stat_is_cached_on_entries(tree):
+    for entry in scan_files(str(tree), threads=1, stat=True):
+        assert entry.stat(follow_symlinks=False).st_size == len(
+            os.path.relpath(entry.path, tree)
+        )
+
+
+def test_unreadable_directory_is_reported(tree):
+    errors = []
+    assert paths(tree / 'missing', onerror=errors.append, threads=1) == []
+    assert isinstance(errors[0], FileNotFoundError)
+
+
+@pytest.mark.parametrize('threads', [2, 8])
+def test_order_is_the_same_with_threads(tree, threads):
+    for i in range(30):
+        (tree / 'many' / f'{i:02}').mkdir(parents=True)
+        (tree / 'many' / f'{i:02}' / 'file.txt').write_text(str(i))
+    assert paths(tree, threads=threads) == paths(tree, threads=1)
+
+
+def test_walk_can_be_stopped_early_with_threads(tree):
+    walk = scan_files(str(tree), threads=4)
+    next(walk)
+    walk.close()
@@ -0,0 +1,86 @@
+from __future__ import annotations
+import datetime
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from config import converters
+from file import get_converter, is_accepted
+from storage import Storage
+from util.transfer import transfer_file
+
+
+def resolve_rule(mime, puid, ext, version, encoding) -> tuple | None:
+    """
+    Get the result File.convert would give files with these properties,
+    if it can be known without looking at the file
+
+    Returns:
+        tuple of status and kept (None to leave kept as is), or None if
+        the file must go through File.convert
+    """
+    if mime in ('', 'None', None):
+        # Must be identified first
+        return None
+    if not ext and mime != 'application/octet-stream':
+        # Gets an extension from its mime type
+        return None
+    if mime not in converters:
+        return 'skipped', None
+
+    converter = get_converter(mime, puid, ext)
+    if is_accepted(converter, version, encoding):
+        return 'accepted', True
+    if mime == 'application/encrypted':
+        return 'protected', True
+    if 'command' in converter or 'function' in converter:
+        return None
+    if converter.get('keep') is False:
+        return 'removed', None
+    return 'skipped', None
+
+
+def triage(store: Storage, source_dir: str, dest_dir: str, conds: str,
+           params: list, threads: int = 8) -> int:
+    """
+    Set status of files that need no converter, without File objects
+
+    The rules in converters.yml are resolved once for each combination
+    of mime, puid, extension, version and encoding among the files, and
+    applied to all matching rows with one UPDATE ... JOIN. Originals of
+    these files are first copied to destination in a thread pool, since
+    that is all File.convert would do with them.
+
+    Returns:
+        number of files given a status
+    """
+    store.fill_ext(conds, params)
+    rules = []
+    for key in store.get_rule_keys(conds, params):
+        result = resolve_rule(*key)
+        if result:
+            rules.append(key + result)
+    if not rules:
+        return 0
+
+    store.set_rules(rules)
+
+    if source_dir != dest_dir:
+        def copy(row):
+            id, path = row
+            dest_path = Path(dest_dir, path)
+            try:
+                dest_path.parent.mkdir(parents=True, exist_ok=True)
+                method = transfer_file(Path(source_dir, path), dest_path)
+                return {'id': id, 'transfer': method}
+            except OSError as e:
+                # Left out of the update, since status is no longer 'new'
+                return {'id': id, 'status': 'failed', 'error_message': str(e),
+                        'status_ts': datetime.datetime.now()}
+
+        orig_conds, orig_params = store.get_conds(original=True)
+        with ThreadPoolExecutor(threads) as executor:
+            for rows in store.get_rule_pages(f"({conds}) AND {orig_conds}",
+                                             list(params) + orig_params):
+                store.update_rows(list(executor.map(copy, rows)))
+
+    return store.apply_rules(conds, params, datetime.datetime.now())
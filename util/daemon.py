@@ -0,0 +1,253 @@
+from __future__ import annotations
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import socket
+import importlib
+import threading
+import subprocess
+import multiprocessing
+import multiprocessing.forkserver
+from rich.console import Console
+
+from config import cfg, converters, pwconv_path
+from .orchestrator import get_orchestrator
+from .util import function_command, load_function, run_function
+
+console = Console()
+
+
+def daemon_functions() -> set[str]:
+    """
+    Functions the daemon may run, from converters in converters.yml with
+    `daemon: true`, also in the overrides for puid and source-ext
+    """
+    functions = set()
+    for converter in converters.values():
+        if not isinstance(converter, dict):
+            continue
+        variants = [converter]
+        for key in ('puid', 'source-ext'):
+            for override in (converter.get(key) or {}).values():
+                if isinstance(override, dict):
+                    variants.append({**converter, **override})
+        for variant in variants:
+            if variant.get('daemon') and variant.get('function'):
+                functions.add(variant['function'])
+    return functions
+
+
+def get_settings() -> dict:
+    settings = dict(cfg.get('converter-daemon') or {})
+    settings.setdefault('socket', '/tmp/pwconv-daemon.sock')
+    settings.setdefault('workers', os.cpu_count() or 1)
+    settings.setdefault('queue-size', 32)
+    settings.setdefault('max-jobs', 500)
+    settings.setdefault('preload', [])
+    return settings
+
+
+class ConverterDaemon:
+    """
+    Resident process running Python converters for the workers
+
+    Only the functions of converters with `daemon: true` are run, since
+    any process that can reach the socket can send a job. Heavy modules
+    and these functions are preloaded by a forkserver when the daemon
+    starts. Each job is run by `run_function` in a child forked from the
+    forkserver, so it starts with the modules loaded and can be killed on
+    timeout. The daemon itself doesn't fork, since it runs jobs from
+    several threads. Jobs wait in a bounded queue; when it is full, the
+    job is refused and the client runs it itself. After `max-jobs` jobs the daemon finishes the queued
+    jobs and replaces itself with a fresh process.
+    """
+
+    def __init__(self, settings: dict):
+        self.path = settings['socket']
+        self.workers = settings['workers']
+        self.max_jobs = settings['max-jobs']
+        self.preload = settings['preload']
+        self.functions = daemon_functions()
+        self.context = multiprocessing.get_context('forkserver')
+        self.jobs = queue.Queue(settings['queue-size'])
+        self.done = 0
+        self._lock = threading.Lock()
+        self._sock = None
+
+    def load_modules(self):
+        """Check that modules and functions load, and preload them"""
+        modules = ['util.util'] + list(self.preload)
+        modules += sorted({name.partition(':')[0] for name in self.functions})
+        self.context.set_forkserver_preload(modules)
+        for name in self.preload:
+            try:
+                module = importlib.import_module(name)
+                if callable(getattr(module, 'warm_up', None)):
+                    module.warm_up()
+            except Exception as e:
+                console.print(f"Converter daemon couldn't load {name}: {e}",
+                              style="bold yellow")
+        for name in self.functions:
+            try:
+                load_function(name)
+            except Exception as e:
+                console.print(f"Converter daemon couldn't load {name}: {e}",
+                              style="bold yellow")
+        multiprocessing.forkserver.ensure_running()
+
+    def serve(self):
+        self.load_modules()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        # Only for converters run by the same user
+        os.chmod(self.path, 0o600)
+        self._sock.listen(self.workers * 2)
+
+        threads = [threading.Thread(target=self._work, daemon=True)
+                   for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                # Socket closed for restart
+                break
+            try:
+                self.jobs.put_nowait(conn)
+            except queue.Full:
+                self._reply(conn, 1, 'busy', '')
+
+        # Let queued jobs finish, then start over with a fresh process
+        self.jobs.join()
+        os.execv(sys.executable, [sys.executable, '-m', 'util.daemon'])
+
+    def _work(self):
+        while True:
+            conn = self.jobs.get()
+            try:
+                request = json.loads(self._receive(conn))
+                if request['function'] not in self.functions:
+                    self._reply(conn, 1, '', f"{request['function']} is not "
+                                "a daemon converter")
+                    continue
+                returncode, out, err = run_function(
+                    request['function'], request['args'], request.get('timeout'),
+                    context=self.context
+                )
+                self._reply(conn, returncode, out, err)
+            except Exception as e:
+                self._reply(conn, 1, '', f"{type(e).__name__}: {e}")
+            finally:
+                self.jobs.task_done()
+
+            with self._lock:
+                self.done += 1
+                if self.done == self.max_jobs:
+                    # Stop accepting jobs, so the daemon can be restarted
+                    os.remove(self.path)
+                    self._sock.shutdown(socket.SHUT_RDWR)
+                    self._sock.close()
+
+    @staticmethod
+    def _receive(conn) -> bytes:
+        chunks = []
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    @staticmethod
+    def _reply(conn, returncode, out, err):
+        try:
+            response = {'returncode': returncode, 'out': out or '',
+                        'err': str(err) if err else ''}
+            conn.sendall(json.dumps(response).encode())
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+
+def run_in_daemon(name: str, args: list, timeout=None) -> tuple[int, str, str]:
+    """
+    Run a Python function in the converter daemon
+
+    Falls back to running it in this process if the daemon isn't running
+    or its queue is full, see `_run_here`.
+
+    Returns:
+        exit code, output and error like `run_shell_cmd`
+    """
+    if not timeout:
+        timeout = cfg['timeout'] - 1
+    request = json.dumps({'function': name, 'args': args, 'timeout': timeout})
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            # The daemon kills the job at timeout, so it answers before this
+            sock.settimeout(timeout + 30)
+            sock.connect(get_settings()['socket'])
+            sock.sendall(request.encode())
+            sock.shutdown(socket.SHUT_WR)
+            response = json.loads(ConverterDaemon._receive(sock))
+    except (OSError, ValueError):
+        return _run_here(name, args, timeout)
+
+    if response['returncode'] and response['out'] == 'busy':
+        return _run_here(name, args, timeout)
+
+    return response['returncode'], response['out'], response['err'] or None
+
+
+def _run_here(name: str, args: list, timeout) -> tuple[int, str, str]:
+    """Run function in a new interpreter, from the event loop with --threads"""
+    orchestrator = get_orchestrator()
+    if orchestrator:
+        return orchestrator.run(function_command(name, args), cwd=pwconv_path,
+                                timeout=timeout)
+    return run_function(name, args, timeout)
+
+
+def daemon_needed() -> bool:
+    return bool(daemon_functions())
+
+
+def start_converter_daemon(timeout: int = 60):
+    """Start the converter daemon, and stop it when this process exits"""
+    path = get_settings()['socket']
+    proc = subprocess.Popen([sys.executable, '-m', 'util.daemon'],
+                            cwd=pwconv_path, start_new_session=True)
+
+    def stop():
+        if proc.poll() is None:
+            proc.terminate()
+            proc.wait()
+        if os.path.exists(path):
+            os.remove(path)
+
+    atexit.register(stop)
+
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        if proc.poll() is not None:
+            break
+        if os.path.exists(path):
+            console.print("Started converter daemon", style="bold blue")
+            return True
+        time.sleep(0.1)
+
+    console.print("Converter daemon didn't start, running converters in the "
+                  "workers", style="bold yellow")
+    return False
+
+
+if __name__ == '__main__':
+    ConverterDaemon(get_settings()).serve()
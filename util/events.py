@@ -0,0 +1,123 @@
+from __future__ import annotations
+import os
+import json
+import logging
+import multiprocessing as mp
+from logging.handlers import MemoryHandler, QueueHandler, QueueListener
+from pathlib import Path
+
+from rich.console import Console
+
+from config import cfg, pwconv_path
+
+# Logger for events about each file. Not propagated to the root logger,
+# so that events only go through the queue.
+logger = logging.getLogger('pwconv.events')
+logger.propagate = False
+
+console = Console()
+# Queue events from this process are sent to
+_queue = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Format an event as one line of JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        event = {
+            'ts': round(record.created, 3),
+            'pid': record.process,
+            'level': record.levelname.lower(),
+            'event': record.getMessage(),
+        }
+        event.update(getattr(record, 'fields', {}))
+        return json.dumps(event, default=str, ensure_ascii=False)
+
+
+class ConsoleHandler(logging.Handler):
+    """Print events to the console, above the progress line"""
+
+    def emit(self, record: logging.LogRecord):
+        fields = getattr(record, 'fields', {})
+        text = record.getMessage()
+        if fields.get('path'):
+            text += f": {fields['path']}"
+        if fields.get('error'):
+            text += f" ({fields['error']})"
+        style = 'bold red' if record.levelno >= logging.ERROR else 'bold yellow'
+        # Clear the progress line first
+        print('\r\x1b[2K', end='', flush=True)
+        console.print(text, style=style, markup=False, highlight=False)
+
+
+class EventLog:
+    """
+    Log of events from the workers, written as JSON lines
+
+    Workers put events on a queue with `emit`, which costs about as much
+    as putting a small dict on a queue. A listener thread in the main
+    process writes them to the log file in batches, and prints warnings
+    and errors to the console.
+    """
+
+    def __init__(self, path: str, batch_size: int = 500,
+                 console_level: int = logging.WARNING):
+        self.path = path
+        self.queue = mp.Queue()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        file_handler = logging.FileHandler(path, encoding='utf-8')
+        file_handler.setFormatter(JsonFormatter())
+        # Flushed when full, at errors and when the log is stopped
+        self._file = MemoryHandler(batch_size, flushLevel=logging.ERROR,
+                                   target=file_handler)
+        console_handler = ConsoleHandler(console_level)
+        self._listener = QueueListener(self.queue, self._file, console_handler,
+                                       respect_handler_level=True)
+
+    def start(self):
+        self._listener.start()
+        attach(self.queue)
+
+    def stop(self):
+        attach(None)
+        self._listener.stop()
+        self._file.flush()
+        self._file.target.close()
+        self._file.close()
+
+
+def attach(queue):
+    """Send events from this process to the queue of an event log"""
+    global _queue
+    _queue = queue
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    if queue is not None:
+        logger.addHandler(QueueHandler(queue))
+        logger.setLevel(cfg.get('event_level', 'INFO').upper())
+
+
+def get_queue():
+    """Get queue events from this process are sent to, for the workers"""
+    return _queue
+
+
+def emit(event: str, level: int = logging.INFO, **fields):
+    """
+    Log an event about a file
+
+    Args:
+        event: what happened, e.g. 'converted'
+        level: logging level, warnings and errors are also printed
+        fields: values written with the event, like id, path, stage,
+                status, duration and converter
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'fields': fields})
+
+
+def get_event_log() -> EventLog:
+    """Create event log at `event_log` in config"""
+    path = cfg.get('event_log') or 'data/events.jsonl'
+    return EventLog(os.path.join(pwconv_path, path),
+                    batch_size=cfg.get('event_batch_size', 500))
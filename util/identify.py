@@ -0,0 +1,523 @@
+from __future__ import annotations
+import os
+import csv
+import json
+import time
+import queue
+import atexit
+import shutil
+import signal
+import socket
+import subprocess
+import datetime
+import threading
+import http.client
+import multiprocessing.util as mp_util
+from collections import OrderedDict
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator
+
+import magic
+import petl as etl
+from chardet import UniversalDetector
+from rich.console import Console
+
+from config import cfg
+from .walk import scan_files
+
+console = Console()
+
+# Columns of the file list, as named in the csv output of Siegfried
+HEADER = ('filename', 'filesize', 'modified', 'errors', 'id', 'format',
+          'version', 'mime', 'class')
+# Rows waiting to be inserted, per shard worker
+QUEUE_SIZE = 1000
+# Results of single file identifications kept in memory
+RESULT_CACHE_SIZE = 10000
+# Bytes read from the start of a file to find its type and encoding
+SNIFF_SIZE = 1024 * 1024
+# Bytes fed to the encoding detector at a time
+SNIFF_BLOCK = 64 * 1024
+
+
+def siegfried_available() -> bool:
+    return bool(cfg.get('use_siegfried', True)) and shutil.which('sf') is not None
+
+
+def get_shards(source_dir: str, target: int, max_depth: int = 3) -> list[tuple[str, bool]]:
+    """
+    Split a directory tree into parts that can be identified in parallel
+
+    Directories are expanded level by level until there are at least
+    `target` parts. An expanded directory becomes a part of its own for
+    the files directly in it.
+
+    Returns:
+        list of (directory, recursive)
+    """
+    shards = []
+    dirs = [source_dir]
+    for _ in range(max_depth):
+        if len(shards) + len(dirs) >= target:
+            break
+        subdirs = []
+        for path in dirs:
+            shards.append((path, False))
+            try:
+                with os.scandir(path) as entries:
+                    subdirs.extend(sorted(entry.path for entry in entries
+                                          if entry.is_dir(follow_symlinks=False)))
+            except OSError as e:
+                console.print(f"Warning: Could not read directory {path}: {e}",
+                              style="bold yellow")
+        dirs = subdirs
+
+    shards.extend((path, True) for path in dirs)
+    return shards
+
+
+def list_files(path: str, source_dir: str, recursive: bool = True,
+               skip=()) -> Iterator[tuple]:
+    """
+    List files without identifying them
+
+    Returns:
+        rows with the columns in HEADER, path relative to source_dir
+    """
+    def warn(e):
+        console.print(f"Warning: Could not read {e.filename}: {e}", style="bold yellow")
+
+    for entry in scan_files(path, recursive, onerror=warn, stat=True):
+        rel_path = os.path.relpath(entry.path, source_dir)
+        if rel_path in skip:
+            continue
+        try:
+            stat = entry.stat()
+            yield (rel_path, stat.st_size, int(stat.st_mtime), None) + (None,) * 5
+        except OSError as e:
+            yield (rel_path, 0, 0, f"Error: {e}") + (None,) * 5
+
+
+def _identify_shard(path: str, recursive: bool, source_dir: str) -> Iterator[tuple]:
+    """Identify files with Siegfried, yielding rows as they are reported"""
+    cmd = ['sf', '-csv', '-coe']
+    if not recursive:
+        cmd.append('-nr')
+    cmd.append(path)
+
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            text=True, encoding='utf-8', errors='replace')
+    # Drain stderr in the background, so sf can't block on a full pipe
+    errors = []
+    reader = threading.Thread(target=lambda: errors.append(proc.stderr.read()),
+                              daemon=True)
+    reader.start()
+
+    seen = set()
+    try:
+        for rec in csv.DictReader(proc.stdout):
+            if not rec.get('filename'):
+                continue
+            rel_path = os.path.relpath(rec['filename'], source_dir)
+            seen.add(rel_path)
+            yield (rel_path,) + tuple(rec.get(col) or None for col in HEADER[1:])
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+        reader.join()
+
+    if returncode != 0:
+        message = ''.join(errors).strip().splitlines()
+        console.print(f"Siegfried failed on {path} (exit code {returncode})"
+                      + (f": {message[-1]}" if message else '')
+                      + ", listing remaining files without identification",
+                      style="bold yellow")
+        yield from list_files(path, source_dir, recursive, skip=seen)
+
+
+def iter_filelist(source_dir: str, workers: int = None,
+                  progress: Callable[[int, int, int], None] = None) -> Iterator[tuple]:
+    """
+    Identify all files in a directory tree
+
+    The tree is split into shards that are identified by separate
+    Siegfried processes, and rows are yielded as soon as any process
+    reports them. Without Siegfried, files are only listed.
+
+    Args:
+        source_dir: directory to identify files in
+        workers: number of Siegfried processes to run at the same time
+        progress: called with files found, shards finished and shards total
+    Returns:
+        rows with the columns in HEADER, path relative to source_dir
+    """
+    source_dir = os.path.normpath(source_dir)
+    if not siegfried_available():
+        count = 0
+        for row in list_files(source_dir, source_dir):
+            count += 1
+            yield row
+            if progress and count % 1000 == 0:
+                progress(count, 0, 1)
+        if progress:
+            progress(count, 1, 1)
+        return
+
+    workers = workers or cfg.get('identify_workers') or os.cpu_count() or 1
+    shards = get_shards(source_dir, workers * 4)
+    rows = queue.Queue(QUEUE_SIZE * workers)
+    stop = threading.Event()
+    done = object()
+
+    def run(shard):
+        try:
+            if stop.is_set():
+                return
+            for row in _identify_shard(*shard, source_dir):
+                while not stop.is_set():
+                    try:
+                        rows.put(row, timeout=1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        finally:
+            rows.put(done)
+
+    count = finished = 0
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(run, shard) for shard in shards]
+        try:
+            while finished < len(shards):
+                row = rows.get()
+                if row is done:
+                    finished += 1
+                else:
+                    count += 1
+                    yield row
+                if progress and (row is done or count % 1000 == 0):
+                    progress(count, finished, len(shards))
+        finally:
+            stop.set()
+            # Let workers blocked on a full queue see the stop flag
+            while not all(future.done() for future in futures):
+                try:
+                    rows.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    for future in futures:
+        if future.exception():
+            raise future.exception()
+
+
+def parse_modified(value) -> int | None:
+    """Get modification time as seconds since epoch from a file list"""
+    if value in (None, ''):
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        pass
+    # Siegfried reports RFC 3339 timestamps
+    try:
+        return int(datetime.datetime.fromisoformat(
+            str(value).replace('Z', '+00:00')).timestamp())
+    except ValueError:
+        return None
+
+
+def identify_paths(source_dir: str, paths: list[str],
+                   workers: int = None) -> Iterator[tuple]:
+    """
+    Identify the given files, e.g. the ones changed since the last run
+
+    Files are sent to the Siegfried server from a pool of threads, so
+    requests overlap. Without Siegfried, files are only listed.
+
+    Args:
+        source_dir: directory the paths are relative to
+        paths: files to identify
+        workers: number of requests at the same time
+    Returns:
+        rows with the columns in HEADER, in the order of `paths`
+    """
+    use_sf = siegfried_available()
+    if use_sf:
+        get_sf_server()
+
+    def identify(rel_path):
+        path = os.path.join(source_dir, rel_path)
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            return (rel_path, 0, 0, f"Error: {e}") + (None,) * 5
+        row = (rel_path, stat.st_size, int(stat.st_mtime), None)
+        fileinfo = identify_file(path) if use_sf else None
+        if not fileinfo:
+            return row + (None,) * 5
+        match = fileinfo['matches'][0]
+        return row + tuple(match.get(col) or None for col in HEADER[4:])
+
+    workers = workers or cfg.get('identify_workers') or os.cpu_count() or 1
+    with ThreadPoolExecutor(workers) as executor:
+        yield from executor.map(identify, paths)
+
+
+class FileList(etl.Table):
+    """
+    File list of a directory tree as a petl table
+
+    Identification starts when the rows are iterated, so the header can
+    be read without running Siegfried. If `paths` is given, only those
+    files are identified.
+    """
+
+    def __init__(self, source_dir: str, workers: int = None, progress=None,
+                 paths: list[str] = None):
+        self.source_dir = source_dir
+        self.workers = workers
+        self.progress = progress
+        self.paths = paths
+
+    def __iter__(self):
+        yield HEADER
+        if self.paths is not None:
+            yield from identify_paths(self.source_dir, self.paths, self.workers)
+        else:
+            yield from iter_filelist(self.source_dir, self.workers, self.progress)
+
+
+class SiegfriedServer:
+    """
+    Siegfried running in server mode, answering identification requests
+
+    The signature file is loaded once when the server starts, instead of
+    for every file as with `sf -json <path>`. A server started before the
+    conversion workers are forked is shared by all of them.
+    """
+
+    def __init__(self):
+        self.port = None
+        self._proc = None
+        self._owner = None
+        self._local = threading.local()
+
+    def start(self, timeout: int = 30) -> bool:
+        """Start server on a free local port and wait until it listens"""
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        try:
+            self._proc = subprocess.Popen(
+                ['sf', '-serve', f'127.0.0.1:{self.port}'],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        except OSError:
+            return False
+        self._owner = os.getpid()
+        # Workers in a multiprocessing pool exit without running atexit
+        mp_util.Finalize(self, SiegfriedServer.stop, args=(self,), exitpriority=10)
+        atexit.register(self.stop)
+
+        t0 = time.time()
+        while time.time() - t0 < timeout:
+            if self._proc.poll() is not None:
+                return False
+            try:
+                with socket.create_connection(('127.0.0.1', self.port), 1):
+                    return True
+            except OSError:
+                time.sleep(0.1)
+
+        return False
+
+    def stop(self):
+        if self._proc and self._owner == os.getpid() and self._proc.poll() is None:
+            os.killpg(os.getpgid(self._proc.pid), signal.SIGTERM)
+            self._proc.wait()
+
+    def is_running(self) -> bool:
+        if self._proc is None:
+            return False
+        if self._owner == os.getpid():
+            return self._proc.poll() is None
+        try:
+            os.kill(self._proc.pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def _connection(self) -> http.client.HTTPConnection:
+        # Keep one connection per thread, and a new one after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def identify(self, path: str) -> dict:
+        """Get Siegfried's json result for a file"""
+        url = f"/identify/{quote(path, safe='')}?format=json"
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request('GET', url)
+                response = conn.getresponse()
+                body = response.read()
+                break
+            except (OSError, http.client.HTTPException):
+                # The server closes idle connections, so retry once on a
+                # new one
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+
+        if response.status != 200:
+            raise RuntimeError(f"Siegfried server answered {response.status}: "
+                               f"{body.decode(errors='replace').strip()}")
+        return json.loads(body)
+
+
+_server = None
+# Set when the server couldn't start, so that it isn't tried again
+_server_failed = False
+_server_lock = threading.Lock()
+_results = OrderedDict()
+
+
+def get_sf_server() -> SiegfriedServer | None:
+    """
+    Get running Siegfried server, starting it if needed
+
+    If the server doesn't start, None is returned from then on in this
+    process and the workers forked from it, without trying again.
+    """
+    global _server, _server_failed
+    with _server_lock:
+        if _server_failed:
+            return None
+        if _server is None or not _server.is_running():
+            _server = SiegfriedServer()
+            if not _server.start():
+                console.print("Siegfried server didn't start, identifying "
+                              "files with separate sf processes",
+                              style="bold yellow")
+                _server = None
+                _server_failed = True
+        return _server
+
+
+def _run_sf(path: str) -> dict:
+    proc = subprocess.run(['sf', '-json', path], capture_output=True)
+    if proc.stderr:
+        raise RuntimeError(proc.stderr.decode(errors='replace').strip())
+    return json.loads(proc.stdout)
+
+
+def identify_file(path: str) -> dict | None:
+    """
+    Identify a single file with Siegfried
+
+    Results are cached by path, size and modification time, so a file
+    is only identified again if it has changed.
+
+    Returns:
+        Siegfried's result for the file, or None if it can't be identified
+    """
+    path = os.path.abspath(path)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    with _server_lock:
+        if key in _results:
+            _results.move_to_end(key)
+            return _results[key]
+
+    try:
+        server = get_sf_server()
+        if server is None and shutil.which('sf') is None:
+            # Identified by magic instead
+            return None
+        result = server.identify(path) if server else _run_sf(path)
+        fileinfo = result['files'][0]
+        if not fileinfo.get('matches'):
+            return None
+    except (OSError, ValueError, KeyError, IndexError, RuntimeError,
+            http.client.HTTPException) as e:
+        console.print(f"Siegfried couldn't identify {path}: {e}", style="bold yellow")
+        return None
+
+    with _server_lock:
+        _results[key] = fileinfo
+        if len(_results) > RESULT_CACHE_SIZE:
+            _results.popitem(last=False)
+    return fileinfo
+
+
+_magic = threading.local()
+
+
+def _magic_handles() -> tuple[magic.Magic, magic.Magic]:
+    # libmagic handles load the magic database when created, and can't be
+    # shared between threads
+    if not hasattr(_magic, 'mime'):
+        _magic.mime = magic.Magic(mime=True)
+        _magic.desc = magic.Magic()
+    return _magic.mime, _magic.desc
+
+
+def read_header(path: str, size: int = SNIFF_SIZE) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read(size)
+
+
+def sniff_type(path: str, header: bytes = None) -> tuple[str, str, bytes]:
+    """
+    Find mime type and format of a file with libmagic
+
+    Only the start of the file is read, once, and kept so that the
+    encoding can be detected from the same bytes.
+
+    Returns:
+        tuple of mime type, format and the bytes read
+    """
+    mime_handle, desc_handle = _magic_handles()
+    if header is None:
+        header = read_header(path)
+    if header:
+        mime = mime_handle.from_buffer(header)
+        fmt = desc_handle.from_buffer(header)
+    else:
+        # Empty files are told apart by the file itself. Symlinks are
+        # listed as the file linked to, so they are identified as it.
+        mime = mime_handle.from_file(os.path.realpath(path))
+        fmt = desc_handle.from_file(os.path.realpath(path))
+        header = b''
+    return mime, fmt.split(',')[0], header
+
+
+def detect_encoding(path: str, header: bytes = None) -> str | None:
+    """
+    Detect the character encoding of a text file
+
+    Detection runs over the start of the file, a block at a time, and
+    stops as soon as the detector is confident.
+    """
+    if header is None:
+        header = read_header(path)
+    detector = UniversalDetector()
+    for start in range(0, len(header), SNIFF_BLOCK):
+        detector.feed(header[start:start + SNIFF_BLOCK])
+        if detector.done:
+            break
+    detector.close()
+    return detector.result['encoding']
@@ -0,0 +1,127 @@
+from __future__ import annotations
+import os
+import signal
+import asyncio
+import threading
+
+from config import cfg
+
+# Seconds a command gets to exit after SIGTERM, before it is killed
+KILL_AFTER = 5
+
+
+class Orchestrator:
+    """
+    Runs converter commands from one asyncio event loop
+
+    The loop runs in a thread of its own, and any thread can hand it a
+    command with `run` and wait for the result. Waiting on the commands
+    costs the loop nothing, so many of them can run at once without a
+    Python process or thread blocked in `communicate()` for each.
+
+    The number of commands running at once is capped by `limit`, and
+    for each mime type by the `concurrency` of its converter in
+    converters.yml, if set.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        daemon=True)
+        self._thread.start()
+        self._pid = os.getpid()
+        # Created in the loop, since they belong to it
+        self._semaphores = {}
+
+    def _semaphore(self, key, limit):
+        if key not in self._semaphores:
+            self._semaphores[key] = asyncio.Semaphore(limit)
+        return self._semaphores[key]
+
+    async def _run(self, command, cwd, timeout, key, key_limit):
+        async with self._semaphore(None, self.limit):
+            if key_limit:
+                async with self._semaphore(key, key_limit):
+                    return await self._run_command(command, cwd, timeout)
+            return await self._run_command(command, cwd, timeout)
+
+    async def _run_command(self, command, cwd, timeout):
+        try:
+            proc = await asyncio.create_subprocess_shell(
+                command,
+                cwd=cwd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                env=dict(os.environ, PYTHONUNBUFFERED='1'),
+                # Own process group, so the whole group can be killed
+                start_new_session=True,
+            )
+        except Exception as e:
+            return 1, '', e
+
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            await self._kill(proc)
+            return 1, 'timeout', None
+
+        return (proc.returncode, out.decode(errors='replace'),
+                err.decode(errors='replace'))
+
+    @staticmethod
+    async def _kill(proc):
+        """Stop the process group of the command, and kill it if it hangs"""
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(proc.pid, sig)
+            except ProcessLookupError:
+                break
+            try:
+                await asyncio.wait_for(proc.wait(), KILL_AFTER)
+                break
+            except asyncio.TimeoutError:
+                continue
+
+    def run(self, command: str, cwd: str = None, timeout: int = None,
+            key: str = None, key_limit: int = None) -> tuple[int, str, str]:
+        """
+        Run shell command and wait for it to finish
+
+        Args:
+            command: shell command
+            cwd: directory to run the command in
+            timeout: seconds before the command is stopped
+            key: commands with the same key share the `key_limit`
+            key_limit: number of commands with this key to run at once
+        Returns:
+            exit code, output and error like `run_shell_cmd`
+        """
+        if not timeout:
+            timeout = cfg['timeout'] - 1
+        future = asyncio.run_coroutine_threadsafe(
+            self._run(command, cwd, timeout, key, key_limit), self._loop
+        )
+        return future.result()
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+_orchestrator = None
+
+
+def start_orchestrator(limit: int) -> Orchestrator:
+    """Run converter commands of this process from an event loop"""
+    global _orchestrator
+    _orchestrator = Orchestrator(limit)
+    return _orchestrator
+
+
+def get_orchestrator() -> Orchestrator | None:
+    """Get the orchestrator of this process, None if not started"""
+    # The loop thread isn't copied into forked processes
+    if _orchestrator and _orchestrator._pid == os.getpid():
+        return _orchestrator
+    return None
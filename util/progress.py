@@ -0,0 +1,131 @@
+from __future__ import annotations
+import sys
+import time
+import datetime
+import threading
+import multiprocessing as mp
+
+# Counters kept for each process
+FIELDS = ('done', 'cached', 'unpacked', 'converted', 'accepted', 'renamed',
+          'skipped', 'removed', 'protected', 'timeout', 'failed')
+_INDEX = {field: i for i, field in enumerate(FIELDS)}
+# Statuses shown in the progress line, when not zero
+STATUSES = FIELDS[3:]
+
+
+class Progress:
+    """
+    Progress of a conversion, counted in shared memory
+
+    Each process writes to its own row of counters in a shared array,
+    so an update is a plain memory write without locks or round trips
+    to a manager process. The main process sums up the rows when it
+    renders progress. The first row belongs to the main process, and
+    workers claim the next ones when they start. Workers beyond the
+    number of rows share the last row, and update it under a lock, as
+    do threads converting in the same process when `threaded` is set.
+    """
+
+    def __init__(self, total: int, processes: int = 1, threaded: bool = False):
+        # Only changed by the main process
+        self.total = total
+        self.started = time.time()
+        self._rows = processes + 2
+        self._counts = mp.RawArray('q', self._rows * len(FIELDS))
+        self._next_row = mp.Value('i', 1)
+        self._lock = mp.Lock()
+        self._offset = 0
+        self._shared = threaded
+        self._thread = None
+        self._stop = threading.Event()
+
+    def claim_row(self):
+        """Take a row of counters for this process"""
+        with self._next_row.get_lock():
+            row = self._next_row.value
+            self._next_row.value += 1
+        if row >= self._rows - 1:
+            row = self._rows - 1
+            self._shared = True
+        self._offset = row * len(FIELDS)
+
+    def release_rows(self):
+        """
+        Let the workers of a new pool claim the rows again
+
+        Only to be called when the workers of the previous pool have
+        exited. The counts in the rows are kept.
+        """
+        with self._next_row.get_lock():
+            self._next_row.value = 1
+
+    def add(self, field: str, n: int = 1):
+        i = _INDEX.get(field)
+        if i is None:
+            return
+        if self._shared:
+            with self._lock:
+                self._counts[self._offset + i] += n
+        else:
+            self._counts[self._offset + i] += n
+
+    def get(self, field: str) -> int:
+        i = _INDEX[field]
+        size = len(FIELDS)
+        return sum(self._counts[row * size + i] for row in range(self._rows))
+
+    def render(self) -> str:
+        done = self.get('done')
+        elapsed = max(time.time() - self.started, 1e-6)
+        rate = done / elapsed
+        percent = round(done / self.total * 100) if self.total else 100
+        line = f"{percent}% | {done}/{self.total} files | {rate:.1f} files/s"
+        if rate and done < self.total:
+            eta = datetime.timedelta(seconds=round((self.total - done) / rate))
+            line += f" | ETA {eta}"
+        counts = [(status, self.get(status)) for status in STATUSES]
+        statuses = ', '.join(f"{status} {n}" for status, n in counts if n)
+        if statuses:
+            line += f" | {statuses}"
+        return line
+
+    def start(self, interval: float = 0.5):
+        """Render progress in a thread every `interval` seconds"""
+        def run():
+            while not self._stop.wait(interval):
+                self._print()
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self._print()
+        print(flush=True)
+
+    def _print(self):
+        sys.stdout.write('\r\x1b[2K' + self.render())
+        sys.stdout.flush()
+
+
+_progress = None
+
+
+def set_progress(progress: Progress | None, worker: bool = False):
+    """Set progress counted by this process, claiming a row in workers"""
+    global _progress
+    _progress = progress
+    if progress and worker:
+        progress.claim_row()
+
+
+def get_progress() -> Progress:
+    """Get progress of this process, a detached one if not set"""
+    global _progress
+    if _progress is None:
+        _progress = Progress(0)
+    return _progress
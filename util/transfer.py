@@ -0,0 +1,110 @@
+from __future__ import annotations
+import os
+import errno
+import fcntl
+import shutil
+
+from config import cfg
+
+# ioctl to share the data blocks of one file with another (Linux)
+FICLONE = 0x40049409
+# Methods in the order they are tried by default
+METHODS = ('reflink', 'hardlink', 'kernel', 'copy')
+# Errors meaning that a method isn't supported for these files
+_UNSUPPORTED = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                errno.ENOSYS, errno.EPERM, errno.EMLINK}
+
+
+def _reflink(src: str, dst: str):
+    with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+        fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+
+
+def _hardlink(src: str, dst: str):
+    os.link(src, dst)
+
+
+def _kernel_copy(src: str, dst: str):
+    """Copy within the kernel, without reading the data into userspace"""
+    with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+        size = os.fstat(f_src.fileno()).st_size
+        copy = getattr(os, 'copy_file_range', None)
+        offset = 0
+        while offset < size:
+            try:
+                if copy:
+                    sent = copy(f_src.fileno(), f_dst.fileno(), size - offset)
+                else:
+                    sent = os.sendfile(f_dst.fileno(), f_src.fileno(), offset,
+                                       size - offset)
+            except OSError as e:
+                # copy_file_range isn't supported across all filesystems
+                # on older kernels, but sendfile is
+                if copy and e.errno in _UNSUPPORTED and offset == 0:
+                    copy = None
+                    continue
+                raise
+            if sent == 0:
+                break
+            offset += sent
+
+
+def _copy(src: str, dst: str):
+    shutil.copyfile(src, dst)
+
+
+_FUNCTIONS = {
+    'reflink': _reflink,
+    'hardlink': _hardlink,
+    'kernel': _kernel_copy,
+    'copy': _copy,
+}
+
+
+def get_methods(methods=None) -> list[str]:
+    """Get transfer methods to try, from `transfer-mode` in config if not given"""
+    if methods is None:
+        methods = cfg.get('transfer-mode') or METHODS
+    if isinstance(methods, str):
+        methods = METHODS if methods == 'auto' else [methods]
+    return [method for method in methods if method in _FUNCTIONS]
+
+
+def transfer_file(src: str, dst: str, methods=None) -> str:
+    """
+    Copy file to destination with the cheapest method that works
+
+    The methods are tried in order, and a plain copy is the last resort:
+    - reflink: share data blocks, on filesystems like btrfs and XFS
+    - hardlink: link to the same file, if on the same filesystem
+    - kernel: copy with copy_file_range or sendfile, which lets the
+      filesystem do server side copies on e.g. NFS 4.2
+    - copy: copy through userspace
+
+    An existing destination is removed first, so that a hardlink from an
+    earlier run is never written through to the source.
+
+    Args:
+        src: file to copy
+        dst: path of copy
+        methods: methods to try, defaults to `transfer-mode` in config
+    Returns:
+        the method used
+    """
+    for method in get_methods(methods) + ['copy']:
+        if os.path.lexists(dst):
+            os.remove(dst)
+        try:
+            _FUNCTIONS[method](src, dst)
+            return method
+        except OSError as e:
+            if method == 'copy' or e.errno not in _UNSUPPORTED:
+                raise
+
+
+def is_same_file(path1, path2) -> bool:
+    """Check if two paths are links to the same file"""
+    try:
+        return os.path.samefile(path1, path2)
+    except OSError:
+        return False
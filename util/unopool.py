@@ -0,0 +1,359 @@
+from __future__ import annotations
+import os
+import time
+import fcntl
+import shutil
+import signal
+import socket
+import subprocess
+import threading
+import xmlrpc.client
+from contextlib import contextmanager
+from pathlib import Path
+import psutil
+from rich.console import Console
+
+from config import cfg
+
+console = Console()
+
+
+class _TimeoutTransport(xmlrpc.client.Transport):
+    """XML-RPC transport that gives up on unresponsive servers"""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self._timeout = timeout
+
+    def make_connection(self, host):
+        conn = super().make_connection(host)
+        conn.timeout = self._timeout
+        return conn
+
+
+class UnoServer:
+    """A single unoserver process with its own ports and user profile"""
+
+    def __init__(self, index: int, port: int, uno_port: int, base_dir: str,
+                 owner: int = None):
+        self.index = index
+        self.port = port
+        self.uno_port = uno_port
+        # Process of the conversion run the server is started for. Servers
+        # restarted by its workers belong to the run as well.
+        self.owner = owner or os.getpid()
+        self.dir = Path(base_dir, str(index))
+        self.profile = Path(self.dir, 'profile')
+        self._lock_path = Path(self.dir, 'lock')
+        self._pid_path = Path(self.dir, 'pid')
+        self._owner_path = Path(self.dir, 'owner')
+        self._proc = None
+        self._spawner = None
+
+    @property
+    def pid(self):
+        return self._read_int(self._pid_path)
+
+    def _read_int(self, path):
+        try:
+            return int(path.read_text())
+        except (OSError, ValueError):
+            return None
+
+    def command(self):
+        return [
+            'unoserver',
+            '--interface', '127.0.0.1',
+            '--port', str(self.port),
+            '--uno-port', str(self.uno_port),
+            '--user-installation', self.profile.as_uri(),
+        ]
+
+    def start(self, timeout=30):
+        """Start the server and wait until it accepts connections"""
+        self.profile.mkdir(parents=True, exist_ok=True)
+        self._lock_path.touch()
+        self._proc = subprocess.Popen(
+            self.command(),
+            start_new_session=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.STDOUT,
+        )
+        self._spawner = os.getpid()
+        self._pid_path.write_text(str(self._proc.pid))
+        self._owner_path.write_text(str(self.owner))
+
+        t0 = time.time()
+        while time.time() - t0 < timeout:
+            if self._proc.poll() is not None:
+                return False
+            if self.is_listening():
+                return True
+            time.sleep(0.5)
+
+        return False
+
+    def kill(self):
+        """Kill the server together with its soffice child processes"""
+        pid = self.pid
+        if pid is None:
+            return
+        try:
+            os.killpg(os.getpgid(pid), signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            return
+        if self._is_child(pid):
+            self._proc.wait()
+        else:
+            # Only the parent can wait for a process, so wait until it's
+            # gone or left as a zombie, which has released its ports
+            self._wait_gone(pid)
+
+    def _is_child(self, pid):
+        return (self._proc is not None and self._proc.pid == pid
+                and self._spawner == os.getpid())
+
+    def _wait_gone(self, pid, timeout=10):
+        t0 = time.time()
+        while time.time() - t0 < timeout:
+            try:
+                if psutil.Process(pid).status() == psutil.STATUS_ZOMBIE:
+                    return
+            except psutil.NoSuchProcess:
+                return
+            time.sleep(0.1)
+
+    def restart(self):
+        self.kill()
+        return self.start()
+
+    def is_own(self):
+        """Check if the server was started for the run of this process"""
+        return self._read_int(self._owner_path) == self.owner
+
+    def is_running(self):
+        # The server may have been restarted by another process, so the
+        # pid file is the reference. Polling our own child reaps it if dead.
+        if self._proc and self._spawner == os.getpid():
+            self._proc.poll()
+        pid = self.pid
+        if pid is None:
+            return False
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def is_listening(self, timeout=1):
+        try:
+            with socket.create_connection(('127.0.0.1', self.port), timeout):
+                return True
+        except OSError:
+            return False
+
+    def is_responding(self, timeout=10):
+        """Check that the server answers a request, not just accepts it"""
+        proxy = xmlrpc.client.ServerProxy(
+            f'http://127.0.0.1:{self.port}',
+            transport=_TimeoutTransport(timeout)
+        )
+        try:
+            proxy.info()
+        except xmlrpc.client.Fault:
+            # Server answered, but doesn't know the method
+            return True
+        except (OSError, xmlrpc.client.Error):
+            return False
+        return True
+
+    def try_lock(self):
+        """Lock the server for one conversion, return file handle or None"""
+        try:
+            fh = open(self._lock_path, 'a')
+        except OSError:
+            return None
+        # POSIX record locks aren't inherited by forked processes, so a
+        # lock held by the monitor can't leak into the conversion workers
+        try:
+            fcntl.lockf(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fh.close()
+            return None
+        return fh
+
+    def wrap(self, cmd: str) -> str:
+        """Point an `unoconvert` command at this server"""
+        return cmd.replace(
+            'unoconvert',
+            f'unoconvert --host 127.0.0.1 --port {self.port}',
+            1
+        )
+
+
+class UnoServerPool:
+    """
+    Pool of unoserver instances shared by all worker processes
+
+    The parent process starts the instances and monitors them. Workers
+    pick a free instance by taking a file lock on it, so no state needs
+    to be shared with the parent. The pid and owning run of each server
+    are kept in files in its folder, so that servers restarted by the
+    workers are stopped by the parent.
+    """
+
+    def __init__(self, instances: int = 1, port: int = 2003,
+                 uno_port: int = 2002, base_dir: str = '/tmp/unoserver',
+                 check_interval: int = 30):
+        owner = os.getpid()
+        self.servers = [
+            UnoServer(i, port + 2 * i, uno_port + 2 * i, base_dir, owner)
+            for i in range(instances)
+        ]
+        self.check_interval = check_interval
+        self._next = 0
+        # File locks don't exclude threads within a process
+        self._busy = set()
+        self._busy_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._monitor = None
+
+    @classmethod
+    def from_config(cls):
+        settings = cfg.get('unoserver') or {}
+        return cls(
+            instances=settings.get('instances', 1),
+            port=settings.get('port', 2003),
+            uno_port=settings.get('uno_port', 2002),
+            base_dir=settings.get('dir', '/tmp/unoserver'),
+            check_interval=settings.get('check_interval', 30),
+        )
+
+    def start(self) -> int:
+        """
+        Start all instances and a thread restarting the ones that hang
+
+        Returns the number of instances that are running.
+        """
+        running = 0
+        for server in self.servers:
+            if server.is_running() and server.is_listening():
+                running += 1
+                continue
+            if server.start():
+                running += 1
+            else:
+                console.print(f"unoserver on port {server.port} didn't start",
+                              style="bold yellow")
+
+        self._monitor = threading.Thread(target=self._watch, daemon=True)
+        self._monitor.start()
+        return running
+
+    def stop(self):
+        """
+        Stop the monitor, and the servers started for this run
+
+        Servers that were already running when the pool was started may
+        be used by another conversion, and are left running.
+        """
+        if self._monitor is not None:
+            self._stop.set()
+            self._monitor.join()
+            self._monitor = None
+        for server in self.servers:
+            if server.is_own():
+                server.kill()
+
+    def _watch(self):
+        while not self._stop.wait(self.check_interval):
+            for server in self.servers:
+                if self._stop.is_set():
+                    return
+                # Only idle servers are checked, since a server busy with
+                # a large document can be slow to answer. Busy servers that
+                # hang are restarted by the worker when the conversion
+                # times out. The file lock doesn't exclude threads of this
+                # process, so servers they use are skipped by `_busy`.
+                with self._busy_lock:
+                    if server.index in self._busy:
+                        continue
+                    fh = server.try_lock()
+                    if fh is None:
+                        continue
+                    self._busy.add(server.index)
+                try:
+                    if not server.is_running():
+                        console.print(f"Restarting unoserver on port "
+                                      f"{server.port}", style="bold yellow")
+                        server.restart()
+                    elif not server.is_responding():
+                        console.print(f"unoserver on port {server.port} hangs, "
+                                      "restarting", style="bold yellow")
+                        server.restart()
+                finally:
+                    self._release(server, fh)
+
+    @contextmanager
+    def acquire(self, wait=0.1):
+        """
+        Get a free server for the duration of one conversion
+
+        Yields None if no server is running, so that commands are run
+        against the default unoserver.
+        """
+        servers = [server for server in self.servers if server.is_running()]
+        if not servers:
+            yield None
+            return
+
+        # Start at a different server in each process, and move on for
+        # each conversion, so that servers are used round-robin
+        start = (os.getpid() + self._next) % len(servers)
+        self._next += 1
+        fh = None
+        while fh is None:
+            with self._busy_lock:
+                for i in range(len(servers)):
+                    server = servers[(start + i) % len(servers)]
+                    if server.index in self._busy:
+                        continue
+                    fh = server.try_lock()
+                    if fh:
+                        self._busy.add(server.index)
+                        break
+            if fh is None:
+                time.sleep(wait)
+
+        try:
+            yield server
+        finally:
+            self._release(server, fh)
+
+    def _release(self, server, fh):
+        # Closing the file drops all locks this process holds on it, so
+        # it is closed before another thread can take the server
+        with self._busy_lock:
+            fh.close()
+            self._busy.discard(server.index)
+
+
+_pool = None
+
+
+def stop_uno_pool():
+    """Stop the unoserver pool of this process, if it was started"""
+    if _pool is not None:
+        _pool.stop()
+
+
+def get_uno_pool() -> UnoServerPool:
+    """Get the unoserver pool configured for this process"""
+    global _pool
+    if _pool is None:
+        _pool = UnoServerPool.from_config()
+    return _pool
+
+
+def unoserver_available() -> bool:
+    return shutil.which('unoserver') is not None
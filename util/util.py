@@ -1,5 +1,10 @@
 from __future__ import annotations
 import re
+import sys
+import csv
+import importlib
+import tempfile
+import traceback
 import shutil
 import subprocess
 import os
@@ -7,7 +12,9 @@ import signal
 import zipfile
 import psutil
 import time
-from config import cfg
+from functools import lru_cache
+from shlex import quote
+from config import cfg, pwconv_path
 from pathlib import Path
 from rich.console import Console
 
@@ -54,123 +61,160 @@ def run_shell_cmd(command, cwd=None, timeout=None,
     return proc.returncode, out, err
 
 
+@lru_cache(maxsize=None)
+def load_function(name: str):
+    """
+    Import function given as `package.module:function`
+
+    If the module has a `warm_up` function, it is called after import,
+    so that lazy initialisation is done once per process.
+    """
+    module_name, _, func_name = name.partition(':')
+    module = importlib.import_module(module_name)
+    if callable(getattr(module, 'warm_up', None)):
+        module.warm_up()
+    return getattr(module, func_name)
+
+
+def run_function(name: str, args: list, timeout=None,
+                 context=None) -> tuple[int, str, str]:
+    """
+    Run a Python function in a child process
+
+    The child is a new interpreter running `function_command`. Forking
+    this process instead isn't safe, since other threads, like the
+    progress updater and the row buffer timer, may hold locks that the
+    child would wait on forever. Running in a child keeps a crash, a leak
+    or a hang in the function from affecting the caller.
+
+    Args:
+        name: function as `package.module:function`
+        args: positional arguments for the function
+        timeout: The number of seconds to wait before killing the child
+        context: forkserver context from `multiprocessing.get_context`,
+                 to fork the child from its single-threaded server
+                 process, which has the modules preloaded
+    Returns:
+        exit code, output and error like `run_shell_cmd`
+    """
+    if not timeout:
+        timeout = cfg['timeout'] - 1
+
+    if context is None:
+        return run_shell_cmd(function_command(name, args), cwd=pwconv_path,
+                             shell=True, timeout=timeout)
+
+    with tempfile.NamedTemporaryFile(prefix='pwconv-') as output:
+        proc = context.Process(target=_run_child,
+                               args=(name, [str(arg) for arg in args],
+                                     output.name))
+        proc.start()
+        proc.join(timeout)
+        if proc.is_alive():
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                # Child hasn't got its own process group yet
+                proc.kill()
+            proc.join()
+            return 1, 'timeout', None
+
+        out = output.read().decode('utf-8', errors='replace')
+    return proc.exitcode, out, ''
+
+
+def _run_child(name: str, args: list, output_path: str):
+    """Run function with output to a file, as child of `run_function`"""
+    code = 1
+    try:
+        # Own process group, so that programs it starts are killed with it
+        os.setsid()
+        fd = os.open(output_path, os.O_WRONLY)
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        os.close(fd)
+        code = call_function(load_function(name), args)
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def call_function(func, args: list) -> int:
+    """Call converter function, and get exit code like for a script"""
+    try:
+        result = func(*args)
+        # Functions like pdf2pdfa return an exit code
+        return result if type(result) is int else 0
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else 1
+    except BaseException as e:
+        # typer.Exit carries the exit code of a command line script
+        code = getattr(e, 'exit_code', None)
+        if not isinstance(code, int):
+            traceback.print_exc()
+            code = 1
+        return code
+
+
+def function_command(name: str, args: list) -> str:
+    """
+    Shell command running a Python function in a new interpreter
+
+    Used by `run_function`, and run from the event loop with --threads.
+    The command must be run from the pwconv folder.
+    """
+    script = ("import sys; from util import call_function, load_function; "
+              "sys.exit(call_function(load_function(sys.argv[1]), sys.argv[2:]))")
+    return ' '.join(quote(part) for part in
+                    [sys.executable, '-c', script, name, *map(str, args)])
+
+
 def make_filelist(source_dir, filelist_path):
-    """Create a file list from source directory using Siegfried or simple listing"""
+    """Create a csv file list from source directory, identified with Siegfried if available"""
+    from .identify import HEADER, iter_filelist
+
     try:
-        # Debug information
-        console.print(f"make_filelist called with:", style="bold blue")
-        console.print(f"  source_dir: {source_dir}", style="blue")
-        console.print(f"  filelist_path: {filelist_path}", style="blue")
-        
-        # Ensure the directory for filelist exists
-        filelist_dir = os.path.dirname(filelist_path)
-        Path(filelist_dir).mkdir(parents=True, exist_ok=True)
-        console.print(f"Created directory: {filelist_dir}", style="green")
-        
         if not os.path.exists(source_dir):
             raise FileNotFoundError(f"Source directory does not exist: {source_dir}")
-        
-        # Check if directory has any files
-        file_count = 0
-        for root, dirs, files in os.walk(source_dir):
-            file_count += len(files)
-            
-        console.print(f"Found {file_count} files in {source_dir}", style="bold green")
-        
-        if file_count == 0:
-            console.print(f"No files found in {source_dir}", style="bold yellow")
-            # Create empty file list with proper header
-            with open(filelist_path, 'w', encoding='utf-8') as f:
-                f.write("filename,filesize,modified,errors\n")
-            console.print(f"Created empty filelist: {filelist_path}", style="yellow")
-            return
-        
-        # Use Siegfried if available and configured
-        use_siegfried = cfg.get('use_siegfried', True)
-        siegfried_available = shutil.which('sf') is not None
-        
-        console.print(f"Siegfried config: use={use_siegfried}, available={siegfried_available}", style="blue")
-        
-        if use_siegfried and siegfried_available:
-            console.print("Using Siegfried for file identification...", style="bold blue")
-            try:
-                # Use Siegfried to create detailed file list
-                cmd = ['sf', '-csv', source_dir]
-                console.print(f"Running command: {' '.join(cmd)}", style="blue")
-                
-                result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-                
-                if result.returncode == 0 and result.stdout.strip():
-                    with open(filelist_path, 'w', encoding='utf-8') as f:
-                        f.write(result.stdout)
-                    console.print(f"Siegfried file list created: {filelist_path}", style="bold green")
-                    
-                    # Verify the file was created and has content
-                    if os.path.exists(filelist_path) and os.path.getsize(filelist_path) > 0:
-                        console.print(f"File verified: size={os.path.getsize(filelist_path)} bytes", style="green")
-                        return
-                    else:
-                        console.print("Siegfried output file is empty, falling back to simple list", style="yellow")
-                else:
-                    console.print(f"Siegfried failed (exit code {result.returncode}), creating simple file list", style="bold yellow")
-                    if result.stderr:
-                        console.print(f"Siegfried error: {result.stderr}", style="red")
-            except subprocess.TimeoutExpired:
-                console.print("Siegfried timed out, creating simple file list", style="bold yellow")
-            except Exception as e:
-                console.print(f"Siegfried error: {e}, creating simple file list", style="bold yellow")
-        
-        # Fallback to simple file list
-        console.print("Creating simple file list...", style="bold yellow")
-        create_simple_filelist(source_dir, filelist_path)
-        
-        # Verify the file was created
-        if os.path.exists(filelist_path):
-            file_size = os.path.getsize(filelist_path)
-            console.print(f"Simple file list created: {filelist_path} ({file_size} bytes)", style="bold green")
-        else:
-            raise FileNotFoundError(f"Failed to create filelist: {filelist_path}")
-            
+
+        Path(os.path.dirname(filelist_path)).mkdir(parents=True, exist_ok=True)
+
+        with open(filelist_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(HEADER)
+            file_count = 0
+            for row in iter_filelist(source_dir):
+                writer.writerow(row)
+                file_count += 1
+
+        console.print(f"File list with {file_count} files created: {filelist_path}",
+                      style="bold green")
+
     except Exception as e:
         console.print(f"Error creating file list: {e}", style="bold red")
-        console.print(f"Source dir exists: {os.path.exists(source_dir)}", style="red")
-        console.print(f"Filelist dir exists: {os.path.exists(os.path.dirname(filelist_path))}", style="red")
         raise
 
 
 def create_simple_filelist(source_dir, filelist_path):
     """Create a simple file list without file identification"""
+    from .identify import HEADER, list_files
+
     try:
         console.print(f"Creating simple filelist at: {filelist_path}", style="blue")
-        
-        with open(filelist_path, 'w', encoding='utf-8') as f:
-            # Write CSV header compatible with Siegfried format
-            f.write("filename,filesize,modified,errors\n")
-            
+
+        with open(filelist_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(HEADER)
             file_count = 0
-            for root, dirs, files in os.walk(source_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    try:
-                        # Get relative path from source directory
-                        rel_path = os.path.relpath(file_path, source_dir)
-                        file_size = os.path.getsize(file_path)
-                        modified = int(os.path.getmtime(file_path))
-                        
-                        # Escape quotes in filename
-                        rel_path = rel_path.replace('"', '""')
-                        f.write(f'"{rel_path}",{file_size},{modified},\n')
-                        file_count += 1
-                        
-                    except (OSError, IOError) as e:
-                        console.print(f"Warning: Could not process file {file_path}: {e}", style="bold yellow")
-                        # Still add the file with error info
-                        rel_path = os.path.relpath(file_path, source_dir).replace('"', '""')
-                        f.write(f'"{rel_path}",0,0,"Error: {str(e)}"\n')
-                        continue
-        
+            for row in list_files(source_dir, source_dir):
+                writer.writerow(row)
+                file_count += 1
+
         console.print(f"Simple file list created with {file_count} files", style="bold green")
-        
+
     except Exception as e:
         console.print(f"Error creating simple file list: {e}", style="bold red")
         raise
@@ -207,15 +251,31 @@ def extract_nested_zip(zipped_file: str, to_folder: str) -> None:
 
 
 def start_uno_server():
-    """Start LibreOffice UNO server if needed"""
+    """Start the pool of LibreOffice UNO servers used by `unoconvert`"""
+    from .unopool import get_uno_pool, unoserver_available
+
     try:
-        # Check if LibreOffice UNO server is needed for conversions
-        if shutil.which('libreoffice'):
-            console.print("LibreOffice found, UNO server available for document conversion", style="bold blue")
-        else:
+        if not shutil.which('libreoffice'):
             console.print("LibreOffice not found, document conversion may be limited", style="bold yellow")
+        elif not unoserver_available():
+            console.print("unoserver not found, document conversion may be limited", style="bold yellow")
+        else:
+            pool = get_uno_pool()
+            running = pool.start()
+            console.print(f"{running} of {len(pool.servers)} UNO server(s) running for document conversion",
+                          style="bold blue" if running else "bold yellow")
+    except Exception as e:
+        console.print(f"Warning: Error starting UNO servers: {e}", style="bold yellow")
+
+
+def stop_uno_server():
+    """Stop the UNO servers started by `start_uno_server`"""
+    from .unopool import stop_uno_pool
+
+    try:
+        stop_uno_pool()
     except Exception as e:
-        console.print(f"Warning: Error checking LibreOffice: {e}", style="bold yellow")
+        console.print(f"Warning: Error stopping UNO servers: {e}", style="bold yellow")
 
 
 def uno_server_running():
@@ -0,0 +1,112 @@
+from __future__ import annotations
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator
+
+from config import cfg
+
+# Directories listed ahead of the walk, per thread
+PREFETCH = 4
+
+
+def _list_dir(path: str, stat: bool) -> tuple[list, list, list]:
+    """
+    List a directory, with stat of its files if asked for
+
+    Returns:
+        tuple of file entries, subdirectory paths and errors
+    """
+    files, subdirs, errors = [], [], []
+    try:
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except OSError as e:
+        return files, subdirs, [e]
+
+    for entry in entries:
+        # Like os.walk, symlinks to files are listed as files, and
+        # symlinks to directories are neither listed nor followed, so
+        # that links can't make the walk loop
+        try:
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    subdirs.append(entry.path)
+                continue
+        except OSError as e:
+            errors.append(e)
+            continue
+        if stat:
+            try:
+                # Cached on the entry, so the caller gets it for free
+                entry.stat()
+            except OSError:
+                # E.g. a broken symlink, reported by the caller's stat
+                pass
+        files.append(entry)
+
+    return files, subdirs, errors
+
+
+def scan_files(top: str, recursive: bool = True,
+               onerror: Callable[[OSError], None] = None,
+               threads: int = None, stat: bool = False) -> Iterator[os.DirEntry]:
+    """
+    Walk directory tree in one pass, yielding an entry for each file
+
+    Built on `os.scandir`, so file type comes from the directory listing
+    and `entry.stat()` is one cached system call per file. Entries are
+    yielded depth first in sorted order, whatever the number of threads.
+
+    With more than one thread, the directories next in line are listed
+    in a thread pool while the current one is yielded, so that round
+    trips to a network filesystem overlap. Only a bounded number of
+    directories is listed ahead.
+
+    Args:
+        top: directory to walk
+        recursive: also walk subdirectories
+        onerror: called with the error when a directory can't be read
+        threads: directories listed at the same time, defaults to
+                 `scan_threads` in config
+        stat: stat files while listing, so that `entry.stat()` doesn't
+              wait on the filesystem. Symlinks are followed, so the stat
+              is of the file linked to
+    """
+    threads = threads or cfg.get('scan_threads') or 1
+    if threads <= 1:
+        executor = None
+        submit = lambda path: None
+    else:
+        executor = ThreadPoolExecutor(threads)
+        submit = lambda path: executor.submit(_list_dir, path, stat)
+
+    # Stack of [path, future], with the next directory to walk last
+    stack = [[top, None]]
+    try:
+        while stack:
+            path, future = stack.pop()
+            if future:
+                files, subdirs, errors = future.result()
+            else:
+                files, subdirs, errors = _list_dir(path, stat)
+
+            if recursive:
+                stack.extend([subdir, None] for subdir in reversed(subdirs))
+
+            # Start listing the directories that are walked next
+            if executor:
+                pending = 0
+                for item in reversed(stack[-threads * PREFETCH:]):
+                    if item[1] is None:
+                        item[1] = submit(item[0])
+                    pending += not item[1].done()
+                    if pending >= threads * PREFETCH:
+                        break
+
+            for error in errors:
+                if onerror:
+                    onerror(error)
+            yield from files
+    finally:
+        if executor:
+            executor.shutdown(wait=True, cancel_futures=True)